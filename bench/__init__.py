@@ -0,0 +1,5 @@
+"""Medições de desempenho do FiscalFlow, fora da aplicação.
+
+Cada módulo roda sozinho a partir da pasta do projeto, por exemplo:
+python -m bench.painel --linhas 50000,100000
+"""
@@ -0,0 +1,56 @@
+"""Vendas simultâneas de vários processos, conferindo que nada se perdeu.
+
+python -m bench.concorrencia --processos 4 --vendas 200
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def vender_em_processo(pasta, prod_id, quantidade):
+    """Worker: registra vendas pela rota de verdade, com a pasta de dados do teste."""
+    os.chdir(pasta)
+    cliente = main.app.test_client()
+    inicio = time.perf_counter()
+    for _ in range(quantidade):
+        cliente.post('/registrar_venda', data={'produto_id': prod_id, 'quantidade': '1'})
+    return time.perf_counter() - inicio
+
+
+@click.command()
+@click.option('--processos', default=4, help='Processos vendendo ao mesmo tempo.')
+@click.option('--vendas', default=100, help='Vendas por processo.')
+def benchmark_concorrencia(processos, vendas):
+    """Vendas simultâneas de vários processos numa pasta temporária, conferindo o estoque no final."""
+    pasta = tempfile.mkdtemp(prefix='fiscalflow-bench-')
+    os.chdir(pasta)
+    main.init_db()
+    total = processos * vendas
+    main.escrever_csv('produtos', [{'id': 1, 'nome': 'Produto Benchmark', 'custo': 1.0, 'preco_venda': 2.0,
+                                    'quantidade': total, 'fornecedor': ''}])
+    contexto = multiprocessing.get_context('spawn')
+    with contexto.Pool(processos) as pool:
+        inicio = time.perf_counter()
+        pool.starmap(vender_em_processo, [(pasta, '1', vendas)] * processos)
+        duracao = time.perf_counter() - inicio
+
+    registradas = main.ler_csv('vendas')
+    estoque_final = main.estoque_atual()['1']
+    ids_unicos = len({v['id'] for v in registradas})
+    print(f'{total} vendas em {duracao:.2f}s com {processos} processos ({total / duracao:.0f} vendas/s)')
+    print(f'Vendas gravadas: {len(registradas)} (ids únicos: {ids_unicos}) | estoque final: {estoque_final}')
+    if len(registradas) != total or ids_unicos != total or estoque_final != 0:
+        raise click.ClickException('Inconsistência: houve atualização perdida ou id repetido.')
+    print(f'Consistente. Dados do teste em {pasta}')
+
+
+if __name__ == '__main__':
+    benchmark_concorrencia()
@@ -0,0 +1,77 @@
+"""Compara a leitura recortada da NFC-e com a leitura da página inteira.
+
+python -m bench.nfe --pasta caminho/das/paginas
+"""
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import ErroLeituraNFe, ler_itens_nfe  # noqa: E402
+
+
+def pagina_nfe_sintetica(n_itens):
+    """Página no formato da consulta pública da SEFAZ, com n_itens itens."""
+    linhas = ''.join(
+        f'<tr id="Item + {i + 1}"><td valign="top"><span class="txtTit">Produto {i} {i % 7 + 1} KG</span>'
+        f'<span class="RCod">(Código: {1000 + i} )</span><br><span class="Rqtd"><strong>Qtde.:</strong>{i % 5 + 1}</span>'
+        f'<span class="RUN"><strong>UN: </strong>UN</span><span class="RvlUnit"><strong>Vl. Unit.:</strong>'
+        f'&nbsp;{i + 1},{i % 100:02d}</span></td><td align="right" valign="top" class="txtTit noWrap">Vl. Total<br>'
+        f'<span class="valor">{(i + 1) * 2},00</span></td></tr>'
+        for i in range(n_itens))
+    rodape = '<div class="ui-grid"><span>Consulte pela chave de acesso em www.nfce.fazenda.sp.gov.br</span></div>' * 40
+    return ('<!DOCTYPE html><html><head><title>NFC-e</title><script src="jquery.js"></script></head><body>'
+            '<div data-role="page"><div id="conteudo"><div class="txtCenter">'
+            '<div id="u20" class="txtTopo">MERCADO EXEMPLO LTDA</div><div class="text">CNPJ: 00.000.000/0001-00</div>'
+            f'</div><table id="tabResult" cellspacing="0" cellpadding="0">{linhas}</table>'
+            f'<div id="totalNota"><label>Qtd. total de itens:</label><span class="totalNumb">{n_itens}</span></div>'
+            f'{rodape}</div></div></body></html>')
+
+
+@click.command()
+@click.option('--pasta', default=None, type=click.Path(exists=True, file_okay=False),
+              help='Pasta com páginas de NFC-e salvas (*.html); sem ela, usa páginas sintéticas.')
+@click.option('--itens', default='1,10,50,150,300', help='Itens das páginas sintéticas, separados por vírgula.')
+@click.option('--repeticoes', default=20, help='Leituras de cada página.')
+def benchmark_nfe(pasta, itens, repeticoes):
+    """Compara a leitura recortada da NFC-e com a leitura da página inteira."""
+    if pasta:
+        paginas = []
+        for nome in sorted(os.listdir(pasta)):
+            if nome.lower().endswith(('.html', '.htm')):
+                with open(os.path.join(pasta, nome), mode='r', encoding='utf-8', errors='replace') as f:
+                    paginas.append((nome, f.read()))
+    else:
+        paginas = [(f'sintetica-{n}', pagina_nfe_sintetica(n)) for n in (int(x) for x in itens.split(','))]
+    print(f"{'pagina':<24} {'KB':>7} {'itens':>6} {'inteira (ms)':>13} {'recorte (ms)':>13} {'ganho':>6}  saída")
+    divergencias = 0
+    for nome, html in paginas:
+        tempos = []
+        resultados = []
+        for restrito in (False, True):
+            try:
+                resultado = ler_itens_nfe(html, restrito=restrito)
+            except ErroLeituraNFe as e:
+                resultado = f'erro: {e}'
+            t0 = time.perf_counter()
+            for _ in range(repeticoes):
+                try:
+                    ler_itens_nfe(html, restrito=restrito)
+                except ErroLeituraNFe:
+                    pass
+            tempos.append((time.perf_counter() - t0) / repeticoes * 1000)
+            resultados.append(resultado)
+        igual = resultados[0] == resultados[1]
+        divergencias += not igual
+        n_itens = len(resultados[1]) if isinstance(resultados[1], list) else 0
+        print(f'{nome[:24]:<24} {len(html) / 1024:>7.1f} {n_itens:>6} {tempos[0]:>13.2f} {tempos[1]:>13.2f} '
+              f'{tempos[0] / tempos[1]:>5.1f}x  {"igual" if igual else "DIFERENTE"}')
+    if divergencias:
+        raise click.ClickException(f'{divergencias} página(s) com saída diferente entre as duas leituras.')
+
+
+if __name__ == '__main__':
+    benchmark_nfe()
@@ -0,0 +1,57 @@
+"""Mede o motor de agregação do dashboard sobre vendas sintéticas.
+
+python -m bench.painel --linhas 50000,100000,200000
+"""
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import HEADERS, AgregadorPainel, TabelaColunar  # noqa: E402
+
+
+@click.command()
+@click.option('--linhas', default='10000,50000,100000,200000',
+              help='Quantidades de vendas sintéticas, separadas por vírgula.')
+def benchmark_painel(linhas):
+    """Mede o motor de agregação sobre linhas sintéticas (custo deve ser linear)."""
+    random.seed(42)
+    inicio = date.today() - timedelta(days=365)
+    nomes = [f'Produto {i}' for i in range(200)]
+    categorias = ['Fixa', 'Variavel', 'Pessoal']
+    print(f"{'linhas':>10} {'dicts (s)':>10} {'us/linha':>10} {'colunas (s)':>12} {'us/linha':>10}")
+    for n in (int(x) for x in linhas.split(',')):
+        vendas = []
+        for i in range(n):
+            dia = (inicio + timedelta(days=random.randrange(366))).isoformat()
+            total = random.randrange(100, 10000) / 100
+            vendas.append({'data': f'{dia} 10:00:00', 'nome_produto': random.choice(nomes),
+                           'total_venda': f'{total:.2f}', 'lucro_estimado': f'{total * 0.3:.2f}'})
+        despesas = [{'data': f'{(inicio + timedelta(days=random.randrange(366))).isoformat()} 09:00:00',
+                     'valor': f'{random.randrange(100, 50000) / 100:.2f}',
+                     'categoria': random.choice(categorias)} for _ in range(n // 20)]
+        total = n + len(despesas)
+        agregador = AgregadorPainel(inicio.isoformat(), date.today().isoformat())
+        t0 = time.perf_counter()
+        agregador.alimentar_linhas(vendas, despesas)
+        agregador.resultado()
+        dt = time.perf_counter() - t0
+        col_vendas = TabelaColunar('vendas', [tuple(v.get(c, '') for c in HEADERS['vendas']) for v in vendas],
+                                   HEADERS['vendas'])
+        col_despesas = TabelaColunar('despesas', [tuple(d.get(c, '') for c in HEADERS['despesas']) for d in despesas],
+                                     HEADERS['despesas'])
+        agregador = AgregadorPainel(inicio.isoformat(), date.today().isoformat())
+        t0 = time.perf_counter()
+        agregador.alimentar_colunas(col_vendas, col_despesas)
+        agregador.resultado()
+        dt_col = time.perf_counter() - t0
+        print(f'{n:>10} {dt:>10.3f} {dt / total * 1e6:>10.2f} {dt_col:>12.3f} {dt_col / total * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    benchmark_painel()
@@ -1,103 +1,2783 @@
+import bisect
 import csv
+import gzip
+import hashlib
+import html as html_lib
+import io
 import os
-from datetime import datetime, timedelta
-from collections import defaultdict
+import re
+import secrets
+import sqlite3
+import itertools
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import unicodedata
+from array import array
+from datetime import date, datetime, timedelta
+from collections import OrderedDict, defaultdict
+import click
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 # Adicionado 'render_template' e removido 'render_template_string' que causava o erro
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, Response, jsonify
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 import json
 from jinja2 import DictLoader
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import numpy as np
+except ImportError:  # NumPy é opcional: sem ele as colunas usam o módulo array
+    np = None
+
 app = Flask(__name__)
 app.secret_key = 'segredo_mercearia_familiar'
 
-# Configuração dos Arquivos
-DATA_DIR = 'dados_mercearia'
-FILES = {
-    'produtos': os.path.join(DATA_DIR, 'produtos.csv'),
-    'vendas': os.path.join(DATA_DIR, 'vendas.csv'),
-    'despesas': os.path.join(DATA_DIR, 'despesas.csv')
-}
+# Configuração dos Arquivos
+DATA_DIR = 'dados_mercearia'
+FILES = {
+    'produtos': os.path.join(DATA_DIR, 'produtos.csv'),
+    'vendas': os.path.join(DATA_DIR, 'vendas.csv'),
+    'despesas': os.path.join(DATA_DIR, 'despesas.csv'),
+    'movimentos': os.path.join(DATA_DIR, 'movimentos_estoque.csv'),
+    'nfce_aplicadas': os.path.join(DATA_DIR, 'nfce_aplicadas.csv')
+}
+
+# Cabeçalhos dos CSVs
+HEADERS = {
+    'produtos': ['id', 'nome', 'custo', 'preco_venda', 'quantidade', 'fornecedor', 'estoque_minimo'],
+    'vendas': ['id', 'data', 'produto_id', 'nome_produto', 'quantidade', 'total_venda', 'lucro_estimado', 'ticket_id'],
+    'despesas': ['id', 'data', 'descricao', 'valor', 'categoria'],
+    'movimentos': ['id', 'data', 'produto_id', 'delta', 'tipo', 'referencia'],
+    'nfce_aplicadas': ['id', 'chave', 'data', 'etapa', 'itens']
+}
+
+# --- Funções Auxiliares de Banco de Dados (CSV) ---
+
+# Backend de armazenamento: 'csv' (padrão) ou 'sqlite'
+BACKEND = os.environ.get('FISCALFLOW_BACKEND', 'csv').lower()
+SQLITE_FILE = os.path.join(DATA_DIR, 'fiscalflow.db')
+
+def _assinatura_arquivo(filepath):
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+# --- Trava entre Processos ---
+# Toda escrita acontece com a trava de dados_mercearia/.trava, que exclui
+# outros processos (vários workers do gunicorn) e, via RLock, as outras
+# threads deste processo. A mesma thread pode tomá-la de novo sem travar.
+TRAVA_FILE = os.path.join(DATA_DIR, '.trava')
+_trava_processo = threading.RLock()
+_trava_estado = {'profundidade': 0, 'arquivo': None}
+
+def _travar_arquivo(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue  # LK_LOCK desiste após ~10s; continua esperando
+
+def _destravar_arquivo(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _tentar_travar_arquivo(f):
+    """Como _travar_arquivo, mas sem esperar: False se outro processo tem a trava."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+@contextmanager
+def trava_dados():
+    with _trava_processo:
+        if _trava_estado['profundidade'] == 0:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            f = open(TRAVA_FILE, 'a+b')
+            _travar_arquivo(f)
+            _trava_estado['arquivo'] = f
+        _trava_estado['profundidade'] += 1
+        try:
+            yield
+        finally:
+            _trava_estado['profundidade'] -= 1
+            if _trava_estado['profundidade'] == 0:
+                f = _trava_estado['arquivo']
+                _trava_estado['arquivo'] = None
+                _destravar_arquivo(f)
+                f.close()
+
+def _gravar_atomico(filepath, escrever):
+    """Grava num temporário ao lado do destino e troca com os.replace.
+
+    Quem lê nunca vê um arquivo pela metade: ou o antigo, ou o novo inteiro.
+    """
+    temp = f'{filepath}.tmp-{os.getpid()}-{threading.get_ident()}'
+    with open(temp, mode='w', newline='', encoding='utf-8') as f:
+        escrever(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, filepath)
+
+# vendas e despesas ficam divididas por mês: dados_mercearia/vendas/2026-10.csv,
+# com a lista de meses em dados_mercearia/vendas/manifesto.json
+TABELAS_PARTICIONADAS = ('vendas', 'despesas')
+_RE_MES = re.compile(r'\d{4}-\d{2}$')
+
+def _mes_da_linha(linha):
+    mes = (linha.get('data') or '')[:7]
+    return mes if _RE_MES.match(mes) else datetime.now().strftime('%Y-%m')
+
+def _ultimo_dia_do_mes(mes):
+    inicio = date.fromisoformat(mes + '-01')
+    return ((inicio + timedelta(days=32)).replace(day=1) - timedelta(days=1)).isoformat()
+
+class _ArquivoConcatenado(io.RawIOBase):
+    """Vários arquivos lidos como um só: um prefixo seguido de trechos
+    (arquivo aberto, início, fim), com seek, para o Range dos downloads."""
+
+    def __init__(self, prefixo, trechos, assinaturas):
+        self._prefixo = prefixo
+        self._trechos = []
+        self._inicios = []
+        posicao = len(prefixo)
+        for arquivo, inicio, fim in trechos:
+            if fim > inicio:
+                self._inicios.append(posicao)
+                self._trechos.append((arquivo, inicio, fim))
+                posicao += fim - inicio
+            else:
+                arquivo.close()
+        self.tamanho = posicao
+        self.etag = hashlib.sha1(repr(assinaturas).encode('utf-8')).hexdigest()[:24]
+        self._posicao = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._posicao
+
+    def seek(self, posicao, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            posicao += self._posicao
+        elif whence == io.SEEK_END:
+            posicao += self.tamanho
+        self._posicao = max(0, posicao)
+        return self._posicao
+
+    def readinto(self, buffer):
+        if self._posicao >= self.tamanho:
+            return 0
+        if self._posicao < len(self._prefixo):
+            dados = self._prefixo[self._posicao:self._posicao + len(buffer)]
+        else:
+            i = bisect.bisect_right(self._inicios, self._posicao) - 1
+            arquivo, inicio, fim = self._trechos[i]
+            deslocamento = inicio + self._posicao - self._inicios[i]
+            arquivo.seek(deslocamento)
+            dados = arquivo.read(min(len(buffer), fim - deslocamento))
+            if not dados:
+                raise OSError('partição encolheu durante o download')
+        buffer[:len(dados)] = dados
+        self._posicao += len(dados)
+        return len(dados)
+
+    def close(self):
+        for arquivo, _, _ in self._trechos:
+            arquivo.close()
+        super().close()
+
+class ArmazenamentoCSV:
+    """Uma tabela por arquivo CSV em DATA_DIR, o formato original do sistema.
+
+    Reescritas vão para um temporário trocado por rename atômico. Commits com
+    mais de uma operação passam por um journal (transacao.journal) que é
+    refeito no init_db se o processo cair no meio.
+
+    vendas e despesas são particionadas por mês (uma pasta com um CSV por mês
+    e um manifesto). Anexos vão para o arquivo do mês da linha, consultas por
+    período só abrem os meses do filtro e, quando outro processo mexe na
+    tabela, só as partições que mudaram são relidas. Um mês fechado vira
+    <mês>.csv.gz com um <mês>.resumo.json ao lado; um anexo nele o reabre.
+    """
+
+    JOURNAL_FILE = os.path.join(DATA_DIR, 'transacao.journal')
+
+    agrega_em_sql = False
+
+    def __init__(self):
+        self._particoes_lidas = {}  # arquivo -> (assinatura, LinhasColunares)
+        self._manifestos = {}       # tipo -> (assinatura, manifesto)
+        self._resumos_fechados = {} # arquivo -> (assinatura, resumo)
+        self._recuperado = False
+
+    # --- Partições ---
+
+    @staticmethod
+    def pasta_particoes(tipo):
+        return os.path.join(DATA_DIR, tipo)
+
+    def _manifesto(self, tipo):
+        return os.path.join(self.pasta_particoes(tipo), 'manifesto.json')
+
+    def _caminho_mes(self, tipo, mes, extensao):
+        return os.path.join(self.pasta_particoes(tipo), f'{mes}{extensao}')
+
+    def arquivo_particao(self, tipo, mes):
+        """CSV do mês: <mês>.csv, ou <mês>.csv.gz se o mês está fechado."""
+        return self._caminho_mes(tipo, mes, '.csv.gz' if mes in self.fechados(tipo) else '.csv')
+
+    def particionada(self, tipo):
+        return tipo in TABELAS_PARTICIONADAS and os.path.exists(self._manifesto(tipo))
+
+    def _ler_manifesto(self, tipo):
+        caminho = self._manifesto(tipo)
+        assinatura = _assinatura_arquivo(caminho)
+        if assinatura is None:
+            return {'particoes': [], 'fechados': []}
+        guardado = self._manifestos.get(tipo)
+        if guardado is None or guardado[0] != assinatura:
+            with open(caminho, mode='r', encoding='utf-8') as f:
+                guardado = (assinatura, json.load(f))
+            self._manifestos[tipo] = guardado
+        return guardado[1]
+
+    def meses(self, tipo):
+        """Meses ('YYYY-MM') com partição, em ordem, segundo o manifesto."""
+        return self._ler_manifesto(tipo)['particoes']
+
+    def fechados(self, tipo):
+        """Meses já fechados (compactados em .csv.gz, com resumo pronto)."""
+        return self._ler_manifesto(tipo).get('fechados', [])
+
+    def _escrever_manifesto(self, caminho, meses, fechados=()):
+        _gravar_atomico(caminho, lambda f: json.dump({'particoes': sorted(meses),
+                                                      'fechados': sorted(fechados)}, f))
+
+    def _arquivos(self, tipo, data_inicio=None, data_fim=None):
+        """Arquivos da tabela, do mais antigo ao mais novo; particionada, só os meses do período."""
+        if not self.particionada(tipo):
+            return [FILES[tipo]]
+        return [self.arquivo_particao(tipo, mes) for mes in self.meses(tipo)
+                if not (data_inicio and mes < data_inicio[:7]) and not (data_fim and mes > data_fim[:7])]
+
+    def assinaturas_particoes(self, tipo):
+        """Mês -> assinatura do arquivo (como lista), ou None se a tabela não é particionada."""
+        if not self.particionada(tipo):
+            return None
+        return {mes: list(_assinatura_arquivo(self.arquivo_particao(tipo, mes)) or ())
+                for mes in self.meses(tipo)}
+
+    # --- Leitura ---
+
+    def inicializar(self):
+        for key, filepath in FILES.items():
+            if key in TABELAS_PARTICIONADAS:
+                self._inicializar_particoes(key)
+                continue
+            if not os.path.exists(filepath):
+                with open(filepath, mode='w', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(HEADERS[key])
+                continue
+            # Arquivos criados antes de uma coluna nova ganham a coluna vazia
+            if self._cabecalho(filepath) != HEADERS[key]:
+                campos, linhas = self._ler_arquivo(filepath)
+                self.escrever(key, [dict(zip(campos, linha)) for linha in linhas])
+
+    def _inicializar_particoes(self, tipo):
+        manifesto = self._manifesto(tipo)
+        if not os.path.exists(manifesto):
+            # Migração: o CSV único é dividido por mês num único commit e
+            # fica guardado como <tabela>.csv.migrado
+            os.makedirs(self.pasta_particoes(tipo), exist_ok=True)
+            legado = FILES[tipo]
+            linhas = []
+            if os.path.exists(legado):
+                campos, brutas = self._ler_arquivo(legado)
+                linhas = [dict(zip(campos, linha)) for linha in brutas]
+            self._aplicar_journal([(tipo, 'w', linhas)], particionar=True)
+            if os.path.exists(legado):
+                os.replace(legado, legado + '.migrado')
+            return
+        # Meses fechados ficam como estão: ler() completa as colunas novas
+        for mes in set(self.meses(tipo)) - set(self.fechados(tipo)):
+            caminho = self.arquivo_particao(tipo, mes)
+            if os.path.exists(caminho) and self._cabecalho(caminho) != HEADERS[tipo]:
+                campos, linhas = self._ler_arquivo(caminho)
+                self._gravar_csv(caminho, tipo, [dict(zip(campos, linha)) for linha in linhas])
+
+    def _cabecalho(self, caminho):
+        with open(caminho, mode='r', encoding='utf-8', newline='') as f:
+            return next(csv.reader([f.readline()]), [])
+
+    def existe(self, tipo):
+        return self.particionada(tipo) or os.path.exists(FILES[tipo])
+
+    def assinatura(self, tipo):
+        if not self.particionada(tipo):
+            return _assinatura_arquivo(FILES[tipo])
+        # Manifesto e todas as partições, achatados numa tupla de inteiros
+        partes = [_assinatura_arquivo(self._manifesto(tipo)) or (0, 0, 0)]
+        partes += [_assinatura_arquivo(c) or (0, 0, 0) for c in self._arquivos(tipo)]
+        return tuple(itertools.chain.from_iterable(partes))
+
+    def _ler_arquivo(self, caminho):
+        abrir = gzip.open if caminho.endswith('.gz') else open
+        with abrir(caminho, mode='rt', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            campos = next(reader, [])
+            n = len(campos)
+            linhas = []
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) != n:
+                    row = (row + [''] * n)[:n]
+                linhas.append(tuple(row))
+        return campos, linhas
+
+    def ler(self, tipo):
+        """Devolve (campos, linhas) com as linhas como tuplas de strings.
+
+        vendas e despesas vêm como LinhasColunares, um bloco por mês.
+        """
+        if not self.particionada(tipo):
+            campos, linhas = self._ler_arquivo(FILES[tipo])
+            if tipo in TABELAS_PARTICIONADAS:
+                linhas = LinhasColunares(campos, linhas)
+            return campos, linhas
+        partes = []
+        arquivos = self._arquivos(tipo)
+        for caminho in arquivos:
+            assinatura = _assinatura_arquivo(caminho)
+            if assinatura is None:
+                continue
+            lido = self._particoes_lidas.get(caminho)
+            if lido is None or lido[0] != assinatura:
+                campos, particao = self._ler_arquivo(caminho)
+                if campos != HEADERS[tipo]:
+                    particao = [tuple(dict(zip(campos, linha)).get(c, '') for c in HEADERS[tipo]) for linha in particao]
+                lido = (assinatura, LinhasColunares(HEADERS[tipo], particao))
+                self._particoes_lidas[caminho] = lido
+            partes.append(lido[1])
+        for caminho in [c for c in self._particoes_lidas if c not in arquivos and
+                        os.path.dirname(c) == self.pasta_particoes(tipo)]:
+            del self._particoes_lidas[caminho]
+        return list(HEADERS[tipo]), LinhasColunares(HEADERS[tipo], partes=partes)
+
+    def _abrir_instantaneo(self, caminho):
+        """Abre o arquivo e anota o tamanho com a trava, ou None se não existe.
+
+        Um mês fechado (.gz) não recebe anexos: o tamanho fica None, sem limite.
+        """
+        with trava_dados():
+            try:
+                if caminho.endswith('.gz'):
+                    return gzip.open(caminho, mode='rb'), None
+                f = open(caminho, mode='rb')
+            except FileNotFoundError:
+                return None
+            return f, os.fstat(f.fileno()).st_size
+
+    def iterar(self, tipo, data_inicio=None, data_fim=None):
+        """Linhas da tabela (dicts), lidas do disco uma a uma, sem carregar o arquivo.
+
+        O tamanho é anotado com a trava: o que for anexado depois, ou um anexo
+        ainda pela metade, fica de fora. Uma reescrita troca o arquivo por
+        rename, e o arquivo aberto continua sendo o antigo. Particionada, só
+        os meses do período são abertos.
+        """
+        for caminho in self._arquivos(tipo, data_inicio, data_fim):
+            aberto = self._abrir_instantaneo(caminho)
+            if aberto is None:
+                continue
+            f, tamanho = aberto
+            with f:
+                def linhas_texto():
+                    lidos = 0
+                    for linha in f:
+                        lidos += len(linha)
+                        if tamanho is not None and lidos > tamanho:
+                            return
+                        yield linha.decode('utf-8')
+                reader = csv.reader(linhas_texto())
+                campos = next(reader, [])
+                n = len(campos)
+                p_data = campos.index('data') if 'data' in campos else None
+                for row in reader:
+                    if not row:
+                        continue
+                    if len(row) != n:
+                        row = (row + [''] * n)[:n]
+                    if p_data is not None:
+                        dia = row[p_data][:10]
+                        if (data_inicio and dia < data_inicio) or (data_fim and dia > data_fim):
+                            continue
+                    yield dict(zip(campos, row))
+
+    def abrir_concatenado(self, tipo):
+        """A tabela particionada como um CSV só, para servir com Range.
+
+        Devolve um _ArquivoConcatenado com o cabeçalho seguido do corpo de
+        cada mês, com tamanhos e assinaturas anotados com a trava (como em
+        iterar(), o que for anexado depois fica de fora). None se algum mês
+        fechado ainda tem o cabeçalho antigo e precisa ser completado.
+        """
+        cabecalho = io.StringIO()
+        csv.writer(cabecalho).writerow(HEADERS[tipo])
+        cabecalho = cabecalho.getvalue().encode('utf-8')
+        trechos, assinaturas = [], []
+        try:
+            with trava_dados():
+                for caminho in self._arquivos(tipo):
+                    try:
+                        if caminho.endswith('.gz'):
+                            # Tamanho descompactado: os 4 últimos bytes do gzip
+                            with open(caminho, mode='rb') as bruto:
+                                bruto.seek(-4, os.SEEK_END)
+                                tamanho = int.from_bytes(bruto.read(4), 'little')
+                            f = gzip.open(caminho, mode='rb')
+                        else:
+                            f = open(caminho, mode='rb')
+                            tamanho = os.fstat(f.fileno()).st_size
+                    except FileNotFoundError:
+                        continue
+                    trechos.append((f, len(cabecalho), tamanho))
+                    assinaturas.append(_assinatura_arquivo(caminho))
+                    if f.readline() != cabecalho:
+                        raise ValueError(caminho)
+        except ValueError:
+            for f, _, _ in trechos:
+                f.close()
+            return None
+        return _ArquivoConcatenado(cabecalho, trechos, assinaturas)
+
+    def ultimas(self, tipo, n):
+        """As n últimas linhas da tabela (dicts), da mais nova para a mais antiga.
+
+        Lê blocos a partir do fim de cada arquivo (o mês mais novo primeiro)
+        até juntar n linhas completas: o custo não depende do tamanho do
+        histórico. Como em iterar(), um anexo ainda pela metade fica de fora.
+        """
+        resultado = []
+        for caminho in reversed(self._arquivos(tipo)):
+            resultado += self._ultimas_arquivo(caminho, n - len(resultado))
+            if len(resultado) >= n:
+                break
+        return resultado
+
+    def _ultimas_arquivo(self, caminho, n):
+        aberto = self._abrir_instantaneo(caminho)
+        if aberto is None:
+            return []
+        f, tamanho = aberto
+        if tamanho is None:
+            # Mês fechado: o arquivo compactado não permite ler de trás para frente
+            with f:
+                linhas = list(csv.reader(io.TextIOWrapper(f, encoding='utf-8', newline='')))
+            campos = linhas[0] if linhas else []
+            return [dict(zip(campos, (row + [''] * len(campos))[:len(campos)]))
+                    for row in reversed(linhas[1:]) if row][:n]
+        with f:
+            campos = next(csv.reader([f.readline().decode('utf-8')]), [])
+            inicio_dados = f.tell()
+            fim = tamanho
+            dados = b''
+            while fim > inicio_dados and dados.count(b'\n') <= n:
+                passo = min(8192, fim - inicio_dados)
+                fim -= passo
+                f.seek(fim)
+                dados = f.read(passo) + dados
+        linhas = dados.split(b'\n')
+        if fim > inicio_dados:
+            linhas = linhas[1:]  # a primeira pode ter começado antes do bloco lido
+        resultado = []
+        for row in csv.reader(linha.decode('utf-8') for linha in reversed(linhas) if linha.strip()):
+            resultado.append(dict(zip(campos, (row + [''] * len(campos))[:len(campos)])))
+            if len(resultado) == n:
+                break
+        return resultado
+
+    # --- Escrita ---
+
+    def anexar(self, tipo, dados):
+        self.anexar_varios(tipo, [dados])
+
+    def anexar_varios(self, tipo, linhas):
+        if not self.particionada(tipo):
+            self._anexar_arquivo(FILES[tipo], tipo, linhas)
+            return
+        grupos = {}
+        for linha in linhas:
+            grupos.setdefault(_mes_da_linha(linha), []).append(linha)
+        meses = self.meses(tipo)
+        novos = [mes for mes in grupos if mes not in meses]
+        if novos:
+            # O manifesto vem antes: partição listada e ainda sem arquivo é só um mês vazio
+            self._escrever_manifesto(self._manifesto(tipo), meses + novos, self.fechados(tipo))
+        for mes in grupos:
+            if mes in self.fechados(tipo):
+                self._reabrir_mes(tipo, mes)
+        for mes, grupo in grupos.items():
+            self._anexar_arquivo(self.arquivo_particao(tipo, mes), tipo, grupo)
+
+    def _anexar_arquivo(self, filepath, tipo, linhas):
+        file_exists = os.path.exists(filepath)
+        # Monta o lote inteiro antes e grava com um único write
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=HEADERS[tipo])
+        if not file_exists:
+            writer.writeheader()
+        writer.writerows(linhas)
+        with open(filepath, mode='a', newline='', encoding='utf-8') as f:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _gravar_csv(self, caminho, tipo, dados):
+        def escrever(f):
+            writer = csv.DictWriter(f, fieldnames=HEADERS[tipo], extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(dados)
+        _gravar_atomico(caminho, escrever)
+
+    def fechar_mes(self, mes, resumos):
+        """Compacta o mês de cada tabela particionada em <mês>.csv.gz e grava
+        resumos[tipo] em <mês>.resumo.json, num único commit pelo journal."""
+        self._concluir_journal()
+        passos = []
+        for n, tipo in enumerate(TABELAS_PARTICIONADAS):
+            if not self.particionada(tipo) or mes in self.fechados(tipo):
+                continue
+            origem = self._caminho_mes(tipo, mes, '.csv')
+            destino = self._caminho_mes(tipo, mes, '.csv.gz')
+            temp = f'{destino}.tmp-{os.getpid()}-{n}'
+            with gzip.open(temp, mode='wb') as saida:
+                if os.path.exists(origem):
+                    with open(origem, mode='rb') as entrada:
+                        for bloco in iter(lambda: entrada.read(1024 * 1024), b''):
+                            saida.write(bloco)
+                else:
+                    saida.write((','.join(HEADERS[tipo]) + '\r\n').encode('utf-8'))
+            passos.append(['renomear', tipo, temp, destino])
+            resumo = self._caminho_mes(tipo, mes, '.resumo.json')
+            temp = f'{resumo}.tmp-{os.getpid()}-{n}'
+            _gravar_atomico(temp, lambda f: json.dump(resumos[tipo], f))
+            passos.append(['renomear', tipo, temp, resumo])
+            manifesto = self._manifesto(tipo)
+            temp = f'{manifesto}.tmp-{os.getpid()}-{n}'
+            self._escrever_manifesto(temp, set(self.meses(tipo)) | {mes}, self.fechados(tipo) + [mes])
+            passos.append(['renomear', tipo, temp, manifesto])
+            passos.append(['remover', tipo, origem])
+        if passos:
+            self._confirmar_passos(passos)
+
+    def _reabrir_mes(self, tipo, mes):
+        """Volta um mês fechado para CSV comum, para receber linhas de novo."""
+        _, linhas = self._ler_arquivo(self._caminho_mes(tipo, mes, '.csv.gz'))
+        def escrever(f):
+            writer = csv.writer(f)
+            writer.writerow(HEADERS[tipo])
+            writer.writerows(linhas)
+        _gravar_atomico(self._caminho_mes(tipo, mes, '.csv'), escrever)
+        # Com o manifesto atualizado o .gz e o resumo deixam de valer
+        self._escrever_manifesto(self._manifesto(tipo), self.meses(tipo),
+                                 [m for m in self.fechados(tipo) if m != mes])
+        for extensao in ('.csv.gz', '.resumo.json'):
+            caminho = self._caminho_mes(tipo, mes, extensao)
+            if os.path.exists(caminho):
+                os.remove(caminho)
+
+    def resumos_fechados(self, tipo, data_inicio, data_fim):
+        """{mês: resumo} dos meses fechados que tocam o período.
+
+        Um resumo só muda junto com o manifesto (reabrir ou fechar de novo),
+        então fica guardado enquanto o manifesto for o mesmo.
+        """
+        if not self.particionada(tipo):
+            return {}
+        fechados = self.fechados(tipo)
+        versao = self._manifestos[tipo][0]
+        resumos = {}
+        for mes in fechados:
+            if not data_inicio[:7] <= mes <= data_fim[:7]:
+                continue
+            caminho = self._caminho_mes(tipo, mes, '.resumo.json')
+            guardado = self._resumos_fechados.get(caminho)
+            if guardado is None or guardado[0] != versao:
+                with open(caminho, mode='r', encoding='utf-8') as f:
+                    guardado = (versao, json.load(f))
+                self._resumos_fechados[caminho] = guardado
+            resumos[mes] = guardado[1]
+        return resumos
+
+    def maiores(self, tipo, colunas):
+        """Maior valor inteiro de cada coluna da tabela.
+
+        Meses fechados entram pelos maiores valores guardados no resumo do
+        fechamento, sem abrir o .gz; só os meses abertos são lidos.
+        """
+        maiores = dict.fromkeys(colunas, 0)
+        if not self.particionada(tipo):
+            arquivos = [FILES[tipo]]
+        else:
+            resumos = self.resumos_fechados(tipo, '0000-01-01', '9999-12-31')
+            arquivos = []
+            for mes in self.meses(tipo):
+                guardados = resumos.get(mes, {}).get('maiores', {})
+                if all(c in guardados for c in colunas):
+                    for c in colunas:
+                        maiores[c] = max(maiores[c], guardados[c])
+                else:
+                    arquivos.append(self.arquivo_particao(tipo, mes))
+        for caminho in arquivos:
+            if not os.path.exists(caminho):
+                continue
+            campos, linhas = self._ler_arquivo(caminho)
+            for c in colunas:
+                if c in campos:
+                    p = campos.index(c)
+                    maiores[c] = max(maiores[c], max((_inteiro(linha[p]) for linha in linhas), default=0))
+        return maiores
+
+    def escrever(self, tipo, dados):
+        if self.particionada(tipo):
+            # Várias partições mudam juntas: passa pelo journal
+            self._aplicar_journal([(tipo, 'w', dados)])
+            return
+        self._gravar_csv(FILES[tipo], tipo, dados)
+
+    def aplicar(self, operacoes):
+        """Aplica [(tipo, modo, dados)] como um único commit."""
+        self._concluir_journal()
+        if len(operacoes) == 1:
+            tipo, modo, dados = operacoes[0]
+            if modo == 'w':
+                self.escrever(tipo, dados)
+            else:
+                self.anexar(tipo, dados)
+            return
+        self._aplicar_journal(operacoes)
+
+    def _aplicar_journal(self, operacoes, particionar=False):
+        # 1) Reescritas vão para temporários completos; 2) o journal com a
+        # lista de passos é gravado (ponto de commit); 3) os passos são
+        # aplicados; 4) o journal é apagado.
+        passos = []
+        for n, (tipo, modo, dados) in enumerate(operacoes):
+            if modo == 'w' and (particionar or self.particionada(tipo)):
+                # Uma partição por mês das linhas; meses que sumiram são apagados
+                grupos = {}
+                for linha in dados:
+                    grupos.setdefault(_mes_da_linha(linha), []).append(linha)
+                # Meses fechados voltam a ser CSV comum
+                for mes, grupo in sorted(grupos.items()):
+                    destino = self._caminho_mes(tipo, mes, '.csv')
+                    temp = f'{destino}.tmp-{os.getpid()}-{n}'
+                    self._gravar_csv(temp, tipo, grupo)
+                    passos.append(['renomear', tipo, temp, destino])
+                manifesto = self._manifesto(tipo)
+                temp = f'{manifesto}.tmp-{os.getpid()}-{n}'
+                self._escrever_manifesto(temp, grupos)
+                passos.append(['renomear', tipo, temp, manifesto])
+                for mes in self.meses(tipo):
+                    if mes not in grupos:
+                        passos.append(['remover', tipo, self._caminho_mes(tipo, mes, '.csv')])
+                for mes in self.fechados(tipo):
+                    for extensao in ('.csv.gz', '.resumo.json'):
+                        passos.append(['remover', tipo, self._caminho_mes(tipo, mes, extensao)])
+            elif modo == 'w':
+                temp = f'{FILES[tipo]}.tmp-{os.getpid()}-{n}'
+                self._gravar_csv(temp, tipo, dados)
+                passos.append(['renomear', tipo, temp])
+            elif passos and passos[-1][0] == 'anexar' and passos[-1][1] == tipo:
+                # Linhas seguidas para a mesma tabela viram um único append
+                passos[-1][2].append(_normalizar_linha(tipo, dados))
+            else:
+                passos.append(['anexar', tipo, [_normalizar_linha(tipo, dados)]])
+        self._confirmar_passos(passos)
+
+    def _confirmar_passos(self, passos):
+        _gravar_atomico(self.JOURNAL_FILE, lambda f: json.dump(passos, f))
+        self._aplicar_passos(passos, recuperando=False)
+        os.remove(self.JOURNAL_FILE)
+
+    def _aplicar_passos(self, passos, recuperando):
+        for passo in passos:
+            acao, tipo, valor = passo[:3]
+            if acao == 'renomear':
+                if os.path.exists(valor):
+                    os.replace(valor, passo[3] if len(passo) > 3 else FILES[tipo])
+            elif acao == 'remover':
+                if os.path.exists(valor):
+                    os.remove(valor)
+            elif recuperando:
+                self._reparar_final(tipo)
+                campos, linhas = self.ler(tipo)
+                pos_id = campos.index('id')
+                gravados = {linha[pos_id] for linha in linhas}
+                faltando = [linha for linha in valor if linha['id'] not in gravados]
+                if faltando:
+                    self.anexar_varios(tipo, faltando)
+            else:
+                self.anexar_varios(tipo, valor)
+
+    def _reparar_final(self, tipo):
+        """Corta uma última linha incompleta deixada por uma gravação interrompida."""
+        for filepath in self._arquivos(tipo):
+            self._reparar_arquivo(filepath)
+
+    def _reparar_arquivo(self, filepath):
+        if filepath.endswith('.gz') or not os.path.exists(filepath):
+            return
+        with open(filepath, mode='rb+') as f:
+            f.seek(0, os.SEEK_END)
+            tamanho = f.tell()
+            if tamanho == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b'\n':
+                return
+            bloco = min(tamanho, 64 * 1024)
+            f.seek(-bloco, os.SEEK_END)
+            final = f.read(bloco)
+            f.truncate(tamanho - bloco + final.rfind(b'\n') + 1)
+
+    def recuperar(self):
+        """Conclui um commit interrompido e limpa temporários órfãos.
+
+        Roda uma vez por processo, na inicialização: reparar o fim de cada
+        partição e listar as pastas não cabe no caminho das requisições. Um
+        journal que sobrar depois disso (commit que falhou no meio, aqui ou
+        em outro processo) é concluído pela próxima escrita.
+        """
+        if self._recuperado:
+            return
+        self._concluir_journal()
+        for tipo in FILES:
+            self._reparar_final(tipo)
+        pastas = [DATA_DIR] + [self.pasta_particoes(tipo) for tipo in TABELAS_PARTICIONADAS]
+        for pasta in pastas:
+            if not os.path.isdir(pasta):
+                continue
+            for nome in os.listdir(pasta):
+                if '.tmp-' in nome:
+                    os.remove(os.path.join(pasta, nome))
+        self._recuperado = True
+
+    def _concluir_journal(self):
+        if not os.path.exists(self.JOURNAL_FILE):
+            return
+        with open(self.JOURNAL_FILE, mode='r', encoding='utf-8') as f:
+            try:
+                passos = json.load(f)
+            except ValueError:
+                passos = []  # journal incompleto: o commit não chegou a acontecer
+        self._aplicar_passos(passos, recuperando=True)
+        os.remove(self.JOURNAL_FILE)
+
+class ArmazenamentoSQLite:
+    """Tabelas com o mesmo esquema de HEADERS num banco SQLite em modo WAL.
+
+    Filtros por data e agrupamentos do dashboard rodam direto no SQL, usando
+    os índices de vendas.data, vendas.produto_id e despesas.data. Cada escrita
+    incrementa a versão da tabela em _versoes, que faz o papel do mtime dos
+    CSVs para o cache em memória.
+    """
+
+    agrega_em_sql = True
+    INDICES = {
+        'vendas': ['data', 'produto_id'],
+        'despesas': ['data'],
+    }
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._local = threading.local()
+
+    def _conexao(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.caminho, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def inicializar(self):
+        conn = self._conexao()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS _versoes (tabela TEXT PRIMARY KEY, versao INTEGER NOT NULL)')
+            for tipo, campos in HEADERS.items():
+                colunas = ', '.join('id INTEGER PRIMARY KEY' if c == 'id' else f'{c} TEXT' for c in campos)
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {tipo} ({colunas})')
+                existentes = {row[1] for row in conn.execute(f'PRAGMA table_info({tipo})')}
+                for campo in campos:
+                    if campo not in existentes:
+                        conn.execute(f"ALTER TABLE {tipo} ADD COLUMN {campo} TEXT NOT NULL DEFAULT ''")
+                for coluna in self.INDICES.get(tipo, []):
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{tipo}_{coluna} ON {tipo} ({coluna})')
+                conn.execute('INSERT OR IGNORE INTO _versoes (tabela, versao) VALUES (?, 0)', (tipo,))
+
+    def _incrementar_versao(self, conn, tipo):
+        conn.execute('UPDATE _versoes SET versao = versao + 1 WHERE tabela = ?', (tipo,))
+
+    def assinatura(self, tipo):
+        row = self._conexao().execute('SELECT versao FROM _versoes WHERE tabela = ?', (tipo,)).fetchone()
+        return (row[0],) if row else None
+
+    # O banco já filtra por data com índice; não há partições por mês
+    def particionada(self, tipo):
+        return False
+
+    def assinaturas_particoes(self, tipo):
+        return None
+
+    def resumos_fechados(self, tipo, data_inicio, data_fim):
+        return {}
+
+    def ler(self, tipo):
+        campos = HEADERS[tipo]
+        cursor = self._conexao().execute(f'SELECT {", ".join(campos)} FROM {tipo} ORDER BY id')
+        linhas = [tuple('' if v is None else str(v) for v in row) for row in cursor]
+        if tipo in TABELAS_PARTICIONADAS:
+            linhas = LinhasColunares(campos, linhas)
+        return list(campos), linhas
+
+    def iterar(self, tipo, data_inicio=None, data_fim=None):
+        """Linhas da tabela (dicts) lidas por um cursor, com o filtro de data no SQL.
+
+        Usa uma conexão própria: o cursor fica aberto enquanto a resposta é
+        enviada e não pode atrapalhar as escritas da conexão da thread.
+        """
+        campos = HEADERS[tipo]
+        condicoes, parametros = [], []
+        if 'data' in campos and data_inicio:
+            condicoes.append('data >= ?')
+            parametros.append(data_inicio)
+        if 'data' in campos and data_fim:
+            condicoes.append('data < ?')
+            parametros.append((date.fromisoformat(data_fim) + timedelta(days=1)).isoformat())
+        where = f' WHERE {" AND ".join(condicoes)}' if condicoes else ''
+        conn = sqlite3.connect(self.caminho, timeout=30)
+        try:
+            cursor = conn.execute(f'SELECT {", ".join(campos)} FROM {tipo}{where} ORDER BY id', parametros)
+            for row in cursor:
+                yield {c: '' if v is None else str(v) for c, v in zip(campos, row)}
+        finally:
+            conn.close()
+
+    def ultimas(self, tipo, n):
+        """As n últimas linhas (maiores ids), da mais nova para a mais antiga."""
+        campos = HEADERS[tipo]
+        cursor = self._conexao().execute(f'SELECT {", ".join(campos)} FROM {tipo} ORDER BY id DESC LIMIT ?', (n,))
+        return [{c: '' if v is None else str(v) for c, v in zip(campos, row)} for row in cursor]
+
+    def maiores(self, tipo, colunas):
+        """Maior valor inteiro de cada coluna da tabela (o de id vem da chave primária)."""
+        expressoes = ', '.join('MAX(id)' if c == 'id' else f'MAX(CAST({c} AS INTEGER))' for c in colunas)
+        row = self._conexao().execute(f'SELECT {expressoes} FROM {tipo}').fetchone()
+        return {c: int(v or 0) for c, v in zip(colunas, row)}
+
+    def _valores(self, tipo, dados):
+        linha = _normalizar_linha(tipo, dados)
+        return [linha[c] or None if c == 'id' else linha[c] for c in HEADERS[tipo]]
+
+    def _insert(self, tipo):
+        campos = HEADERS[tipo]
+        return f'INSERT INTO {tipo} ({", ".join(campos)}) VALUES ({", ".join("?" * len(campos))})'
+
+    def anexar(self, tipo, dados):
+        self.aplicar([(tipo, 'a', dados)])
+
+    def escrever(self, tipo, dados):
+        self.aplicar([(tipo, 'w', dados)])
+
+    def aplicar(self, operacoes):
+        """Aplica [(tipo, modo, dados)] numa única transação do SQLite."""
+        conn = self._conexao()
+        with conn:
+            for tipo, modo, dados in operacoes:
+                if modo == 'w':
+                    conn.execute(f'DELETE FROM {tipo}')
+                    conn.executemany(self._insert(tipo), (self._valores(tipo, d) for d in dados))
+                else:
+                    conn.execute(self._insert(tipo), self._valores(tipo, dados))
+                self._incrementar_versao(conn, tipo)
+
+    def recuperar(self):
+        pass  # o próprio SQLite desfaz transações interrompidas
+
+    def resumos(self, data_inicio, data_fim):
+        """Mesmo formato de obter_resumos(), agregado no SQL só para o intervalo."""
+        fim_exclusivo = (date.fromisoformat(data_fim) + timedelta(days=1)).isoformat()
+        conn = self._conexao()
+        resumos = _resumos_vazios()
+        cursor = conn.execute(
+            'SELECT substr(data, 1, 10) AS dia, nome_produto, '
+            'SUM(CAST(ROUND(total_venda * 100) AS INTEGER)), SUM(CAST(ROUND(lucro_estimado * 100) AS INTEGER)) '
+            'FROM vendas WHERE data >= ? AND data < ? GROUP BY dia, nome_produto',
+            (data_inicio, fim_exclusivo))
+        for dia, nome, total, lucro in cursor:
+            dia_resumo = resumos['vendas'].setdefault(dia, {'total': 0, 'lucro': 0, 'produtos': {}})
+            dia_resumo['total'] += total
+            dia_resumo['lucro'] += lucro
+            dia_resumo['produtos'][nome] = [total, lucro]
+        cursor = conn.execute(
+            "SELECT substr(data, 1, 10) AS dia, COALESCE(NULLIF(categoria, ''), 'Outros') AS cat, "
+            'SUM(CAST(ROUND(valor * 100) AS INTEGER)) '
+            'FROM despesas WHERE data >= ? AND data < ? GROUP BY dia, cat',
+            (data_inicio, fim_exclusivo))
+        for dia, categoria, valor in cursor:
+            dia_resumo = resumos['despesas'].setdefault(dia, {'total': 0, 'categorias': {}})
+            dia_resumo['total'] += valor
+            dia_resumo['categorias'][categoria] = valor
+        return resumos
+
+    def categorias_despesas(self):
+        cursor = self._conexao().execute(
+            "SELECT DISTINCT COALESCE(NULLIF(categoria, ''), 'Outros') FROM despesas")
+        return sorted(row[0] for row in cursor)
+
+armazenamento = ArmazenamentoSQLite(SQLITE_FILE) if BACKEND == 'sqlite' else ArmazenamentoCSV()
+
+def init_db():
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    with trava_dados():
+        armazenamento.recuperar()
+        armazenamento.inicializar()
+        preparar_sequencias()
+
+# init_db() roda uma vez por processo, antes da primeira requisição (ou no
+# __main__), e não mais a cada visita ao dashboard: ele toma a trava e
+# passa por todas as partições, o que anularia os caches. No mesmo momento,
+# as importações de NFC-e deixadas pela metade por um processo que morreu
+# passam a 'falhou'.
+_preparacao = {'feita': False}
+_trava_preparacao = threading.Lock()
+
+def preparar_dados():
+    if _preparacao['feita']:
+        return
+    with _trava_preparacao:
+        if not _preparacao['feita']:
+            init_db()
+            recuperar_importacoes()
+            _preparacao['feita'] = True
+
+@app.before_request
+def _preparar_dados_antes_da_requisicao():
+    preparar_dados()
+
+# --- Cache de Tabelas em Memória ---
+# Cada tabela lida fica guardada junto com a assinatura da fonte (mtime,
+# tamanho e inode do CSV, ou a versão da tabela no SQLite). Enquanto ela não
+# mudar, ler_csv reaproveita as linhas já parseadas; escrever_csv atualiza o
+# cache na hora, então só edições externas obrigam a reler a tabela.
+_cache_tabelas = {}
+_cache_lock = threading.RLock()
+_contador_versoes = itertools.count(1)
+
+def assinatura_tabela(tipo):
+    return armazenamento.assinatura(tipo)
+
+def _normalizar_linha(tipo, linha):
+    """Converte a linha para o mesmo formato que o csv.DictReader devolve."""
+    return {campo: '' if linha.get(campo) is None else str(linha.get(campo))
+            for campo in HEADERS[tipo]}
+
+def _carregar_tabela(tipo):
+    """Entrada do cache da tabela, relendo a fonte só se ela mudou.
+
+    As linhas ficam guardadas como tuplas na ordem de 'campos', que ocupam
+    bem menos memória que um dicionário por linha; vendas e despesas, as
+    tabelas que crescem sem parar, ficam em colunas (LinhasColunares).
+    """
+    assinatura = assinatura_tabela(tipo)
+    if assinatura is None:
+        _cache_tabelas.pop(tipo, None)
+        return None
+    entrada = _cache_tabelas.get(tipo)
+    if entrada is None or entrada['assinatura'] != assinatura:
+        campos, linhas = armazenamento.ler(tipo)
+        entrada = {'assinatura': assinatura, 'campos': campos, 'linhas': linhas,
+                   'versao': next(_contador_versoes)}
+        _cache_tabelas[tipo] = entrada
+    return entrada
+
+def _linhas_do_cache(tipo, linhas):
+    return LinhasColunares(HEADERS[tipo], linhas) if tipo in TABELAS_PARTICIONADAS else linhas
+
+def versao_tabela(tipo):
+    """Número que muda sempre que o conteúdo da tabela muda (neste processo)."""
+    with _cache_lock:
+        entrada = _carregar_tabela(tipo)
+        return entrada['versao'] if entrada else 0
+
+def _indexar_por_data(entrada, pos):
+    campos = entrada['campos']
+    linha = entrada['linhas'][pos]
+    chave = (linha[campos.index('data')], _inteiro(linha[campos.index('id')]), pos)
+    indice = entrada['por_data']
+    bisect.insort(indice[''], chave)
+    if 'categoria' in campos:
+        bisect.insort(indice.setdefault(linha[campos.index('categoria')] or 'Outros', []), chave)
+
+def indice_por_data(entrada):
+    """Índice da tabela por data: categoria ('' = todas) -> [(data, id, posição)] em ordem.
+
+    Montado na primeira consulta e, daí em diante, mantido por gravar_em_lote
+    a cada linha anexada; uma reescrita da tabela cria entrada nova, sem índice.
+    """
+    if 'por_data' not in entrada:
+        campos = entrada['campos']
+        p_data, p_id = campos.index('data'), campos.index('id')
+        p_categoria = campos.index('categoria') if 'categoria' in campos else None
+        indice = {'': []}
+        for pos, linha in enumerate(entrada['linhas']):
+            chave = (linha[p_data], _inteiro(linha[p_id]), pos)
+            indice[''].append(chave)
+            if p_categoria is not None:
+                indice.setdefault(linha[p_categoria] or 'Outros', []).append(chave)
+        for chaves in indice.values():
+            chaves.sort()
+        entrada['por_data'] = indice
+    return entrada['por_data']
+
+def pagina_por_data(tipo, data_inicio='', data_fim='', categoria='', pagina=1, por_pagina=50):
+    """Uma página da tabela, da data mais recente para a mais antiga.
+
+    Duas buscas binárias no índice por data delimitam o período; só as linhas
+    da página são montadas. Devolve (linhas, total no período).
+    """
+    with _cache_lock:
+        entrada = _carregar_tabela(tipo)
+        if entrada is None:
+            return [], 0
+        chaves = indice_por_data(entrada).get(categoria, [])
+        inicio = bisect.bisect_left(chaves, (data_inicio,)) if data_inicio else 0
+        fim = len(chaves)
+        if data_fim:
+            dia_seguinte = (date.fromisoformat(data_fim) + timedelta(days=1)).isoformat()
+            fim = bisect.bisect_left(chaves, (dia_seguinte,))
+        total = max(0, fim - inicio)
+        ate = fim - (pagina - 1) * por_pagina
+        fatia = chaves[max(inicio, ate - por_pagina):max(inicio, ate)]
+        campos = entrada['campos']
+        return [dict(zip(campos, entrada['linhas'][pos])) for _, _, pos in reversed(fatia)], total
+
+def ler_csv(tipo):
+    with _cache_lock:
+        entrada = _carregar_tabela(tipo)
+        if entrada is None:
+            return []
+        # Dicionários novos a cada leitura: as rotas alteram as linhas antes de regravar
+        campos = entrada['campos']
+        return [dict(zip(campos, linha)) for linha in entrada['linhas']]
+
+def ler_colunas(tipo):
+    """Versão colunar e tipada da tabela, montada uma vez por versão do CSV."""
+    with _cache_lock:
+        entrada = _carregar_tabela(tipo)
+        if entrada is None:
+            return TabelaColunar(tipo, [], HEADERS[tipo])
+        if 'colunas' not in entrada:
+            entrada['colunas'] = TabelaColunar(tipo, entrada['linhas'], entrada['campos'])
+        return entrada['colunas']
+
+def escrever_csv(tipo, dados, mode='w'):
+    """Se mode='a', adiciona uma linha. Se mode='w', reescreve tudo."""
+    if mode in ('a', 'w'):
+        gravar_em_lote([(tipo, mode, dados)])
+
+def gravar_em_lote(operacoes):
+    """Grava [(tipo, modo, dados)] como um único commit, com a trava de dados.
+
+    Serve para ações que mexem em mais de uma tabela, como a venda, que baixa
+    o estoque e registra a venda: ou as duas gravações valem, ou nenhuma.
+    Cache, colunas e resumos são atualizados sem reler as tabelas.
+    """
+    with trava_dados():
+        resumos = None
+        if not armazenamento.agrega_em_sql and any(
+                tipo in ('vendas', 'despesas') and modo == 'a' for tipo, modo, _ in operacoes):
+            resumos = obter_resumos()
+        with _cache_lock:
+            tipos = list(dict.fromkeys(tipo for tipo, _, _ in operacoes))
+            antes = {tipo: assinatura_tabela(tipo) for tipo in tipos}
+            armazenamento.aplicar(operacoes)
+
+            for tipo in tipos:
+                entrada = _cache_tabelas.get(tipo)
+                valida = (entrada is not None and entrada['assinatura'] == antes[tipo]
+                          and entrada['campos'] == HEADERS[tipo])
+                if antes[tipo] is None:
+                    entrada, valida = {'campos': HEADERS[tipo], 'linhas': _linhas_do_cache(tipo, [])}, True
+                # Particionada, o disco guarda as linhas agrupadas por mês; o
+                # cache precisa ficar na mesma ordem de uma releitura
+                mes = None
+                if armazenamento.particionada(tipo):
+                    p_data = HEADERS[tipo].index('data')
+                    mes = lambda linha: _mes_da_linha({'data': linha[p_data]})
+                for tipo_op, modo, dados in operacoes:
+                    if tipo_op != tipo:
+                        continue
+                    if modo == 'w':
+                        linhas = [tuple(_normalizar_linha(tipo, d).values()) for d in dados]
+                        if mes is not None:
+                            linhas.sort(key=mes)
+                        entrada = {'campos': HEADERS[tipo], 'linhas': _linhas_do_cache(tipo, linhas)}
+                        valida = True
+                    elif valida:
+                        linha = tuple(_normalizar_linha(tipo, dados).values())
+                        if mes is not None and entrada['linhas'] and mes(linha) < mes(entrada['linhas'][-1]):
+                            valida = False  # foi para um mês anterior: relê a tabela
+                            continue
+                        entrada['linhas'].append(linha)
+                        if 'colunas' in entrada:
+                            entrada['colunas'].anexar(linha)
+                        if 'por_data' in entrada:
+                            _indexar_por_data(entrada, len(entrada['linhas']) - 1)
+                if valida:
+                    entrada['assinatura'] = assinatura_tabela(tipo)
+                    entrada['versao'] = next(_contador_versoes)
+                    _cache_tabelas[tipo] = entrada
+                else:
+                    # O cache já estava desatualizado; a próxima leitura relê a tabela
+                    _cache_tabelas.pop(tipo, None)
+
+            if resumos is not None:
+                meses, acrescidas = set(), set()
+                for tipo, modo, dados in operacoes:
+                    if tipo in ('vendas', 'despesas') and modo == 'a':
+                        linha = _normalizar_linha(tipo, dados)
+                        _acumular_resumo(resumos, tipo, linha)
+                        meses.add(_mes_da_linha(linha))
+                        acrescidas.add(tipo)
+                # Tabela reescrita no mesmo commit fica com a fonte antiga e é
+                # refeita na próxima leitura
+                reescritas = {tipo for tipo, modo, _ in operacoes if modo == 'w'}
+                for tipo in acrescidas - reescritas:
+                    fontes = _fontes_resumo(tipo)
+                    if isinstance(fontes, dict) and isinstance(resumos['fontes'][tipo], dict):
+                        for mes in meses & fontes.keys():
+                            resumos['fontes'][tipo][mes] = fontes[mes]
+                    else:
+                        resumos['fontes'][tipo] = fontes
+                # Só os arquivos dos meses que receberam linhas são regravados
+                for mes in meses:
+                    _salvar_resumo_mes(resumos, mes)
+
+# --- Representação Colunar ---
+# Tipos das colunas usadas em agregações. Datas viram o número ordinal do dia,
+# dinheiro vira centavos inteiros e textos repetidos (nomes de produto,
+# categorias) viram ids que apontam para uma lista de valores únicos.
+TIPOS_COLUNAS = {
+    'produtos': {'id': 'inteiro', 'nome': 'texto', 'custo': 'centavos',
+                 'preco_venda': 'centavos', 'quantidade': 'inteiro', 'fornecedor': 'texto'},
+    'vendas': {'id': 'inteiro', 'data': 'dia', 'produto_id': 'inteiro', 'nome_produto': 'texto',
+               'quantidade': 'inteiro', 'total_venda': 'centavos', 'lucro_estimado': 'centavos',
+               'ticket_id': 'inteiro'},
+    'despesas': {'id': 'inteiro', 'data': 'dia', 'valor': 'centavos', 'categoria': 'texto'},
+    'movimentos': {'id': 'inteiro', 'produto_id': 'inteiro', 'delta': 'inteiro'},
+}
+
+def _centavos(valor):
+    try:
+        return int(round(float(valor) * 100))
+    except (TypeError, ValueError):
+        return 0
+
+def _inteiro(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        try:
+            return int(float(valor))
+        except (TypeError, ValueError):
+            return 0
+
+class TabelaColunar:
+    """Colunas tipadas de uma tabela guardadas em array('q') (int64).
+
+    Com NumPy instalado, coluna() devolve um ndarray para operações
+    vetorizadas; sem ele, devolve o próprio array para laços enxutos.
+    """
+
+    def __init__(self, tipo, linhas, campos):
+        self.tipo = tipo
+        self.tipos = TIPOS_COLUNAS.get(tipo, {})
+        self._posicoes = {c: campos.index(c) for c in self.tipos if c in campos}
+        self.colunas = {c: array('q') for c in self.tipos}
+        self.textos = {c: [] for c, t in self.tipos.items() if t == 'texto'}
+        self._ids_textos = {c: {} for c in self.textos}
+        self._dias = {}
+        for linha in linhas:
+            self.anexar(linha)
+
+    def __len__(self):
+        return len(self.colunas['id']) if 'id' in self.colunas else 0
+
+    def _dia(self, valor):
+        chave = valor[:10]
+        ordinal = self._dias.get(chave)
+        if ordinal is None:
+            try:
+                ordinal = date.fromisoformat(chave).toordinal()
+            except ValueError:
+                ordinal = 0
+            self._dias[chave] = ordinal
+        return ordinal
+
+    def _texto(self, coluna, valor):
+        ids = self._ids_textos[coluna]
+        i = ids.get(valor)
+        if i is None:
+            i = ids[valor] = len(self.textos[coluna])
+            self.textos[coluna].append(valor)
+        return i
+
+    def anexar(self, linha):
+        """Adiciona uma linha (tupla na ordem do CSV) ao fim das colunas."""
+        for coluna, tipo in self.tipos.items():
+            pos = self._posicoes.get(coluna)
+            valor = linha[pos] if pos is not None else ''
+            if tipo == 'centavos':
+                convertido = _centavos(valor)
+            elif tipo == 'dia':
+                convertido = self._dia(valor)
+            elif tipo == 'texto':
+                convertido = self._texto(coluna, valor)
+            else:
+                convertido = _inteiro(valor)
+            self.colunas[coluna].append(convertido)
+
+    def coluna(self, nome):
+        if np is not None:
+            # Cópia, e não view: o array.array não pode crescer enquanto exporta o buffer
+            return np.array(self.colunas[nome], dtype=np.int64)
+        return self.colunas[nome]
+
+    def dias_iso(self):
+        """Mapa ordinal -> 'YYYY-MM-DD' dos dias presentes na tabela."""
+        return {ordinal: chave for chave, ordinal in self._dias.items()}
+
+class LinhasColunares:
+    """Linhas de vendas/despesas guardadas por coluna, no lugar de uma tupla
+    por linha.
+
+    Valores repetidos (produto, quantidade, categoria...) são um só objeto
+    por coluna, via vocabulário; id e data, quase sempre únicos, ficam sem.
+    Uma tabela particionada é a sequência dos blocos dos meses, sem cópia,
+    mais as linhas anexadas depois. Para quem usa, é a lista de tuplas de
+    sempre: len(), índice, iteração e append().
+    """
+
+    CAMPOS_UNICOS = ('id', 'data')
+
+    def __init__(self, campos, linhas=(), partes=()):
+        self._partes = [parte for parte in partes if len(parte)]
+        self._inicios = list(itertools.accumulate([0] + [len(parte) for parte in self._partes]))
+        self._base = self._inicios.pop()
+        linhas = list(linhas)
+        colunas = zip(*linhas) if linhas else [() for _ in campos]
+        self._vocabularios = [None if campo in self.CAMPOS_UNICOS else {} for campo in campos]
+        self._colunas = [list(coluna) if vocabulario is None else
+                         [vocabulario.setdefault(valor, valor) for valor in coluna]
+                         for coluna, vocabulario in zip(colunas, self._vocabularios)]
+
+    def __len__(self):
+        return self._base + len(self._colunas[0]) if self._colunas else self._base
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError(pos)
+        if pos >= self._base:
+            return tuple([coluna[pos - self._base] for coluna in self._colunas])
+        i = bisect.bisect_right(self._inicios, pos) - 1
+        return self._partes[i][pos - self._inicios[i]]
+
+    def __iter__(self):
+        return itertools.chain(*self._partes, zip(*self._colunas))
+
+    def append(self, linha):
+        for coluna, vocabulario, valor in zip(self._colunas, self._vocabularios, linha):
+            coluna.append(valor if vocabulario is None else vocabulario.setdefault(valor, valor))
+
+# --- Índice do Catálogo por Nome Normalizado ---
+# Casa itens de NFC-e com produtos cadastrados em O(1) por item. Os nomes são
+# comparados já normalizados: minúsculas, sem acentos, espaços colapsados e
+# unidades escritas de um jeito só ("5 KG", "5kg" e "5 Kg." viram "5kg").
+_UNIDADES = {
+    'kg': 'kg', 'kgs': 'kg', 'g': 'g', 'gr': 'g', 'grs': 'g', 'mg': 'mg',
+    'l': 'l', 'lt': 'l', 'lts': 'l', 'litro': 'l', 'litros': 'l', 'ml': 'ml',
+    'un': 'un', 'und': 'un', 'unid': 'un', 'unids': 'un', 'pct': 'pct', 'cx': 'cx',
+}
+_RE_UNIDADE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(' + '|'.join(sorted(_UNIDADES, key=len, reverse=True)) + r')\b\.?')
+_RE_ESPACOS = re.compile(r'\s+')
+
+def normalizar_nome(nome):
+    sem_acento = unicodedata.normalize('NFKD', nome or '')
+    texto = ''.join(c for c in sem_acento if not unicodedata.combining(c)).lower()
+    texto = _RE_UNIDADE.sub(lambda m: m.group(1).replace(',', '.') + _UNIDADES[m.group(2)], texto)
+    return _RE_ESPACOS.sub(' ', texto).strip()
+
+def _trigramas(nome_normalizado):
+    texto = f'  {nome_normalizado} '
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _fragmentos(nome_normalizado):
+    """Todos os trechos de 1 a 3 letras de cada palavra do nome."""
+    return {palavra[i:i + n] for palavra in nome_normalizado.split()
+            for n in (1, 2, 3) for i in range(len(palavra) - n + 1)}
+
+class IndiceCatalogo:
+    """Mapa nome normalizado -> ids de produto, com busca aproximada opcional.
+
+    Os índices de trigramas e de fragmentos e a lista ordenada de nomes só
+    são montados na primeira busca que precisa deles (sugerir(), contendo()
+    ou autocompletar()) e, daí em diante, são mantidos junto com o mapa
+    principal.
+    """
+
+    def __init__(self):
+        self.versao = None
+        self._nomes = {}        # id -> nome original
+        self._normalizados = {}  # id -> nome normalizado
+        self._por_nome = {}     # nome normalizado -> [ids]
+        self._trigramas = None  # trigrama -> {ids}
+        self._fragmentos = None  # trecho de 1 a 3 letras de uma palavra -> {ids}
+        self._ordenados = None  # [(nome normalizado, id)] em ordem
+
+    def adicionar(self, prod_id, nome):
+        if prod_id in self._nomes:
+            self.remover(prod_id)
+        chave = normalizar_nome(nome)
+        self._nomes[prod_id] = nome
+        self._normalizados[prod_id] = chave
+        self._por_nome.setdefault(chave, []).append(prod_id)
+        if self._trigramas is not None:
+            for tri in _trigramas(chave):
+                self._trigramas.setdefault(tri, set()).add(prod_id)
+        if self._fragmentos is not None:
+            for fragmento in _fragmentos(chave):
+                self._fragmentos.setdefault(fragmento, set()).add(prod_id)
+        if self._ordenados is not None:
+            bisect.insort(self._ordenados, (chave, prod_id))
+
+    def remover(self, prod_id):
+        self._nomes.pop(prod_id, None)
+        chave = self._normalizados.pop(prod_id, None)
+        if chave is None:
+            return
+        ids = self._por_nome.get(chave, [])
+        if prod_id in ids:
+            ids.remove(prod_id)
+        if not ids:
+            self._por_nome.pop(chave, None)
+        if self._trigramas is not None:
+            for tri in _trigramas(chave):
+                self._trigramas.get(tri, set()).discard(prod_id)
+        if self._fragmentos is not None:
+            for fragmento in _fragmentos(chave):
+                self._fragmentos.get(fragmento, set()).discard(prod_id)
+        if self._ordenados is not None:
+            i = bisect.bisect_left(self._ordenados, (chave, prod_id))
+            if i < len(self._ordenados) and self._ordenados[i] == (chave, prod_id):
+                del self._ordenados[i]
+
+    def sincronizar(self, produtos):
+        """Aplica só as diferenças em relação à lista (id, nome) recebida."""
+        atuais = dict(produtos)
+        alterados = [(prod_id, nome) for prod_id, nome in atuais.items() if self._nomes.get(prod_id) != nome]
+        removidos = [i for i in self._nomes if i not in atuais]
+        if len(alterados) + len(removidos) > 1000:
+            # Em cargas grandes sai mais barato remontar trigramas e ordem depois
+            self._trigramas = self._fragmentos = self._ordenados = None
+        for prod_id, nome in alterados:
+            self.adicionar(prod_id, nome)
+        for prod_id in removidos:
+            self.remover(prod_id)
+
+    def buscar(self, nome):
+        """Ids dos produtos cujo nome normalizado é igual ao informado."""
+        return list(self._por_nome.get(normalizar_nome(nome), []))
+
+    def normalizado(self, prod_id):
+        return self._normalizados.get(prod_id, '')
+
+    def contendo(self, texto):
+        """Ids cujo nome normalizado contém todas as palavras do texto, ou cujo id é o texto."""
+        palavras = normalizar_nome(texto).split()
+        ids = {texto.strip()} & self._nomes.keys()
+        if palavras:
+            ids.update(prod_id for prod_id in self._candidatos(palavras)
+                       if all(p in self._normalizados[prod_id] for p in palavras))
+        return ids
+
+    def _candidatos(self, palavras):
+        """Ids que têm todos os fragmentos das palavras; falta conferir a ordem deles.
+
+        Palavras de até 3 letras são um fragmento inteiro; as maiores viram
+        os trigramas que as compõem.
+        """
+        fragmentos = self._indice_fragmentos()
+        candidatos = None
+        for palavra in palavras:
+            partes = [palavra] if len(palavra) <= 3 else [palavra[j:j + 3] for j in range(len(palavra) - 2)]
+            for parte in partes:
+                ids = fragmentos.get(parte, set())
+                candidatos = set(ids) if candidatos is None else candidatos & ids
+                if not candidatos:
+                    return set()
+        return candidatos or set()
+
+    def autocompletar(self, texto, limite=10, aceitar=None):
+        """Ids para a busca digitada no caixa, no máximo 'limite', na ordem de relevância.
+
+        Primeiro o id exato (leitor de código), depois os nomes que começam com
+        o texto (busca binária na lista ordenada) e, se faltar, os que contêm
+        todas as palavras. 'aceitar(id)' descarta produtos, como os sem estoque.
+        """
+        if self._ordenados is None:
+            self._ordenados = sorted((chave, prod_id) for prod_id, chave in self._normalizados.items())
+        aceitar = aceitar or (lambda prod_id: True)
+        encontrados = []
+        vistos = set()
+
+        def incluir(prod_id):
+            if prod_id not in vistos:
+                vistos.add(prod_id)
+                if aceitar(prod_id):
+                    encontrados.append(prod_id)
+            return len(encontrados) >= limite
+
+        texto = texto.strip()
+        if texto in self._nomes and incluir(texto):
+            return encontrados
+        prefixo = normalizar_nome(texto)
+        if not prefixo:
+            return encontrados
+        i = bisect.bisect_left(self._ordenados, (prefixo,))
+        while i < len(self._ordenados) and self._ordenados[i][0].startswith(prefixo):
+            if incluir(self._ordenados[i][1]):
+                return encontrados
+            i += 1
+        palavras = prefixo.split()
+        # Para o "contém", o índice de fragmentos reduz os candidatos
+        ordem = sorted((self._normalizados[prod_id], prod_id) for prod_id in self._candidatos(palavras))
+        for chave, prod_id in ordem:
+            if prod_id not in vistos and all(p in chave for p in palavras) and incluir(prod_id):
+                break
+        return encontrados
+
+    def _indice_trigramas(self):
+        if self._trigramas is None:
+            self._trigramas = {}
+            for prod_id, chave in self._normalizados.items():
+                for tri in _trigramas(chave):
+                    self._trigramas.setdefault(tri, set()).add(prod_id)
+        return self._trigramas
+
+    def _indice_fragmentos(self):
+        if self._fragmentos is None:
+            self._fragmentos = {}
+            for prod_id, chave in self._normalizados.items():
+                for fragmento in _fragmentos(chave):
+                    self._fragmentos.setdefault(fragmento, set()).add(prod_id)
+        return self._fragmentos
+
+    def sugerir(self, nome, limite=3, similaridade_minima=0.4):
+        """Produtos com nome parecido (similaridade de trigramas), do mais parecido ao menos."""
+        self._indice_trigramas()
+        consulta = _trigramas(normalizar_nome(nome))
+        em_comum = defaultdict(int)
+        for tri in consulta:
+            for prod_id in self._trigramas.get(tri, ()):
+                em_comum[prod_id] += 1
+        sugestoes = []
+        for prod_id, n in em_comum.items():
+            total = len(consulta) + len(_trigramas(self._normalizados[prod_id])) - n
+            score = n / total if total else 0
+            if score >= similaridade_minima:
+                sugestoes.append((score, prod_id))
+        sugestoes.sort(key=lambda s: (-s[0], self._nomes[s[1]]))
+        return [(prod_id, self._nomes[prod_id], round(score, 2)) for score, prod_id in sugestoes[:limite]]
+
+_indice_catalogo = IndiceCatalogo()
+
+def indice_catalogo():
+    """Índice do catálogo, sincronizado com a versão atual de produtos.csv."""
+    with _cache_lock:
+        versao = versao_tabela('produtos')
+        if _indice_catalogo.versao != versao:
+            entrada = _carregar_tabela('produtos')
+            linhas = entrada['linhas'] if entrada else []
+            campos = entrada['campos'] if entrada else HEADERS['produtos']
+            pos_id, pos_nome = campos.index('id'), campos.index('nome')
+            _indice_catalogo.sincronizar((linha[pos_id], linha[pos_nome]) for linha in linhas)
+            _indice_catalogo.versao = versao
+        return _indice_catalogo
+
+# --- Sequências de IDs ---
+# Último id entregue por tabela, salvo em sequencias.json a cada reserva,
+# antes de as linhas serem gravadas. O arquivo é semeado com o maior id de
+# cada tabela no init_db, quando ainda não existe (primeira execução ou
+# migração); depois disso nenhuma alocação olha os dados.
+SEQUENCIAS_FILE = os.path.join(DATA_DIR, 'sequencias.json')
+_sequencias = None
+
+def _ler_arquivo_sequencias():
+    if os.path.exists(SEQUENCIAS_FILE):
+        try:
+            with open(SEQUENCIAS_FILE, mode='r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    return {}
+
+def _semear_sequencias(sequencias):
+    """Completa as sequências que faltam com o maior id já gravado na tabela."""
+    for tipo in FILES:
+        if tipo not in sequencias:
+            sequencias[tipo] = armazenamento.maiores(tipo, ['id'])['id']
+    # Tickets do caixa: uma sequência própria, a partir de vendas.ticket_id
+    if 'tickets' not in sequencias:
+        sequencias['tickets'] = armazenamento.maiores('vendas', ['ticket_id'])['ticket_id']
+    # Movimentos já compactados no snapshot não estão mais no CSV
+    sequencias['movimentos'] = max(int(sequencias['movimentos']), _ler_snapshot_estoque()['ultimo_movimento'])
+    return sequencias
+
+def preparar_sequencias():
+    """Grava sequencias.json semeado pelos dados, se ele ainda não tem todas as tabelas."""
+    with trava_dados():
+        sequencias = _ler_arquivo_sequencias()
+        if all(tipo in sequencias for tipo in [*FILES, 'tickets']):
+            return
+        sequencias = _semear_sequencias(sequencias)
+        _gravar_atomico(SEQUENCIAS_FILE, lambda f: json.dump(sequencias, f))
+
+def _carregar_sequencias():
+    global _sequencias
+    # Semeia de novo só se o arquivo sumiu depois do init_db
+    _sequencias = _semear_sequencias({k: int(v) for k, v in _ler_arquivo_sequencias().items()})
+
+def reservar_ids(tipo, quantidade=1):
+    """Reserva 'quantidade' ids consecutivos para a tabela e devolve o range."""
+    with trava_dados():
+        if _sequencias is None:
+            _carregar_sequencias()
+        else:
+            # Outros workers podem ter avançado a sequência desde a última reserva
+            for chave, valor in _ler_arquivo_sequencias().items():
+                _sequencias[chave] = max(_sequencias.get(chave, 0), int(valor))
+        primeiro = _sequencias.get(tipo, 0) + 1
+        _sequencias[tipo] = primeiro + quantidade - 1
+        _gravar_atomico(SEQUENCIAS_FILE, lambda f: json.dump(_sequencias, f))
+    return range(primeiro, primeiro + quantidade)
+
+def gerar_id(tipo):
+    return reservar_ids(tipo, 1)[0]
+
+# --- Movimentos de Estoque ---
+# Vendas, entradas de NFC-e e ajustes manuais não reescrevem produtos.csv:
+# cada mudança vira uma linha anexada em movimentos_estoque.csv. O estoque
+# atual é o snapshot (estoque_snapshot.json) mais os movimentos com id maior
+# que o último compactado. Produtos cadastrados depois do snapshot partem da
+# quantidade do catálogo. Passando de LIMITE_MOVIMENTOS linhas, o ledger é
+# compactado num snapshot novo e esvaziado.
+#
+# Junto das quantidades fica o conjunto de produtos abaixo do estoque mínimo
+# (coluna estoque_minimo do catálogo; vazia vale ESTOQUE_MINIMO_PADRAO). Cada
+# movimento reavalia só o produto movimentado.
+ESTOQUE_SNAPSHOT_FILE = os.path.join(DATA_DIR, 'estoque_snapshot.json')
+LIMITE_MOVIMENTOS = 5000
+ESTOQUE_MINIMO_PADRAO = 5
+_estoque = {'chave': None, 'entrada': None, 'lidas': 0, 'ultimo': 0, 'quantidades': {},
+            'minimos': {}, 'baixo': set(), 'versao': 0}
+
+def estoque_minimo(valor):
+    """Estoque mínimo do produto a partir do valor da coluna (vazio: o padrão)."""
+    valor = str(valor).strip()
+    return _inteiro(valor) if valor else ESTOQUE_MINIMO_PADRAO
+
+def _ler_snapshot_estoque():
+    try:
+        with open(ESTOQUE_SNAPSHOT_FILE, mode='r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        return {'ultimo_movimento': int(snapshot['ultimo_movimento']),
+                'quantidades': snapshot['quantidades']}
+    except (FileNotFoundError, ValueError, KeyError):
+        return {'ultimo_movimento': 0, 'quantidades': {}}
+
+def estoque_atual():
+    """Quantidade atual por id de produto (str). Não altere o dicionário.
+
+    Só os movimentos anexados desde a última chamada são somados; o cálculo
+    completo acontece quando o catálogo ou o snapshot mudam.
+    """
+    with _cache_lock:
+        movimentos = _carregar_tabela('movimentos')
+        chave = (versao_tabela('produtos'), _assinatura_arquivo(ESTOQUE_SNAPSHOT_FILE))
+        recalcular = _estoque['chave'] != chave or _estoque['entrada'] is not movimentos
+        if recalcular:
+            snapshot = _ler_snapshot_estoque()
+            compactadas = snapshot['quantidades']
+            quantidades = {}
+            minimos = {}
+            for p in ler_csv('produtos'):
+                quantidades[p['id']] = int(compactadas[p['id']]) if p['id'] in compactadas \
+                    else _inteiro(p['quantidade'])
+                minimos[p['id']] = estoque_minimo(p.get('estoque_minimo', ''))
+            _estoque.update(chave=chave, entrada=movimentos, lidas=0,
+                            ultimo=snapshot['ultimo_movimento'], quantidades=quantidades,
+                            minimos=minimos, baixo=set())
+        movidos = set()
+        if movimentos is not None:
+            campos = movimentos['campos']
+            p_id, p_produto, p_delta = (campos.index(c) for c in ('id', 'produto_id', 'delta'))
+            quantidades, ultimo = _estoque['quantidades'], _estoque['ultimo']
+            linhas = movimentos['linhas']
+            for linha in itertools.islice(linhas, _estoque['lidas'], None):
+                if _inteiro(linha[p_id]) > ultimo:
+                    quantidades[linha[p_produto]] = quantidades.get(linha[p_produto], 0) + _inteiro(linha[p_delta])
+                    movidos.add(linha[p_produto])
+            _estoque['lidas'] = len(linhas)
+        if recalcular or movidos:
+            _estoque['versao'] = next(_contador_versoes)
+        minimos, baixo, quantidades = _estoque['minimos'], _estoque['baixo'], _estoque['quantidades']
+        for prod_id in (minimos if recalcular else movidos):
+            if prod_id in minimos and quantidades[prod_id] < minimos[prod_id]:
+                baixo.add(prod_id)
+            else:
+                baixo.discard(prod_id)
+        return _estoque['quantidades']
+
+def versao_estoque():
+    """Número que muda sempre que alguma quantidade do estoque muda (neste processo)."""
+    with _cache_lock:
+        estoque_atual()
+        return _estoque['versao']
+
+def total_estoque_baixo():
+    """Quantos produtos estão abaixo do estoque mínimo."""
+    with _cache_lock:
+        estoque_atual()
+        return len(_estoque['baixo'])
+
+def ler_estoque_minimo(texto):
+    """Valor do formulário para a coluna estoque_minimo: '' (padrão) ou um inteiro >= 0."""
+    try:
+        return str(max(0, int(texto))) if str(texto).strip() else ''
+    except ValueError:
+        return ''
+
+def estoque_baixo():
+    """Produtos abaixo do estoque mínimo: [{id, nome, quantidade, estoque_minimo}], por nome.
+
+    Lê só o conjunto mantido por estoque_atual(), sem percorrer o catálogo.
+    """
+    with _cache_lock:
+        estoque = estoque_atual()
+        entrada = _carregar_tabela('produtos')
+        if entrada is None:
+            return []
+        linhas = entrada['linhas']
+        posicoes = _posicoes_por_id(entrada)
+        p_nome = entrada['campos'].index('nome')
+        indice = indice_catalogo()
+        produtos = []
+        for prod_id in sorted(_estoque['baixo'], key=lambda i: (indice.normalizado(i), _inteiro(i))):
+            if prod_id in posicoes:
+                produtos.append({'id': prod_id, 'nome': linhas[posicoes[prod_id]][p_nome],
+                                 'quantidade': estoque[prod_id], 'estoque_minimo': _estoque['minimos'][prod_id]})
+        return produtos
+
+def ler_produtos():
+    """Catálogo com a quantidade atual calculada pelo ledger.
+
+    Só para exibir: para regravar produtos.csv use ler_csv('produtos'), que
+    mantém a quantidade base do catálogo.
+    """
+    estoque = estoque_atual()
+    produtos = ler_csv('produtos')
+    for p in produtos:
+        p['quantidade'] = estoque.get(p['id'], _inteiro(p['quantidade']))
+    return produtos
+
+def _posicoes_por_id(entrada):
+    """id do produto -> posição da linha na entrada do cache do catálogo."""
+    linhas = entrada['linhas']
+    posicoes = entrada.get('por_id')
+    if posicoes is None or posicoes[0] != len(linhas):
+        p_id = entrada['campos'].index('id')
+        posicoes = entrada['por_id'] = (len(linhas), {linha[p_id]: i for i, linha in enumerate(linhas)})
+    return posicoes[1]
+
+def buscar_produto(prod_id):
+    """Produto (dict, com a quantidade atual) pelo id, sem montar o catálogo inteiro."""
+    with _cache_lock:
+        entrada = _carregar_tabela('produtos')
+        if entrada is None:
+            return None
+        linhas = entrada['linhas']
+        i = _posicoes_por_id(entrada).get(prod_id)
+        if i is None:
+            return None
+        produto = dict(zip(entrada['campos'], linhas[i]))
+        produto['quantidade'] = estoque_atual().get(prod_id, _inteiro(produto['quantidade']))
+        return produto
+
+def _margem(custo, preco_venda):
+    """Margem sobre o preço de venda (0.25 = 25%), ou None sem preço."""
+    custo, preco_venda = _centavos(custo), _centavos(preco_venda)
+    return (preco_venda - custo) / preco_venda if preco_venda else None
+
+def _ordem_catalogo(entrada, campo):
+    """Posições das linhas do catálogo ordenadas por 'campo' (id, nome, fornecedor, margem ou quantidade).
+
+    Cada ordem é montada uma vez por versão da tabela e guardada na entrada
+    do cache; a da quantidade também depende da versão do estoque, que muda
+    a cada venda, e é remontada só quando ela muda.
+    """
+    if entrada.get('ordens', (None,))[0] != entrada['versao']:
+        entrada['ordens'] = (entrada['versao'], {})
+    ordens = entrada['ordens'][1]
+    if campo == 'quantidade':
+        versao = versao_estoque()
+        if ordens.get('quantidade', (None,))[0] != versao:
+            linhas = entrada['linhas']
+            campos = entrada['campos']
+            p_id, p_qtd = campos.index('id'), campos.index('quantidade')
+            estoque = estoque_atual()
+            ordens['quantidade'] = (versao, sorted(range(len(linhas)), key=lambda i: (
+                estoque.get(linhas[i][p_id], _inteiro(linhas[i][p_qtd])), _inteiro(linhas[i][p_id]))))
+        return ordens['quantidade'][1]
+    if campo not in ordens:
+        linhas = entrada['linhas']
+        campos = entrada['campos']
+        p_id = campos.index('id')
+        if campo == 'id':
+            chave = lambda i: _inteiro(linhas[i][p_id])
+        elif campo == 'margem':
+            p_custo, p_preco = campos.index('custo'), campos.index('preco_venda')
+            def chave(i):
+                margem = _margem(linhas[i][p_custo], linhas[i][p_preco])
+                return (margem is None, margem or 0, _inteiro(linhas[i][p_id]))
+        elif campo == 'nome':
+            # O índice do catálogo já tem os nomes normalizados
+            indice = indice_catalogo()
+            chave = lambda i: (indice.normalizado(linhas[i][p_id]), _inteiro(linhas[i][p_id]))
+        else:
+            p = campos.index(campo)
+            normalizados = {}
+            def chave(i):
+                valor = linhas[i][p]
+                if valor not in normalizados:
+                    normalizados[valor] = normalizar_nome(valor)
+                return (normalizados[valor], _inteiro(linhas[i][p_id]))
+        ordens[campo] = sorted(range(len(linhas)), key=chave)
+    return ordens[campo]
+
+def pagina_catalogo(busca='', ordem='id', decrescente=False, pagina=1, por_pagina=50):
+    """Só a fatia visível do catálogo, já filtrada e ordenada.
+
+    Devolve (produtos da página com quantidade atual e margem, total filtrado).
+    """
+    with _cache_lock:
+        entrada = _carregar_tabela('produtos')
+        if entrada is None:
+            return [], 0
+        linhas = entrada['linhas']
+        campos = entrada['campos']
+        p_id = campos.index('id')
+        estoque = estoque_atual()
+        posicoes = _ordem_catalogo(entrada, ordem)
+        if busca:
+            ids = indice_catalogo().contendo(busca)
+            posicoes = [i for i in posicoes if linhas[i][p_id] in ids]
+        total = len(posicoes)
+        if decrescente:
+            posicoes = posicoes[::-1]
+        inicio = (pagina - 1) * por_pagina
+        produtos = []
+        for i in posicoes[inicio:inicio + por_pagina]:
+            produto = dict(zip(campos, linhas[i]))
+            produto['quantidade'] = estoque.get(produto['id'], _inteiro(produto['quantidade']))
+            produto['margem'] = _margem(produto['custo'], produto['preco_venda'])
+            produto['minimo'] = estoque_minimo(produto['estoque_minimo'])
+            produtos.append(produto)
+        return produtos, total
+
+def movimentar_estoque(movimentos, operacoes=()):
+    """Anexa movimentos [(produto_id, delta, tipo, referencia)] num só commit.
+
+    'operacoes' entra no mesmo commit (a venda junto da baixa de estoque,
+    por exemplo). Compacta o ledger se ele passou do limite.
+    """
+    with trava_dados():
+        agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ids = reservar_ids('movimentos', len(movimentos))
+        linhas = [{'id': mov_id, 'data': agora, 'produto_id': produto_id, 'delta': delta,
+                   'tipo': tipo, 'referencia': referencia}
+                  for mov_id, (produto_id, delta, tipo, referencia) in zip(ids, movimentos)]
+        gravar_em_lote([('movimentos', 'a', linha) for linha in linhas] + list(operacoes))
+        with _cache_lock:
+            entrada = _carregar_tabela('movimentos')
+            tamanho = len(entrada['linhas']) if entrada else 0
+        if tamanho > LIMITE_MOVIMENTOS:
+            compactar_estoque()
+
+def compactar_estoque():
+    """Grava o estoque atual num snapshot novo e esvazia o ledger.
+
+    A ordem garante que uma queda no meio não muda o estoque: com o snapshot
+    já gravado, movimentos antigos são ignorados pelo id, e produtos.csv
+    passa a guardar a quantidade atual só como espelho legível.
+    """
+    with trava_dados():
+        quantidades = dict(estoque_atual())
+        ids = ler_colunas('movimentos').colunas['id']
+        ultimo = max(max(ids) if ids else 0, _ler_snapshot_estoque()['ultimo_movimento'])
+        _gravar_atomico(ESTOQUE_SNAPSHOT_FILE, lambda f: json.dump(
+            {'ultimo_movimento': ultimo, 'quantidades': quantidades}, f))
+        produtos = ler_csv('produtos')
+        for p in produtos:
+            p['quantidade'] = quantidades.get(p['id'], p['quantidade'])
+        gravar_em_lote([('produtos', 'w', produtos), ('movimentos', 'w', [])])
+    return len(ids)
+
+@app.cli.command('compactar-estoque')
+def compactar_estoque_cmd():
+    """Compacta movimentos_estoque.csv num snapshot do estoque."""
+    init_db()
+    compactados = compactar_estoque()
+    print(f"{compactados} movimentos compactados em {ESTOQUE_SNAPSHOT_FILE}.")
+
+# --- Resumos Diários (Rollups) ---
+# Totais por dia, por produto e por categoria, mantidos incrementalmente a
+# cada venda/despesa lançada. O dashboard lê daqui, então o custo depende do
+# número de dias no filtro e não do histórico inteiro de transações.
+# Valores guardados em centavos para não acumular erro de arredondamento.
+#
+# No disco há um arquivo por mês (dados_mercearia/resumos/2026-10.json) com os
+# dias do mês e a assinatura das partições de vendas e despesas daquele mês:
+# uma venda regrava só o arquivo do seu mês, e um mês cuja partição mudou por
+# fora é refeito sozinho. Antes do init_db as tabelas ainda não estão
+# particionadas e os resumos ficam só na memória.
+RESUMOS_DIR = os.path.join(DATA_DIR, 'resumos')
+_resumos = None
+
+def _resumos_vazios():
+    return {'fontes': {'vendas': None, 'despesas': None}, 'vendas': {}, 'despesas': {}}
+
+def _acumular_resumo(resumos, tipo, linha):
+    dia = linha['data'][:10]
+    if tipo == 'vendas':
+        total = _centavos(linha['total_venda'])
+        lucro = _centavos(linha['lucro_estimado'])
+        dia_resumo = resumos['vendas'].setdefault(dia, {'total': 0, 'lucro': 0, 'produtos': {}})
+        dia_resumo['total'] += total
+        dia_resumo['lucro'] += lucro
+        por_produto = dia_resumo['produtos'].setdefault(linha['nome_produto'], [0, 0])
+        por_produto[0] += total
+        por_produto[1] += lucro
+    elif tipo == 'despesas':
+        valor = _centavos(linha['valor'])
+        categoria = linha.get('categoria') or 'Outros'
+        dia_resumo = resumos['despesas'].setdefault(dia, {'total': 0, 'categorias': {}})
+        dia_resumo['total'] += valor
+        dia_resumo['categorias'][categoria] = dia_resumo['categorias'].get(categoria, 0) + valor
+
+def _arquivo_resumo_mes(mes):
+    return os.path.join(RESUMOS_DIR, f'{mes}.json')
+
+def _por_mes(resumos):
+    """Resumos guardados por mês? Só quando as duas tabelas estão particionadas."""
+    return all(isinstance(resumos['fontes'][tipo], dict) for tipo in ('vendas', 'despesas'))
+
+def _salvar_resumo_mes(resumos, mes):
+    """Regrava o arquivo do mês a partir dos resumos em memória."""
+    if not _por_mes(resumos):
+        return
+    dados = {'fontes': {tipo: resumos['fontes'][tipo].get(mes) for tipo in ('vendas', 'despesas')}}
+    for tipo in ('vendas', 'despesas'):
+        dados[tipo] = {dia: valor for dia, valor in resumos[tipo].items() if dia[:7] == mes}
+    caminho = _arquivo_resumo_mes(mes)
+    if not any(dados[tipo] or dados['fontes'][tipo] for tipo in ('vendas', 'despesas')):
+        if os.path.exists(caminho):
+            os.remove(caminho)  # o mês sumiu das duas tabelas
+        return
+    os.makedirs(RESUMOS_DIR, exist_ok=True)
+    texto = json.dumps(dados)
+    _gravar_atomico(caminho, lambda f: f.write(texto))
+
+def _ler_resumo_mes(mes):
+    try:
+        with open(_arquivo_resumo_mes(mes), mode='r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _carregar_resumos():
+    """Junta os arquivos mensais; None se ainda não há resumos por mês.
+
+    Um arquivo ilegível fica sem fontes e o mês é refeito por atualizar_resumos.
+    """
+    if not os.path.isdir(RESUMOS_DIR):
+        return None
+    resumos = _resumos_vazios()
+    resumos['fontes'] = {'vendas': {}, 'despesas': {}}
+    for nome in os.listdir(RESUMOS_DIR):
+        mes = nome[:-len('.json')]
+        if not nome.endswith('.json') or not _RE_MES.match(mes):
+            continue
+        dados = _ler_resumo_mes(mes)
+        if dados is None:
+            continue
+        for tipo in ('vendas', 'despesas'):
+            if dados['fontes'].get(tipo) is not None:
+                resumos['fontes'][tipo][mes] = dados['fontes'][tipo]
+            resumos[tipo].update(dados[tipo])
+    return resumos
+
+def _acumular_colunas(resumos, tipo, colunas):
+    """Soma uma tabela inteira nos resumos, a partir da versão colunar."""
+    dias_iso = colunas.dias_iso()
+    if tipo == 'vendas':
+        nomes = colunas.textos['nome_produto']
+        grupos = _agrupar_somas(colunas.coluna('data'), colunas.coluna('nome_produto'), len(nomes),
+                                colunas.coluna('total_venda'), colunas.coluna('lucro_estimado'))
+        for (dia, produto), (total, lucro) in grupos.items():
+            dia_resumo = resumos['vendas'].setdefault(dias_iso[dia], {'total': 0, 'lucro': 0, 'produtos': {}})
+            dia_resumo['total'] += total
+            dia_resumo['lucro'] += lucro
+            por_produto = dia_resumo['produtos'].setdefault(nomes[produto], [0, 0])
+            por_produto[0] += total
+            por_produto[1] += lucro
+    elif tipo == 'despesas':
+        categorias = colunas.textos['categoria']
+        grupos = _agrupar_somas(colunas.coluna('data'), colunas.coluna('categoria'), len(categorias),
+                                colunas.coluna('valor'))
+        for (dia, categoria), (valor,) in grupos.items():
+            nome_categoria = categorias[categoria] or 'Outros'
+            dia_resumo = resumos['despesas'].setdefault(dias_iso[dia], {'total': 0, 'categorias': {}})
+            dia_resumo['total'] += valor
+            dia_resumo['categorias'][nome_categoria] = dia_resumo['categorias'].get(nome_categoria, 0) + valor
+
+def _agrupar_somas(dias, ids, n_ids, *valores):
+    """Soma as colunas de valores agrupando por (dia, id)."""
+    grupos = {}
+    if not len(dias):
+        return grupos
+    if np is not None:
+        chaves = dias * max(n_ids, 1) + ids
+        unicas, inverso = np.unique(chaves, return_inverse=True)
+        somas = [np.bincount(inverso, weights=v).round().astype(np.int64).tolist() for v in valores]
+        for i, chave in enumerate(unicas.tolist()):
+            grupos[divmod(chave, max(n_ids, 1))] = [s[i] for s in somas]
+        return grupos
+    for linha in zip(dias, ids, *valores):
+        chave = (linha[0], linha[1])
+        soma = grupos.get(chave)
+        if soma is None:
+            grupos[chave] = list(linha[2:])
+        else:
+            for i, v in enumerate(linha[2:]):
+                soma[i] += v
+    return grupos
+
+def _fontes_resumo(tipo):
+    """De onde os resumos da tabela foram tirados: a assinatura de cada
+    partição mensal ({mês: assinatura}) ou, sem partições, a da tabela."""
+    particoes = armazenamento.assinaturas_particoes(tipo)
+    if particoes is not None:
+        return particoes
+    assinatura = assinatura_tabela(tipo)
+    return list(assinatura) if assinatura else None
+
+def reconstruir_resumos():
+    """Recria os resumos a partir dos CSVs brutos de vendas e despesas."""
+    global _resumos
+    resumos = _resumos_vazios()
+    for tipo in ('vendas', 'despesas'):
+        fontes = _fontes_resumo(tipo)
+        _acumular_colunas(resumos, tipo, ler_colunas(tipo))
+        resumos['fontes'][tipo] = fontes
+    if _por_mes(resumos):
+        meses = {dia[:7] for tipo in ('vendas', 'despesas') for dia in resumos[tipo]}
+        meses |= {mes for tipo in ('vendas', 'despesas') for mes in resumos['fontes'][tipo]}
+        if os.path.isdir(RESUMOS_DIR):
+            for nome in os.listdir(RESUMOS_DIR):
+                if nome[:-len('.json')] not in meses:
+                    os.remove(os.path.join(RESUMOS_DIR, nome))
+        for mes in meses:
+            _salvar_resumo_mes(resumos, mes)
+        # Formato antigo, com todos os meses num arquivo só
+        legado = os.path.join(DATA_DIR, 'resumos.json')
+        if os.path.exists(legado):
+            os.remove(legado)
+    _resumos = resumos
+    return resumos
+
+def atualizar_resumos(resumos):
+    """Refaz nos resumos só os meses cujas partições mudaram desde a última
+    vez, relendo o arquivo do mês se outro worker já o atualizou. Sem
+    partições, tudo é refeito."""
+    atuais = {tipo: _fontes_resumo(tipo) for tipo in ('vendas', 'despesas')}
+    if not _por_mes(resumos) or not all(isinstance(f, dict) for f in atuais.values()):
+        return reconstruir_resumos()
+    meses = {mes for tipo in ('vendas', 'despesas')
+             for mes in set(atuais[tipo]) | set(resumos['fontes'][tipo])
+             if atuais[tipo].get(mes) != resumos['fontes'][tipo].get(mes)}
+    for mes in sorted(meses):
+        dados = _ler_resumo_mes(mes)
+        refeito = False
+        for tipo in ('vendas', 'despesas'):
+            fonte = atuais[tipo].get(mes)
+            if resumos['fontes'][tipo].get(mes) == fonte:
+                continue
+            for dia in [dia for dia in resumos[tipo] if dia[:7] == mes]:
+                del resumos[tipo][dia]
+            if dados is not None and dados['fontes'].get(tipo) == fonte:
+                resumos[tipo].update(dados[tipo])
+            else:
+                for linha in armazenamento.iterar(tipo, mes + '-01', _ultimo_dia_do_mes(mes)):
+                    _acumular_resumo(resumos, tipo, linha)
+                refeito = True
+            if fonte is None:
+                resumos['fontes'][tipo].pop(mes, None)
+            else:
+                resumos['fontes'][tipo][mes] = fonte
+        if refeito:
+            _salvar_resumo_mes(resumos, mes)
+    return resumos
+
+def _resumos_em_dia(resumos):
+    return all(resumos['fontes'].get(tipo) == _fontes_resumo(tipo) for tipo in ('vendas', 'despesas'))
+
+def obter_resumos():
+    """Devolve os resumos, reconstruindo se os CSVs foram editados por fora."""
+    global _resumos
+    with _cache_lock:
+        if _resumos is None:
+            _resumos = _carregar_resumos()
+            if _resumos is None:
+                return reconstruir_resumos()
+        if not _resumos_em_dia(_resumos):
+            _resumos = atualizar_resumos(_resumos)
+        return _resumos
+
+def resumos_do_intervalo(data_inicio, data_fim):
+    """Resumos diários que cobrem ao menos o intervalo pedido."""
+    if armazenamento.agrega_em_sql:
+        return armazenamento.resumos(data_inicio, data_fim)
+    return obter_resumos()
+
+def categorias_despesas():
+    if armazenamento.agrega_em_sql:
+        return armazenamento.categorias_despesas()
+    return sorted(set(c for d in obter_resumos()['despesas'].values() for c in d['categorias']))
+
+def dias_do_intervalo(data_inicio, data_fim):
+    """Gera as datas 'YYYY-MM-DD' de data_inicio até data_fim (inclusive)."""
+    dia = datetime.strptime(data_inicio, '%Y-%m-%d').date()
+    fim = datetime.strptime(data_fim, '%Y-%m-%d').date()
+    while dia <= fim:
+        yield dia.isoformat()
+        dia += timedelta(days=1)
+
+def dias_do_mes(mes_str):
+    """Gera as datas 'YYYY-MM-DD' do mês 'YYYY-MM'."""
+    inicio = datetime.strptime(mes_str + '-01', '%Y-%m-%d')
+    fim = (inicio + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return dias_do_intervalo(inicio.strftime('%Y-%m-%d'), fim.strftime('%Y-%m-%d'))
+
+@app.cli.command('reconstruir-resumos')
+def reconstruir_resumos_cmd():
+    """Recria os resumos mensais de dados_mercearia/resumos/ a partir dos CSVs."""
+    init_db()
+    resumos = reconstruir_resumos()
+    print(f"Resumos recriados: {len(resumos['vendas'])} dias de vendas, "
+          f"{len(resumos['despesas'])} dias de despesas.")
+
+# --- Fechamento de Mês ---
+# Um mês que já passou não muda mais. Fechado, suas vendas e despesas ficam
+# compactadas em .csv.gz e o dashboard usa o resumo gravado junto (totais do
+# mês, por produto, por categoria e por dia) em vez de somar dia a dia.
 
-# Cabeçalhos dos CSVs
-HEADERS = {
-    'produtos': ['id', 'nome', 'custo', 'preco_venda', 'quantidade', 'fornecedor'],
-    'vendas': ['id', 'data', 'produto_id', 'nome_produto', 'quantidade', 'total_venda', 'lucro_estimado'],
-    'despesas': ['id', 'data', 'descricao', 'valor', 'categoria']
-}
+def resumo_mensal(tipo, mes, linhas):
+    """Totais do mês, por produto (vendas) ou categoria (despesas) e por dia, em centavos."""
+    resumos = _resumos_vazios()
+    # Maiores ids do mês: as sequências partem deles sem abrir o .gz
+    maiores = dict.fromkeys(['id', 'ticket_id'] if tipo == 'vendas' else ['id'], 0)
+    for linha in linhas:
+        _acumular_resumo(resumos, tipo, linha)
+        for coluna in maiores:
+            maiores[coluna] = max(maiores[coluna], _inteiro(linha.get(coluna)))
+    dias = dict(sorted(resumos[tipo].items()))
+    if tipo == 'vendas':
+        produtos = {}
+        for dia_resumo in dias.values():
+            for nome, (total, lucro) in dia_resumo['produtos'].items():
+                por_produto = produtos.setdefault(nome, [0, 0])
+                por_produto[0] += total
+                por_produto[1] += lucro
+        return {'mes': mes, 'total': sum(d['total'] for d in dias.values()),
+                'lucro': sum(d['lucro'] for d in dias.values()), 'produtos': produtos, 'dias': dias,
+                'maiores': maiores}
+    categorias = {}
+    for dia_resumo in dias.values():
+        for categoria, valor in dia_resumo['categorias'].items():
+            categorias[categoria] = categorias.get(categoria, 0) + valor
+    return {'mes': mes, 'total': sum(d['total'] for d in dias.values()),
+            'categorias': categorias, 'dias': dias, 'maiores': maiores}
 
-# --- Funções Auxiliares de Banco de Dados (CSV) ---
+def fechar_mes(mes):
+    """Fecha um mês já encerrado ('YYYY-MM'). Devolve os resumos gravados."""
+    if not _RE_MES.match(mes) or mes >= date.today().strftime('%Y-%m'):
+        raise ValueError(f'{mes} não é um mês encerrado (use YYYY-MM, antes do mês atual)')
+    with trava_dados():
+        diarios = obter_resumos()
+        resumos = {tipo: resumo_mensal(tipo, mes, armazenamento.iterar(tipo, mes + '-01', _ultimo_dia_do_mes(mes)))
+                   for tipo in TABELAS_PARTICIONADAS}
+        armazenamento.fechar_mes(mes, resumos)
+        # As linhas são as mesmas: os resumos do mês continuam valendo
+        with _cache_lock:
+            for tipo in TABELAS_PARTICIONADAS:
+                fontes = _fontes_resumo(tipo)
+                if isinstance(fontes, dict) and isinstance(diarios['fontes'][tipo], dict) and mes in fontes:
+                    diarios['fontes'][tipo][mes] = fontes[mes]
+            _salvar_resumo_mes(diarios, mes)
+    return resumos
 
-def init_db():
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
-    
-    for key, filepath in FILES.items():
-        if not os.path.exists(filepath):
-            with open(filepath, mode='w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(HEADERS[key])
+@app.cli.command('fechar-mes')
+@click.argument('mes', required=False)
+def fechar_mes_cmd(mes):
+    """Fecha o mês MES (YYYY-MM) ou, sem ele, todos os meses anteriores ao atual."""
+    init_db()
+    if armazenamento.agrega_em_sql:
+        raise click.ClickException('O fechamento de mês vale para os CSVs; no SQLite o banco já filtra por data.')
+    if mes:
+        meses = [mes]
+    else:
+        atual = date.today().strftime('%Y-%m')
+        meses = sorted({m for tipo in TABELAS_PARTICIONADAS for m in armazenamento.meses(tipo)
+                        if m < atual and m not in armazenamento.fechados(tipo)})
+    for mes in meses:
+        try:
+            resumos = fechar_mes(mes)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        print(f"{mes}: vendas {resumos['vendas']['total'] / 100:.2f}, "
+              f"despesas {resumos['despesas']['total'] / 100:.2f}.")
+    print(f'{len(meses)} mês(es) fechado(s).')
 
-def ler_csv(tipo):
-    itens = []
-    if os.path.exists(FILES[tipo]):
-        with open(FILES[tipo], mode='r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                itens.append(row)
-    return itens
+# --- Motor de Agregação do Dashboard ---
 
-def escrever_csv(tipo, dados, mode='w'):
-    """Se mode='a', adiciona uma linha. Se mode='w', reescreve tudo."""
-    filepath = FILES[tipo]
-    file_exists = os.path.exists(filepath)
-    
-    if mode == 'a':
-        with open(filepath, mode='a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=HEADERS[tipo])
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(dados)
-    elif mode == 'w':
-        with open(filepath, mode='w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=HEADERS[tipo])
-            writer.writeheader()
-            writer.writerows(dados)
+class AgregadorPainel:
+    """Preenche, numa única passada, todos os números do dashboard.
 
-def gerar_id(tipo):
-    dados = ler_csv(tipo)
-    if not dados:
-        return 1
-    ids = [int(d['id']) for d in dados]
-    return max(ids) + 1
+    Recebe vendas (dia, produto, total, lucro) e despesas (dia, categoria,
+    valor) em centavos, venham elas das linhas brutas ou dos resumos diários.
+    Cards, evolução, comparativo mensal e totais por produto/categoria são
+    acumulados na mesma visita a cada registro.
+    """
 
-def extrair_itens_nfe(url):
-    """Extrai TODOS os itens da NFC-e em uma lista de dicionários.
+    def __init__(self, data_inicio, data_fim, produto='', categoria='', hoje=None):
+        hoje = hoje or date.today()
+        self.data_inicio = data_inicio
+        self.data_fim = data_fim
+        self.produto = produto
+        self.categoria = categoria
+        self.hoje = hoje.isoformat()
+        self.mes_atual = self.hoje[:7]
+
+        # Granularidade da evolução decidida uma vez, e não a cada linha
+        dias = (date.fromisoformat(data_fim) - date.fromisoformat(data_inicio)).days
+        self.granularidade = 'dia' if dias <= 31 else 'semana' if dias <= 90 else 'mes'
+        self._chaves_evolucao = {}
+
+        # Comparativo Mensal: últimos 12 meses até o mês atual
+        self.meses_comparativo = []
+        for i in range(11, -1, -1):
+            mes = (hoje.month - i - 1) % 12 + 1
+            ano = hoje.year - (1 if hoje.month - i - 1 < 0 else 0)
+            self.meses_comparativo.append(f"{ano}-{mes:02d}")
+        self._indice_mes = {m: i for i, m in enumerate(self.meses_comparativo)}
+
+        self.vendas_hoje = 0
+        self.lucro_mes = 0
+        self.despesas_mes = 0
+        self.vendas_por_produto = defaultdict(int)
+        self.lucro_por_produto = defaultdict(int)
+        self.despesas_por_categoria = defaultdict(int)
+        self.evolucao = defaultdict(int)
+        self.comparativo_vendas = [0] * 12
+        self.comparativo_despesas = [0] * 12
+
+    def _chave_evolucao(self, dia):
+        chave = self._chaves_evolucao.get(dia)
+        if chave is None:
+            if self.granularidade == 'dia':
+                chave = dia
+            elif self.granularidade == 'semana':
+                # semana (YYYY-WW)
+                data_obj = date.fromisoformat(dia)
+                chave = f"{data_obj.year}-{data_obj.isocalendar()[1]:02d}"
+            else:
+                chave = dia[:7]
+            self._chaves_evolucao[dia] = chave
+        return chave
+
+    def venda(self, dia, produto, total, lucro):
+        mes = dia[:7]
+        if dia == self.hoje:
+            self.vendas_hoje += total
+        if mes == self.mes_atual:
+            self.lucro_mes += lucro
+        i = self._indice_mes.get(mes)
+        if i is not None:
+            self.comparativo_vendas[i] += total
+        self._venda_filtrada(dia, produto, total, lucro)
+
+    def _venda_filtrada(self, dia, produto, total, lucro):
+        if self.data_inicio <= dia <= self.data_fim and (not self.produto or produto == self.produto):
+            self.vendas_por_produto[produto] += total
+            self.lucro_por_produto[produto] += lucro
+            self.evolucao[self._chave_evolucao(dia)] += total
+
+    def despesa(self, dia, categoria, valor):
+        mes = dia[:7]
+        if mes == self.mes_atual:
+            self.despesas_mes += valor
+        i = self._indice_mes.get(mes)
+        if i is not None:
+            self.comparativo_despesas[i] += valor
+        self._despesa_filtrada(dia, categoria, valor)
+
+    def _despesa_filtrada(self, dia, categoria, valor):
+        if self.data_inicio <= dia <= self.data_fim and (not self.categoria or categoria == self.categoria):
+            self.despesas_por_categoria[categoria] += valor
+
+    def alimentar_mes_fechado(self, tipo, resumo):
+        """Soma um mês fechado a partir do seu resumo mensal.
+
+        O comparativo usa só o total do mês. Os blocos filtrados usam os totais
+        por produto/categoria quando o mês inteiro está no filtro (e a evolução
+        é mensal); senão, os dias do resumo.
+        """
+        mes = resumo['mes']
+        i = self._indice_mes.get(mes)
+        if i is not None:
+            (self.comparativo_vendas if tipo == 'vendas' else self.comparativo_despesas)[i] += resumo['total']
+        primeiro, ultimo = mes + '-01', _ultimo_dia_do_mes(mes)
+        if ultimo < self.data_inicio or primeiro > self.data_fim:
+            return
+        inteiro = self.data_inicio <= primeiro and ultimo <= self.data_fim
+        if tipo == 'vendas':
+            if inteiro and self.granularidade == 'mes':
+                for nome, (total, lucro) in resumo['produtos'].items():
+                    self._venda_filtrada(primeiro, nome, total, lucro)
+            else:
+                for dia, dia_vendas in resumo['dias'].items():
+                    for nome, (total, lucro) in dia_vendas['produtos'].items():
+                        self._venda_filtrada(dia, nome, total, lucro)
+        elif inteiro:
+            for categoria, valor in resumo['categorias'].items():
+                self._despesa_filtrada(primeiro, categoria, valor)
+        else:
+            for dia, dia_despesas in resumo['dias'].items():
+                for categoria, valor in dia_despesas['categorias'].items():
+                    self._despesa_filtrada(dia, categoria, valor)
+
+    def alimentar_linhas(self, vendas, despesas):
+        """Uma passada sobre as linhas brutas de cada tabela."""
+        for v in vendas:
+            self.venda(v['data'][:10], v['nome_produto'],
+                       _centavos(v['total_venda']), _centavos(v['lucro_estimado']))
+        for d in despesas:
+            self.despesa(d['data'][:10], d.get('categoria') or 'Outros', _centavos(d['valor']))
+
+    def alimentar_colunas(self, vendas, despesas):
+        """Mesma passada de alimentar_linhas, sobre as tabelas colunares."""
+        dias_iso = vendas.dias_iso()
+        nomes = vendas.textos['nome_produto']
+        for dia, produto, total, lucro in zip(vendas.colunas['data'], vendas.colunas['nome_produto'],
+                                              vendas.colunas['total_venda'], vendas.colunas['lucro_estimado']):
+            self.venda(dias_iso[dia], nomes[produto], total, lucro)
+        dias_iso = despesas.dias_iso()
+        categorias = despesas.textos['categoria']
+        for dia, categoria, valor in zip(despesas.colunas['data'], despesas.colunas['categoria'],
+                                         despesas.colunas['valor']):
+            self.despesa(dias_iso[dia], categorias[categoria] or 'Outros', valor)
+
+    def intervalo_necessario(self):
+        """Primeiro e último dia que algum bloco do dashboard consulta."""
+        fim_mes_atual = list(dias_do_mes(self.mes_atual))[-1]
+        return (min(self.data_inicio, self.meses_comparativo[0] + '-01'),
+                max(self.data_fim, fim_mes_atual))
+
+    def alimentar_resumos(self, resumos, fechados=None):
+        """Uma passada sobre os dias de resumo que algum bloco do dashboard usa.
+
+        fechados: {tabela: meses} já somados por alimentar_mes_fechado.
+        """
+        fechados = fechados or {}
+        vendas_fechadas = fechados.get('vendas', ())
+        despesas_fechadas = fechados.get('despesas', ())
+        dias = set(dias_do_intervalo(self.data_inicio, self.data_fim))
+        for mes in self.meses_comparativo:
+            dias.update(dias_do_mes(mes))
+        resumo_vendas = resumos['vendas']
+        resumo_despesas = resumos['despesas']
+        for dia in sorted(dias):
+            dia_vendas = resumo_vendas.get(dia) if dia[:7] not in vendas_fechadas else None
+            if dia_vendas:
+                for nome, (total, lucro) in dia_vendas['produtos'].items():
+                    self.venda(dia, nome, total, lucro)
+            dia_despesas = resumo_despesas.get(dia) if dia[:7] not in despesas_fechadas else None
+            if dia_despesas:
+                for categoria, valor in dia_despesas['categorias'].items():
+                    self.despesa(dia, categoria, valor)
+
+    def resultado(self):
+        """Valores prontos para o template, em reais."""
+        produtos_labels = list(self.vendas_por_produto.keys())
+        despesas_cat_labels = list(self.despesas_por_categoria.keys())
+        evolucao_labels = sorted(self.evolucao.keys())
+        return {
+            'vendas_hoje': self.vendas_hoje / 100,
+            'lucro_mes': self.lucro_mes / 100,
+            'despesas_mes': self.despesas_mes / 100,
+            'vendas_filtrado': sum(self.vendas_por_produto.values()) / 100,
+            'lucro_filtrado': sum(self.lucro_por_produto.values()) / 100,
+            'despesas_filtrado': sum(self.despesas_por_categoria.values()) / 100,
+            'produtos_labels': produtos_labels,
+            'produtos_vendas_valores': [round(self.vendas_por_produto[n] / 100, 2) for n in produtos_labels],
+            'produtos_lucro_valores': [round(self.lucro_por_produto[n] / 100, 2) for n in produtos_labels],
+            'despesas_cat_labels': despesas_cat_labels,
+            'despesas_cat_valores': [round(self.despesas_por_categoria[c] / 100, 2) for c in despesas_cat_labels],
+            'evolucao_labels': evolucao_labels,
+            'evolucao_valores': [round(self.evolucao[k] / 100, 2) for k in evolucao_labels],
+            'comparativo_labels': [datetime.strptime(m, '%Y-%m').strftime('%b/%Y') for m in self.meses_comparativo],
+            'comparativo_vendas': [round(v / 100, 2) for v in self.comparativo_vendas],
+            'comparativo_despesas': [round(v / 100, 2) for v in self.comparativo_despesas],
+        }
+
+# --- Cache de Resultados do Dashboard ---
+# Os operadores reabrem o dashboard quase sempre com os mesmos filtros (mês
+# atual, mês passado, um produto). O resultado de calcular_painel fica guardado
+# por (data_inicio, data_fim, produto, categoria, versão dos dados). A versão
+# usa as assinaturas de vendas, despesas e produtos, que valem entre workers,
+# e o dia de hoje, do qual dependem os cards de "hoje" e "mês atual".
+LIMITE_CACHE_PAINEL = int(os.environ.get('FISCALFLOW_CACHE_PAINEL', '64'))
+
+def versao_dados_painel():
+    return (tuple(assinatura_tabela(tipo) for tipo in ('vendas', 'despesas', 'produtos')),
+            date.today().isoformat())
+
+class CachePainel:
+    """LRU em memória dos resultados do dashboard, com contadores de uso.
+
+    Quando a versão dos dados muda, as entradas antigas não servem para mais
+    nada e são descartadas de uma vez (conta como uma invalidação).
+    """
+
+    def __init__(self, limite=64):
+        self.limite = limite
+        self._entradas = OrderedDict()
+        self._versao = None
+        self._lock = threading.Lock()
+        self.acertos = self.falhas = self.descartes = self.invalidacoes = 0
+
+    def obter(self, filtros, calcular):
+        versao = versao_dados_painel()
+        chave = (filtros['data_inicio'], filtros['data_fim'], filtros['produto'],
+                 filtros['categoria'], versao)
+        with self._lock:
+            if versao != self._versao:
+                if self._entradas:
+                    self.invalidacoes += 1
+                self._entradas.clear()
+                self._versao = versao
+            resultado = self._entradas.get(chave)
+            if resultado is not None:
+                self._entradas.move_to_end(chave)
+                self.acertos += 1
+                return resultado
+            self.falhas += 1
+        # Calcula fora da trava: filtros diferentes não esperam uns pelos outros
+        resultado = calcular(filtros)
+        with self._lock:
+            if self._versao == versao and self.limite > 0:
+                self._entradas[chave] = resultado
+                self._entradas.move_to_end(chave)
+                while len(self._entradas) > self.limite:
+                    self._entradas.popitem(last=False)
+                    self.descartes += 1
+        return resultado
+
+    def estatisticas(self):
+        with self._lock:
+            consultas = self.acertos + self.falhas
+            return {'entradas': len(self._entradas), 'limite': self.limite,
+                    'acertos': self.acertos, 'falhas': self.falhas,
+                    'taxa_acerto': round(self.acertos / consultas, 3) if consultas else 0.0,
+                    'descartes': self.descartes, 'invalidacoes': self.invalidacoes}
+
+cache_painel = CachePainel(LIMITE_CACHE_PAINEL)
+
+# --- Cliente NFC-e ---
+# Busca as páginas da SEFAZ com uma Session compartilhada (keep-alive e pool
+# de conexões), novas tentativas com backoff exponencial e um prazo total por
+# nota. Falha ao baixar vira ErroBuscaNFe; página sem a tabela de itens vira
+# ErroLeituraNFe, para a tela dizer o que de fato deu errado.
+
+class ErroBuscaNFe(Exception):
+    """A página da NFC-e não pôde ser baixada (rede, prazo ou HTTP de erro)."""
+
+class ErroLeituraNFe(Exception):
+    """A página veio, mas não tem os itens no formato esperado."""
+
+# Chave de acesso: os 44 dígitos que identificam a nota, presentes na URL do QR Code
+_RE_CHAVE_NFE = re.compile(r'(?<!\d)\d{44}(?!\d)')
+CACHE_NFCE_DIR = os.path.join(DATA_DIR, 'cache_nfce')
+
+def chave_nfe(url):
+    """Chave de acesso (44 dígitos) contida na URL da NFC-e, ou ''."""
+    m = _RE_CHAVE_NFE.search(url or '')
+    return m.group(0) if m else ''
+
+class CacheNFe:
+    """Itens já lidos de cada NFC-e, num JSON por chave de acesso.
+
+    O mtime do arquivo marca o último uso: cada leitura o atualiza e, passando
+    de 'limite' notas, as usadas há mais tempo são apagadas (LRU).
+    """
+
+    def __init__(self, pasta, limite=500):
+        self.pasta = pasta
+        self.limite = limite
+
+    def _caminho(self, chave):
+        return os.path.join(self.pasta, f'{chave}.json')
+
+    def ler(self, chave):
+        caminho = self._caminho(chave)
+        try:
+            with open(caminho, mode='r', encoding='utf-8') as f:
+                itens = json.load(f)
+            os.utime(caminho)
+        except (OSError, ValueError):
+            return None
+        return itens
+
+    def gravar(self, chave, itens):
+        os.makedirs(self.pasta, exist_ok=True)
+        _gravar_atomico(self._caminho(chave), lambda f: json.dump(itens, f, ensure_ascii=False))
+        self._podar()
+
+    def _podar(self):
+        usos = []
+        for nome in os.listdir(self.pasta):
+            if not nome.endswith('.json'):
+                continue
+            caminho = os.path.join(self.pasta, nome)
+            assinatura = _assinatura_arquivo(caminho)
+            if assinatura is not None:
+                usos.append((assinatura[0], caminho))
+        if len(usos) <= self.limite:
+            return
+        usos.sort()
+        for _, caminho in usos[:len(usos) - self.limite]:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass  # outro worker já apagou
+
+# Uma nota é lançada em duas etapas: 'existentes' (entrada dos itens já
+# cadastrados) e, por último, 'novos' (cadastro dos que faltavam). Quando
+# não sobra item novo, a etapa final é gravada com 0 itens no mesmo commit
+# da entrada; sem ela, a nota ficou pela metade.
+ETAPA_FINAL_NFCE = 'novos'
+
+def etapas_aplicadas(chave):
+    """Etapas da NFC-e já lançadas ('existentes' e/ou 'novos') -> data do lançamento."""
+    if not chave:
+        return {}
+    return {r['etapa']: r['data'] for r in ler_csv('nfce_aplicadas') if r['chave'] == chave}
+
+def registro_nfce_aplicada(chave, etapa, n_itens):
+    """Operação de gravar_em_lote que marca a etapa da NFC-e como lançada."""
+    return ('nfce_aplicadas', 'a', {'id': gerar_id('nfce_aplicadas'), 'chave': chave,
+                                    'data': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                    'etapa': etapa, 'itens': n_itens})
+
+class ClienteNFe:
+    """Cliente HTTP das páginas de NFC-e, seguro para usar de várias threads.
+
+    Com um CacheNFe, notas cuja chave já foi lida não vão à rede.
+    """
+
+    STATUS_REPETIR = {429, 500, 502, 503, 504}
+
+    def __init__(self, tentativas=3, backoff=0.5, timeout=(3.05, 10), prazo=20, paralelas=4, cache=None):
+        self.cache = cache
+        self.tentativas = tentativas
+        self.backoff = backoff
+        self.timeout = timeout  # (conexão, leitura) por tentativa
+        self.prazo = prazo      # segundos no total, somando tentativas e esperas
+        self.paralelas = paralelas
+        self._sessao = None
+        self._lock = threading.Lock()
+
+    def sessao(self):
+        with self._lock:
+            if self._sessao is None:
+                sessao = requests.Session()
+                # As novas tentativas ficam com buscar(), que conhece o prazo total
+                adaptador = HTTPAdapter(pool_connections=self.paralelas,
+                                        pool_maxsize=self.paralelas, max_retries=0)
+                sessao.mount('http://', adaptador)
+                sessao.mount('https://', adaptador)
+                self._sessao = sessao
+            return self._sessao
+
+    def buscar(self, url):
+        """HTML da página da nota, ou ErroBuscaNFe."""
+        limite = time.monotonic() + self.prazo
+        erro = 'prazo esgotado'
+        for tentativa in range(self.tentativas):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            timeout = (min(self.timeout[0], restante), min(self.timeout[1], restante))
+            try:
+                resp = self.sessao().get(url, timeout=timeout)
+                if resp.status_code not in self.STATUS_REPETIR:
+                    resp.raise_for_status()
+                    return resp.text
+                erro = f'HTTP {resp.status_code}'
+            except (requests.HTTPError, requests.exceptions.InvalidURL,
+                    requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema) as e:
+                # Erro do cliente ou URL inválida: repetir não adianta
+                raise ErroBuscaNFe(str(e)) from e
+            except requests.RequestException as e:
+                erro = str(e) or type(e).__name__
+            if tentativa + 1 < self.tentativas:
+                time.sleep(max(0, min(self.backoff * 2 ** tentativa, limite - time.monotonic())))
+        raise ErroBuscaNFe(f'{url}: {erro}')
+
+    def extrair(self, url):
+        """Itens da nota; ErroBuscaNFe ou ErroLeituraNFe se não der."""
+        chave = chave_nfe(url) if self.cache is not None else ''
+        if chave:
+            itens = self.cache.ler(chave)
+            if itens is not None:
+                return itens
+        itens = ler_itens_nfe(self.buscar(url))
+        if chave and itens:
+            self.cache.gravar(chave, itens)
+        return itens
+
+    def extrair_varios(self, urls):
+        """Busca várias notas em paralelo, reaproveitando as conexões do pool.
+
+        Devolve [(url, itens, erro)] na ordem das urls; 'erro' é None ou a
+        exceção (ErroBuscaNFe / ErroLeituraNFe) daquela nota.
+        """
+        with ThreadPoolExecutor(max_workers=self.paralelas) as executor:
+            futuros = [executor.submit(self.extrair, url) for url in urls]
+            resultados = []
+            for url, futuro in zip(urls, futuros):
+                try:
+                    resultados.append((url, futuro.result(), None))
+                except (ErroBuscaNFe, ErroLeituraNFe) as e:
+                    resultados.append((url, [], e))
+        return resultados
+
+cliente_nfe = ClienteNFe(cache=CacheNFe(CACHE_NFCE_DIR))
+
+# --- Leitura da Página da NFC-e ---
+# A página da SEFAZ é grande, mas só a tabela tabResult (itens) e o div
+# txtTopo (nome da loja) interessam. Os dois trechos são recortados do HTML
+# com expressões já compiladas e as linhas da tabela são lidas direto do
+# texto, sem montar árvore. Se a marcação fugir do padrão (tabelas aninhadas,
+# comentários, spans dentro de spans...), a página inteira é lida com o
+# BeautifulSoup como antes; tests/test_leitura_nfe.py confere que as duas
+# dão o mesmo.
+# Dentro de uma tag, um '>' entre aspas (title="a>b") não a fecha: os
+# atributos são lidos como valores entre aspas ou caracteres fora delas.
+_DENTRO_DA_TAG = r"""(?:"[^"]*"|'[^']*'|[^'">])"""
+_RE_TABELA_ITENS = re.compile(r'<table\b' + _DENTRO_DA_TAG + r'*?\sid\s*=\s*["\']?tabResult(?=["\'\s/>])',
+                              re.IGNORECASE)
+_RE_TAG_TABELA = re.compile(r'<(/?)table\b', re.IGNORECASE)
+_RE_TOPO = re.compile(r'<div\b' + _DENTRO_DA_TAG + r'*?\sclass\s*=\s*["\'][^"\']*(?<![\w-])txtTopo(?![\w-])[^"\']*["\']'
+                      + _DENTRO_DA_TAG + r'*>(.*?)</div\s*>', re.IGNORECASE | re.DOTALL)
+_RE_INICIO_LINHA = re.compile(r'<tr\b', re.IGNORECASE)
+_RE_SPAN = re.compile(r'<span\b(' + _DENTRO_DA_TAG + r'*)>(.*?)</span\s*>', re.IGNORECASE | re.DOTALL)
+_RE_ATRIBUTO = re.compile(r"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?""")
+_RE_TAG = re.compile(r'</?[a-zA-Z]' + _DENTRO_DA_TAG + '*>')
+_RE_MARCACAO_ESPECIAL = re.compile(r'<!|<\?|<script|<style|<textarea|<select', re.IGNORECASE)
+_RE_QTD = re.compile(r"(\d+[\.,]?\d*)")
+_RE_VL_UNIT = re.compile(r"(\d+[\.\d]*,\d+)")
+_CLASSES_ITEM = ('txtTit', 'Rqtd', 'RvlUnit')
+
+def _classe_html(atributos):
+    """Valor do atributo class (o último, se repetido, como no BeautifulSoup), ou None."""
+    classe = None
+    for atributo in _RE_ATRIBUTO.finditer(atributos):
+        if atributo.group(1).lower() == 'class':
+            classe = next((v for v in atributo.groups()[1:] if v is not None), '')
+    return classe
+
+def _texto_html(fragmento):
+    """O mesmo que get_text(strip=True) do BeautifulSoup para um trecho simples."""
+    pedacos = (html_lib.unescape(t).strip() for t in _RE_TAG.split(fragmento))
+    return ''.join(p for p in pedacos if p)
+
+def _quantidade_nfe(texto):
+    m = _RE_QTD.search(texto)
+    if m:
+        try:
+            return int(float(m.group(1).replace(',', '.')))
+        except ValueError:
+            pass
+    return 0
+
+def _custo_nfe(texto):
+    # pega primeiro número com vírgula decimal (aceita 14,6 ou 14,60)
+    m = _RE_VL_UNIT.search(texto)
+    if m:
+        try:
+            return float(m.group(1).replace('.', '').replace(',', '.'))
+        except ValueError:
+            pass
+    return 0.0
+
+def _ler_itens_recortados(html):
+    """Itens lidos só dos trechos que interessam, ou None se o recorte não for seguro."""
+    m = _RE_TABELA_ITENS.search(html)
+    if m is None:
+        return None
+    tags = _RE_TAG_TABELA.finditer(html, m.start())
+    next(tags)
+    fim = None
+    for tag in tags:
+        if not tag.group(1):
+            return None  # tabela dentro da tabela de itens
+        fim = html.find('>', tag.end())
+        break
+    if fim is None or fim < 0:
+        return None
+    tabela = html[m.end():fim + 1]
+    if _RE_MARCACAO_ESPECIAL.search(tabela):
+        return None
+
+    fornecedor = ''
+    topo = _RE_TOPO.search(html)
+    if topo is None:
+        if 'txtTopo' in html:
+            return None
+    else:
+        conteudo = topo.group(1)
+        if topo.start() > m.start() or '<div' in conteudo.lower() or _RE_MARCACAO_ESPECIAL.search(conteudo):
+            return None
+        fornecedor = _texto_html(conteudo)
+
+    inicios = [t.start() for t in _RE_INICIO_LINHA.finditer(tabela)]
+    if len(inicios) != tabela.lower().count('</tr'):
+        return None  # linhas sem fechamento viram linhas aninhadas no BeautifulSoup
+    inicios.append(len(tabela))
+    itens = []
+    for inicio, proximo in zip(inicios, inicios[1:]):
+        linha = tabela[inicio:proximo]
+        encontrados = _RE_SPAN.findall(linha)
+        if len(encontrados) != linha.lower().count('<span'):
+            return None  # span dentro de span ou atributo fora do padrão
+        # Vale o primeiro span de cada classe, como no tr.find(...)
+        spans = {}
+        for atributos, conteudo in encontrados:
+            classe = _classe_html(atributos)
+            if classe is None:
+                continue
+            for nome in html_lib.unescape(classe).split():
+                if nome in _CLASSES_ITEM:
+                    spans.setdefault(nome, conteudo)
+        if 'txtTit' not in spans:
+            continue
+        nome = _texto_html(spans['txtTit'])
+        if not nome:
+            continue
+        itens.append({
+            'nome': nome,
+            'quantidade': _quantidade_nfe(_texto_html(spans['Rqtd'])) if 'Rqtd' in spans else 0,
+            'custo': _custo_nfe(_texto_html(spans['RvlUnit'])) if 'RvlUnit' in spans else 0.0,
+            'fornecedor': fornecedor
+        })
+    return itens
+
+def ler_itens_nfe(html, restrito=True):
+    """Extrai TODOS os itens da página de uma NFC-e em uma lista de dicionários.
 
     Cada item terá: nome, quantidade, custo (valor unitário) e fornecedor.
+    Com restrito=False a página inteira vira árvore, o caminho antigo, que
+    serve de referência para os testes e para bench/nfe.py.
     """
-    try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-    except Exception:
-        return []
+    if 'tabResult' not in html:
+        raise ErroLeituraNFe('tabela de itens (tabResult) não encontrada')
+    if restrito:
+        itens = _ler_itens_recortados(html)
+        if itens is not None:
+            return itens
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
+    soup = BeautifulSoup(html, 'html.parser')
     # Tabela de itens: table com id="tabResult"
     tabela = soup.find('table', id='tabResult')
-    print(tabela) 
     if not tabela:
-        return []
+        raise ErroLeituraNFe('tabela de itens (tabResult) não encontrada')
 
     # Fornecedor: nome da loja no topo (div.txtTopo)
     topo = soup.find('div', class_='txtTopo')
     fornecedor_padrao = topo.get_text(strip=True) if topo else ''
 
     itens = []
-    import re
-
     for tr in tabela.find_all('tr'):
         # Nome do produto
         span_nome = tr.find('span', class_='txtTit')
@@ -109,28 +2789,11 @@ def extrair_itens_nfe(url):
 
         # Quantidade (ex: "Qtde.:1")
         span_qtd = tr.find('span', class_='Rqtd')
-        quantidade = 0
-        if span_qtd:
-            txt_qtd = span_qtd.get_text(strip=True)
-            m = re.search(r"(\d+[\.,]?\d*)", txt_qtd)
-            if m:
-                try:
-                    quantidade = int(float(m.group(1).replace(',', '.')))
-                except Exception:
-                    quantidade = 0
+        quantidade = _quantidade_nfe(span_qtd.get_text(strip=True)) if span_qtd else 0
 
         # Valor unitário (ex: "Vl. Unit.: 27,95" ou "14,6")
         span_vl_unit = tr.find('span', class_='RvlUnit')
-        custo = 0.0
-        if span_vl_unit:
-            txt_vl = span_vl_unit.get_text(strip=True)
-            # pega primeiro número com vírgula decimal (aceita 14,6 ou 14,60)
-            m = re.search(r"(\d+[\.\d]*,\d+)", txt_vl)
-            if m:
-                try:
-                    custo = float(m.group(1).replace('.', '').replace(',', '.'))
-                except Exception:
-                    custo = 0.0
+        custo = _custo_nfe(span_vl_unit.get_text(strip=True)) if span_vl_unit else 0.0
 
         itens.append({
             'nome': nome,
@@ -141,20 +2804,308 @@ def extrair_itens_nfe(url):
 
     return itens
 
+def extrair_itens_nfe(url):
+    """Itens da NFC-e da URL; ErroBuscaNFe ou ErroLeituraNFe se não der."""
+    return cliente_nfe.extrair(url)
+
 
 def extrair_dados_nfe(url):
     """Compat: mantém a assinatura antiga, retornando apenas o primeiro item.
 
     Essa função ainda é usada no fluxo atual de 1 item. Em breve, vamos
     migrar o código para trabalhar diretamente com a lista retornada por
-    extrair_itens_nfe.
+    extrair_itens_nfe. None se a nota não tem itens; erros de busca e de
+    leitura sobem como em extrair_itens_nfe.
     """
     itens = extrair_itens_nfe(url)
-    print(itens)
     if not itens:
         return None
     return itens[0]
 
+# --- Sessões de Importação de NFC-e ---
+# A nota lida fica guardada no servidor, em dados_mercearia/sessoes_nfce/, sob
+# um token curto. As telas de confirmação mandam só o token e as escolhas do
+# operador, em vez de levar a nota inteira em JSON nos formulários.
+SESSOES_NFCE_DIR = os.path.join(DATA_DIR, 'sessoes_nfce')
+VALIDADE_SESSAO_NFCE = timedelta(hours=2)
+_RE_TOKEN_SESSAO = re.compile(r'[A-Za-z0-9_-]{22}')
+
+def _caminho_sessao_nfce(token):
+    return os.path.join(SESSOES_NFCE_DIR, f'{token}.json')
+
+def criar_sessao_nfce(url, chave, itens_existentes, itens_novos):
+    """Guarda a nota lida e devolve o token da sessão."""
+    os.makedirs(SESSOES_NFCE_DIR, exist_ok=True)
+    agora = datetime.now()
+    for nome in os.listdir(SESSOES_NFCE_DIR):
+        if nome.endswith('.json') and carregar_sessao_nfce(nome[:-5], agora) is None:
+            encerrar_sessao_nfce(nome[:-5])
+    sessao = {'token': secrets.token_urlsafe(16), 'url': url, 'chave': chave,
+              'expira': (agora + VALIDADE_SESSAO_NFCE).isoformat(timespec='seconds'),
+              'itens_existentes': itens_existentes, 'itens_novos': itens_novos}
+    _gravar_atomico(_caminho_sessao_nfce(sessao['token']),
+                    lambda f: json.dump(sessao, f, ensure_ascii=False))
+    return sessao['token']
+
+def carregar_sessao_nfce(token, agora=None):
+    """Sessão do token, ou None se ele não existe ou já expirou."""
+    if not _RE_TOKEN_SESSAO.fullmatch(token or ''):
+        return None
+    try:
+        with open(_caminho_sessao_nfce(token), mode='r', encoding='utf-8') as f:
+            sessao = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if sessao.get('expira', '') < (agora or datetime.now()).isoformat(timespec='seconds'):
+        return None
+    return sessao
+
+def encerrar_sessao_nfce(token):
+    if _RE_TOKEN_SESSAO.fullmatch(token or ''):
+        try:
+            os.remove(_caminho_sessao_nfce(token))
+        except FileNotFoundError:
+            pass
+
+# --- Importação em Lote de NFC-e ---
+# Cada importação é um job: as notas são buscadas por um pool de threads em
+# segundo plano e o andamento fica num JSON em dados_mercearia/importacoes/,
+# que qualquer worker lê para o endpoint de status. Na tela de revisão, as
+# entradas confirmadas de todas as notas são aplicadas num único commit.
+#
+# O pool só existe no processo que criou o job. Enquanto vive, esse processo
+# mantém travado importacoes/.processo-<id>; se a trava está livre, ele
+# morreu (reinício do servidor ou do worker) e as notas que estavam na fila
+# nunca vão terminar: o job passa a 'falhou' e pode ser retomado pela tela.
+IMPORTACOES_DIR = os.path.join(DATA_DIR, 'importacoes')
+# Linhas só com o conteúdo do QR Code (chave|versão|...) são consultadas neste endereço
+URL_QRCODE_PADRAO = os.environ.get('FISCALFLOW_URL_QRCODE', 'https://www.nfce.fazenda.sp.gov.br/qrcode?p=')
+VALIDADE_IMPORTACOES = timedelta(days=7)
+MAX_NOTAS_IMPORTACAO = 500
+_RE_ID_IMPORTACAO = re.compile(r'[0-9a-f]{12}')
+_importacoes_lock = threading.Lock()
+_executor_importacoes = ThreadPoolExecutor(max_workers=cliente_nfe.paralelas, thread_name_prefix='importacao-nfe')
+_processo_importacoes = {'pid': None, 'id': None, 'arquivo': None}
+
+def urls_de_texto(texto):
+    """URLs de NFC-e de um texto colado ou arquivo, separadas por linha ou espaço."""
+    urls = []
+    for pedaco in texto.split():
+        if pedaco.lower().startswith(('http://', 'https://')):
+            urls.append(pedaco)
+        elif chave_nfe(pedaco) and pedaco.startswith(chave_nfe(pedaco)):
+            urls.append(URL_QRCODE_PADRAO + pedaco)
+    return urls
+
+def _caminho_importacao(job_id):
+    return os.path.join(IMPORTACOES_DIR, f'{job_id}.json')
+
+def carregar_importacao(job_id):
+    if not _RE_ID_IMPORTACAO.fullmatch(job_id or ''):
+        return None
+    try:
+        with open(_caminho_importacao(job_id), mode='r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _salvar_importacao(job):
+    job['atualizado'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    _gravar_atomico(_caminho_importacao(job['id']), lambda f: json.dump(job, f, ensure_ascii=False))
+
+def listar_importacoes(limite=10):
+    """Importações mais recentes, sem os itens."""
+    if not os.path.isdir(IMPORTACOES_DIR):
+        return []
+    jobs = []
+    for nome in os.listdir(IMPORTACOES_DIR):
+        if nome.endswith('.json'):
+            job = carregar_importacao(nome[:-5])
+            if job is not None:
+                jobs.append({'id': job['id'], 'criado': job['criado'], 'estado': job['estado'],
+                             'notas': len(job['notas'])})
+    return sorted(jobs, key=lambda j: j['criado'], reverse=True)[:limite]
+
+def _limpar_importacoes_antigas():
+    limite = time.time() - VALIDADE_IMPORTACOES.total_seconds()
+    for nome in os.listdir(IMPORTACOES_DIR):
+        if nome.startswith('.processo-'):
+            continue  # a trava de um processo vivo pode ter mais de 7 dias
+        caminho = os.path.join(IMPORTACOES_DIR, nome)
+        assinatura = _assinatura_arquivo(caminho)
+        if assinatura is not None and assinatura[0] / 1e9 < limite:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+def _caminho_processo(processo):
+    return os.path.join(IMPORTACOES_DIR, f'.processo-{processo}')
+
+def _processo_atual():
+    """Id deste processo nos jobs; na primeira chamada, toma a trava que mostra que ele vive."""
+    with _importacoes_lock:
+        if _processo_importacoes['pid'] != os.getpid():
+            processo = uuid.uuid4().hex[:12]
+            os.makedirs(IMPORTACOES_DIR, exist_ok=True)
+            f = open(_caminho_processo(processo), 'a+b')
+            _travar_arquivo(f)
+            _processo_importacoes.update(pid=os.getpid(), id=processo, arquivo=f)
+        return _processo_importacoes['id']
+
+def _processo_vivo(processo):
+    if not processo:
+        return False
+    if processo == _processo_importacoes['id'] and _processo_importacoes['pid'] == os.getpid():
+        return True
+    try:
+        f = open(_caminho_processo(processo), 'r+b')
+    except FileNotFoundError:
+        return False
+    with f:
+        if not _tentar_travar_arquivo(f):
+            return True
+        _destravar_arquivo(f)
+    return False
+
+def recuperar_importacoes():
+    """Marca como 'falhou' os jobs em 'processando' cujo processo não existe mais.
+
+    As notas que ainda estavam na fila ficam 'interrompida'; as já lidas são
+    mantidas.
+    """
+    if not os.path.isdir(IMPORTACOES_DIR):
+        return
+    mortos = set()
+    with trava_dados():
+        for nome in os.listdir(IMPORTACOES_DIR):
+            if not nome.endswith('.json'):
+                continue
+            job = carregar_importacao(nome[:-5])
+            if job is None or job['estado'] != 'processando' or _processo_vivo(job.get('processo')):
+                continue
+            mortos.add(job.get('processo'))
+            with _importacoes_lock:
+                for nota in job['notas']:
+                    if nota['estado'] == 'pendente':
+                        nota.update(estado='interrompida', erro='o servidor reiniciou antes de ler esta nota')
+                job['estado'] = 'falhou'
+                _salvar_importacao(job)
+        for processo in mortos - {None}:
+            try:
+                os.remove(_caminho_processo(processo))
+            except OSError:
+                pass
+
+def retomar_importacao(job_id):
+    """Põe de novo na fila as notas interrompidas ou que falharam ao baixar.
+
+    Só vale para jobs em 'falhou'; devolve False para os demais.
+    """
+    processo = _processo_atual()
+    with trava_dados():
+        job = carregar_importacao(job_id)
+        if job is None or job['estado'] != 'falhou':
+            return False
+        pendentes = []
+        with _importacoes_lock:
+            for posicao, nota in enumerate(job['notas']):
+                if nota['estado'] in ('pendente', 'interrompida', 'erro_busca'):
+                    if nota['estado'] == 'erro_busca':
+                        job['processadas'] -= 1
+                    nota.update(estado='pendente', erro='', itens=[])
+                    pendentes.append(posicao)
+            job.update(estado='processando' if pendentes else 'concluido', processo=processo)
+            _salvar_importacao(job)
+    for posicao in pendentes:
+        _executor_importacoes.submit(_processar_nota, job, posicao)
+    return True
+
+def _chaves_aplicadas():
+    """Chaves das NFC-e concluídas (com a etapa final gravada).
+
+    Notas que ficaram pela metade ou cuja entrada não lançou nenhum item
+    podem entrar de novo numa importação.
+    """
+    return {r['chave'] for r in ler_csv('nfce_aplicadas') if r['etapa'] == ETAPA_FINAL_NFCE}
+
+def _chaves_com_entrada():
+    """Chaves cuja etapa 'existentes' já lançou algum item no estoque."""
+    return {r['chave'] for r in ler_csv('nfce_aplicadas')
+            if r['etapa'] == 'existentes' and _inteiro(r['itens']) > 0}
+
+def _processar_nota(job, posicao):
+    """Busca, lê e concilia uma nota do job (roda no pool de threads)."""
+    nota = job['notas'][posicao]
+    resultado = {'estado': 'ok', 'erro': '', 'itens': []}
+    try:
+        itens = cliente_nfe.extrair(nota['url'])
+        with _cache_lock:
+            indice = indice_catalogo()
+            for item in itens:
+                ids = indice.buscar(item['nome'])
+                item['produto_id'] = ids[0] if ids else ''
+        resultado['itens'] = itens
+        if not itens:
+            resultado.update(estado='erro_leitura', erro='a nota não tem itens')
+    except ErroBuscaNFe as e:
+        resultado.update(estado='erro_busca', erro=str(e))
+    except ErroLeituraNFe as e:
+        resultado.update(estado='erro_leitura', erro=str(e))
+    except Exception as e:
+        # Um erro inesperado numa nota não pode deixar o job parado
+        app.logger.exception('Erro ao importar NFC-e %s', nota['url'])
+        resultado.update(estado='erro_leitura', erro=str(e))
+    with _importacoes_lock:
+        nota.update(resultado)
+        job['processadas'] += 1
+        if job['processadas'] >= job['a_processar']:
+            job['estado'] = 'concluido'
+        _salvar_importacao(job)
+
+def criar_importacao(urls):
+    """Registra o job, agenda a busca das notas em segundo plano e devolve o id."""
+    os.makedirs(IMPORTACOES_DIR, exist_ok=True)
+    _limpar_importacoes_antigas()
+    aplicadas = _chaves_aplicadas()
+    job = {'id': uuid.uuid4().hex[:12], 'criado': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+           'estado': 'processando', 'processadas': 0, 'notas': [], 'processo': _processo_atual()}
+    vistas = set()
+    pendentes = []
+    for url in urls:
+        chave = chave_nfe(url)
+        nota = {'url': url, 'chave': chave, 'estado': 'pendente', 'erro': '', 'itens': []}
+        if (chave or url) in vistas:
+            nota['estado'] = 'repetida'
+        elif chave in aplicadas:
+            nota['estado'] = 'ja_aplicada'
+        else:
+            pendentes.append(len(job['notas']))
+        vistas.add(chave or url)
+        job['notas'].append(nota)
+    job['a_processar'] = len(pendentes)
+    if not pendentes:
+        job['estado'] = 'concluido'
+    with _importacoes_lock:
+        _salvar_importacao(job)
+    for posicao in pendentes:
+        _executor_importacoes.submit(_processar_nota, job, posicao)
+    return job['id']
+
+def resumo_importacao(job):
+    """Andamento do job para o endpoint de status (sem os itens)."""
+    return {
+        'id': job['id'],
+        'estado': job['estado'],
+        'total': len(job['notas']),
+        'a_processar': job['a_processar'],
+        'processadas': job['processadas'],
+        'atualizado': job.get('atualizado', ''),
+        'notas': [{'url': n['url'], 'chave': n['chave'], 'estado': n['estado'], 'erro': n['erro'],
+                   'itens': len(n['itens']), 'reconhecidos': sum(1 for i in n['itens'] if i.get('produto_id'))}
+                  for n in job['notas']],
+    }
+
 # --- Templates HTML (Embutidos) ---
 
 BASE_TEMPLATE = """
@@ -178,7 +3129,8 @@ BASE_TEMPLATE = """
             <nav class="flex-1 p-4 space-y-2">
                 <a href="{{ url_for('index') }}" class="block p-3 rounded {% if active_page == 'dashboard' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-chart-line mr-2"></i> Dashboard</a>
                 <a href="{{ url_for('caixa') }}" class="block p-3 rounded {% if active_page == 'caixa' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-cash-register mr-2"></i> Caixa (Venda)</a>
-                <a href="{{ url_for('estoque') }}" class="block p-3 rounded {% if active_page == 'estoque' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-box mr-2"></i> Estoque</a>
+                <a href="{{ url_for('estoque') }}" class="block p-3 rounded {% if active_page == 'estoque' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-box mr-2"></i> Estoque <span id="badgeEstoqueBaixo" class="hidden float-right bg-red-600 text-white text-xs font-bold rounded-full px-2 py-0.5"></span></a>
+                <a href="{{ url_for('importar_nfe') }}" class="block p-3 rounded {% if active_page == 'importar_nfe' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-file-import mr-2"></i> Importar NFC-e</a>
                 <a href="{{ url_for('despesas') }}" class="block p-3 rounded {% if active_page == 'despesas' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-file-invoice-dollar mr-2"></i> Despesas</a>
                 <a href="{{ url_for('relatorios') }}" class="block p-3 rounded {% if active_page == 'relatorios' %}bg-green-600 hover:bg-green-700 text-white font-bold{% else %}hover:bg-slate-700{% endif %} transition"><i class="fas fa-file-csv mr-2"></i> Exportar</a>
             </nav>
@@ -186,6 +3138,18 @@ BASE_TEMPLATE = """
                 Sistema de Controle Simples
             </div>
         </div>
+        <script>
+        // Alerta de estoque baixo no menu, sem carregar o dashboard
+        fetch('{{ url_for('api_estoque_baixo', limite=0) }}')
+            .then(r => r.ok ? r.json() : null)
+            .then(d => {
+                if (!d || !d.total) return;
+                const badge = document.getElementById('badgeEstoqueBaixo');
+                badge.textContent = d.total;
+                badge.title = d.total + ' produto(s) abaixo do estoque mínimo';
+                badge.classList.remove('hidden');
+            });
+        </script>
 
         <!-- Main Content -->
         <div class="flex-1 flex flex-col overflow-y-auto">
@@ -223,15 +3187,15 @@ DASHBOARD_HTML = """
 <div class="grid grid-cols-1 md:grid-cols-3 gap-6 mb-8">
     <div class="bg-white p-6 rounded-lg shadow-md border-l-4 border-green-500">
         <div class="text-gray-500 text-sm">Vendas</div>
-        <div class="text-3xl font-bold text-gray-800">R$ {{ "%.2f"|format(vendas_filtrado) }}</div>
+        <div id="card_vendas_filtrado" class="text-3xl font-bold text-gray-800">R$ ...</div>
     </div>
     <div class="bg-white p-6 rounded-lg shadow-md border-l-4 border-blue-500">
         <div class="text-gray-500 text-sm">Lucro Estimado</div>
-        <div class="text-3xl font-bold text-gray-800">R$ {{ "%.2f"|format(lucro_filtrado) }}</div>
+        <div id="card_lucro_filtrado" class="text-3xl font-bold text-gray-800">R$ ...</div>
     </div>
     <div class="bg-white p-6 rounded-lg shadow-md border-l-4 border-red-500">
         <div class="text-gray-500 text-sm">Despesas</div>
-        <div class="text-3xl font-bold text-gray-800">R$ {{ "%.2f"|format(despesas_filtrado) }}</div>
+        <div id="card_despesas_filtrado" class="text-3xl font-bold text-gray-800">R$ ...</div>
     </div>
 </div>
 
@@ -307,46 +3271,46 @@ DASHBOARD_HTML = """
             <tr>
                 <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">Produto</th>
                 <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">Qtd Atual</th>
+                <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">Mínimo</th>
                 <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">Status</th>
             </tr>
         </thead>
-        <tbody class="bg-white divide-y divide-gray-200">
-            {% for p in baixo_estoque %}
+        <tbody id="tabelaBaixoEstoque" class="bg-white divide-y divide-gray-200">
             <tr>
-                <td class="px-6 py-4 whitespace-nowrap">{{ p.nome }}</td>
-                <td class="px-6 py-4 whitespace-nowrap font-bold text-red-600">{{ p.quantidade }}</td>
-                <td class="px-6 py-4 whitespace-nowrap text-sm text-red-500">Repor Urgente</td>
+                <td colspan="4" class="px-6 py-4 text-center text-gray-500">Carregando...</td>
             </tr>
-            {% else %}
-            <tr>
-                <td colspan="3" class="px-6 py-4 text-center text-gray-500">Nenhum produto com estoque crítico.</td>
-            </tr>
-            {% endfor %}
         </tbody>
     </table>
 </div>
 
 <script>
-    // Dados para os gráficos antigos (mantidos)
-    const despesasCatLabels = {{ despesas_cat_labels|tojson }};
-    const despesasCatValores = {{ despesas_cat_valores|tojson }};
-
-    const vendasProdutoLabels = {{ produtos_labels|tojson }};
-    const vendasProdutoValores = {{ produtos_vendas_valores|tojson }};
+    // Cada bloco busca seus dados em /api/painel/<bloco> com os filtros da página.
+    // O navegador guarda as respostas e manda o ETag de volta: sem mudança, vem um 304.
+    const filtrosPainel = new URLSearchParams({{ filtros|tojson }}).toString();
+    function carregarBloco(bloco, desenhar) {
+        const url = "{{ url_for('widget_painel', widget='__bloco__') }}".replace('__bloco__', bloco);
+        fetch(url + '?' + filtrosPainel)
+            .then(r => r.json())
+            .then(desenhar)
+            .catch(erro => console.error('Falha ao carregar ' + bloco, erro));
+    }
+    const reais = valor => 'R$ ' + Number(valor).toFixed(2);
 
-    const estoqueLabels = {{ estoque_labels|tojson }};
-    const estoqueValores = {{ estoque_valores|tojson }};
+    carregarBloco('cards', d => {
+        ['vendas_filtrado', 'lucro_filtrado', 'despesas_filtrado'].forEach(campo => {
+            document.getElementById('card_' + campo).textContent = reais(d[campo]);
+        });
+    });
 
     // Evolução de Vendas no Tempo
-    const ctxEvolucao = document.getElementById('evolucaoVendasChart');
-    if (ctxEvolucao) {
-        new Chart(ctxEvolucao, {
+    carregarBloco('evolucao', d => {
+        new Chart(document.getElementById('evolucaoVendasChart'), {
             type: 'line',
             data: {
-                labels: {{ evolucao_labels | tojson }},
+                labels: d.evolucao_labels,
                 datasets: [{
                     label: 'Total de Vendas (R$)',
-                    data: {{ evolucao_valores | tojson }},
+                    data: d.evolucao_valores,
                     borderColor: 'rgb(34, 197, 94)',
                     backgroundColor: 'rgba(34, 197, 94, 0.1)',
                     tension: 0.3,
@@ -365,26 +3329,25 @@ DASHBOARD_HTML = """
                 }
             }
         });
-    }
+    });
 
     // Comparativo Mensal: Vendas vs Despesas
-    const ctxComparativo = document.getElementById('comparativoMensalChart');
-    if (ctxComparativo) {
-        new Chart(ctxComparativo, {
+    carregarBloco('comparativo', d => {
+        new Chart(document.getElementById('comparativoMensalChart'), {
             type: 'bar',
             data: {
-                labels: {{ comparativo_labels | tojson }},
+                labels: d.comparativo_labels,
                 datasets: [
                     {
                         label: 'Vendas (R$)',
-                        data: {{ comparativo_vendas | tojson }},
+                        data: d.comparativo_vendas,
                         backgroundColor: 'rgba(34, 197, 94, 0.7)',
                         borderColor: 'rgb(34, 197, 94)',
                         borderWidth: 1
                     },
                     {
                         label: 'Despesas (R$)',
-                        data: {{ comparativo_despesas | tojson }},
+                        data: d.comparativo_despesas,
                         backgroundColor: 'rgba(239, 68, 68, 0.7)',
                         borderColor: 'rgb(239, 68, 68)',
                         borderWidth: 1
@@ -403,115 +3366,95 @@ DASHBOARD_HTML = """
                 }
             }
         });
-    }
+    });
 
-    function buildChartConfigs() {
-        const ctxDespesasCategoria = document.getElementById('chartDespesasCategoria');
-        if (ctxDespesasCategoria) {
-            new Chart(ctxDespesasCategoria, {
-                type: 'doughnut',
-                data: {
-                    labels: despesasCatLabels,
-                    datasets: [{
-                        data: despesasCatValores,
-                        backgroundColor: [
-                            'rgba(239,68,68,0.8)',
-                            'rgba(249,115,22,0.8)',
-                            'rgba(234,179,8,0.8)',
-                            'rgba(59,130,246,0.8)',
-                            'rgba(16,185,129,0.8)',
-                            'rgba(16,185,129,0.8)'
-                        ]
-                    }]
-                },
-                options: {
-                    responsive: false,
-                    maintainAspectRatio: false,
-                    plugins: { legend: { position: 'bottom' } }
-                }
-            });
-        }
+    carregarBloco('despesas_categoria', d => {
+        new Chart(document.getElementById('chartDespesasCategoria'), {
+            type: 'doughnut',
+            data: {
+                labels: d.despesas_cat_labels,
+                datasets: [{
+                    data: d.despesas_cat_valores,
+                    backgroundColor: [
+                        'rgba(239,68,68,0.8)',
+                        'rgba(249,115,22,0.8)',
+                        'rgba(234,179,8,0.8)',
+                        'rgba(59,130,246,0.8)',
+                        'rgba(16,185,129,0.8)',
+                        'rgba(16,185,129,0.8)'
+                    ]
+                }]
+            },
+            options: {
+                responsive: false,
+                maintainAspectRatio: false,
+                plugins: { legend: { position: 'bottom' } }
+            }
+        });
+    });
 
-        const ctxVendasProduto = document.getElementById('chartVendasProduto');
-        if (ctxVendasProduto) {
-            new Chart(ctxVendasProduto, {
-                type: 'bar',
-                data: {
-                    labels: vendasProdutoLabels,
-                    datasets: [{
-                        label: 'Vendas (R$)',
-                        data: vendasProdutoValores,
-                        backgroundColor: 'rgba(37,99,235,0.7)'
-                    }]
-                },
-                options: {
-                    indexAxis: 'x',
-                    responsive: false,
-                    maintainAspectRatio: false,
-                    scales: {
-                        x: { ticks: { autoSkip: true, maxRotation: 45, minRotation: 0 } },
-                        y: { beginAtZero: true }
-                    }
+    carregarBloco('vendas_produto', d => {
+        new Chart(document.getElementById('chartVendasProduto'), {
+            type: 'bar',
+            data: {
+                labels: d.produtos_labels,
+                datasets: [{
+                    label: 'Vendas (R$)',
+                    data: d.produtos_vendas_valores,
+                    backgroundColor: 'rgba(37,99,235,0.7)'
+                }]
+            },
+            options: {
+                indexAxis: 'x',
+                responsive: false,
+                maintainAspectRatio: false,
+                scales: {
+                    x: { ticks: { autoSkip: true, maxRotation: 45, minRotation: 0 } },
+                    y: { beginAtZero: true }
                 }
-            });
-        }
+            }
+        });
+    });
 
-        const ctxEstoque = document.getElementById('chartEstoque');
-        if (ctxEstoque) {
-            new Chart(ctxEstoque, {
-                type: 'bar',
-                data: {
-                    labels: estoqueLabels,
-                    datasets: [{
-                        label: 'Quantidade em Estoque',
-                        data: estoqueValores,
-                        backgroundColor: 'rgba(34,197,94,0.7)'
-                    }]
-                },
-                options: {
-                    indexAxis: 'y',
-                    responsive: false,
-                    maintainAspectRatio: false,
-                    scales: {
-                        x: { beginAtZero: true }
-                    }
+    carregarBloco('estoque', d => {
+        new Chart(document.getElementById('chartEstoque'), {
+            type: 'bar',
+            data: {
+                labels: d.estoque_labels,
+                datasets: [{
+                    label: 'Quantidade em Estoque',
+                    data: d.estoque_valores,
+                    backgroundColor: 'rgba(34,197,94,0.7)'
+                }]
+            },
+            options: {
+                indexAxis: 'y',
+                responsive: false,
+                maintainAspectRatio: false,
+                scales: {
+                    x: { beginAtZero: true }
                 }
-            });
-        }
+            }
+        });
 
-        const ctxRadarProduto = document.getElementById('chartRadarProduto');
-        if (ctxRadarProduto) {
-            new Chart(ctxRadarProduto, {
-                type: 'radar',
-                data: {
-                    labels: vendasProdutoLabels,
-                    datasets: [
-                        {
-                            label: 'Vendas (R$)',
-                            data: vendasProdutoValores,
-                            borderColor: 'rgba(59,130,246,1)',
-                            backgroundColor: 'rgba(59,130,246,0.2)'
-                        },
-                        {
-                            label: 'Lucro (R$)',
-                            data: lucroProdutoValores,
-                            borderColor: 'rgba(34,197,94,1)',
-                            backgroundColor: 'rgba(34,197,94,0.2)'
-                        }
-                    ]
-                },
-                options: {
-                    responsive: false,
-                    maintainAspectRatio: false,
-                    scales: {
-                        r: { beginAtZero: true }
-                    }
-                }
-            });
+        // Alerta de estoque baixo
+        const corpo = document.getElementById('tabelaBaixoEstoque');
+        corpo.innerHTML = '';
+        if (!d.baixo_estoque.length) {
+            corpo.innerHTML = '<tr><td colspan="4" class="px-6 py-4 text-center text-gray-500">Nenhum produto com estoque crítico.</td></tr>';
         }
-    }
-
-    document.addEventListener('DOMContentLoaded', buildChartConfigs);
+        d.baixo_estoque.forEach(p => {
+            const tr = document.createElement('tr');
+            tr.innerHTML = '<td class="px-6 py-4 whitespace-nowrap"></td>'
+                + '<td class="px-6 py-4 whitespace-nowrap font-bold text-red-600"></td>'
+                + '<td class="px-6 py-4 whitespace-nowrap text-gray-600"></td>'
+                + '<td class="px-6 py-4 whitespace-nowrap text-sm text-red-500">Repor Urgente</td>';
+            tr.children[0].textContent = p.nome;
+            tr.children[1].textContent = p.quantidade;
+            tr.children[2].textContent = p.estoque_minimo;
+            corpo.appendChild(tr);
+        });
+    });
 </script>
 {% endblock %}
 """
@@ -538,10 +3481,14 @@ ESTOQUE_HTML = """
             <label class="block text-sm font-medium text-gray-700">Qtd Inicial</label>
             <input type="number" name="quantidade" value="{{ form_data.quantidade if form_data else '' }}" class="mt-1 block w-full border border-gray-300 rounded-md p-2">
         </div>
-        <div class="col-span-1 md:col-span-3">
+        <div class="col-span-1 md:col-span-2">
             <label class="block text-sm font-medium text-gray-700">Fornecedor</label>
             <input type="text" name="fornecedor" value="{{ form_data.fornecedor if form_data else '' }}" class="mt-1 block w-full border border-gray-300 rounded-md p-2">
         </div>
+        <div>
+            <label class="block text-sm font-medium text-gray-700">Estoque Mínimo</label>
+            <input type="number" min="0" name="estoque_minimo" placeholder="{{ estoque_minimo_padrao }}" value="{{ form_data.estoque_minimo if form_data else '' }}" class="mt-1 block w-full border border-gray-300 rounded-md p-2">
+        </div>
         <div class="col-span-1 md:col-span-2 md:col-span-1">
             <label class="block text-sm font-medium text-gray-700 invisible md:visible">&nbsp;</label>
             <button type="submit" name="acao" value="salvar" class="mt-1 w-full bg-blue-600 text-white p-2 rounded-md hover:bg-blue-700 font-bold">Salvar</button>
@@ -552,20 +3499,41 @@ ESTOQUE_HTML = """
                 <input type="url" name="url_nfe" placeholder="Cole aqui a URL completa da NFC-e" value="{{ form_data.url_nfe if form_data else '' }}" class="flex-1 border border-gray-300 rounded-md p-2">
                 <button type="submit" name="acao" value="preencher_nfe" class="bg-green-600 text-white px-3 py-2 rounded-md text-sm font-semibold hover:bg-green-700 whitespace-nowrap">Pegar dados pela URL</button>
             </div>
+            <label class="mt-2 inline-flex items-center text-xs text-gray-600">
+                <input type="checkbox" name="busca_aproximada" value="1" class="h-4 w-4 mr-2 border-gray-300 rounded">
+                Sugerir produtos com nome parecido para itens não encontrados
+            </label>
         </div>
     </form>
 </div>
 
+{% macro coluna_ordenavel(campo, rotulo) %}
+<th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">
+    <a href="{{ url_for('estoque', busca=busca or None, ordem=campo, direcao='desc' if ordem == campo and direcao == 'asc' else 'asc') }}" class="hover:text-gray-800">
+        {{ rotulo }}{% if ordem == campo %} <i class="fas fa-sort-{{ 'up' if direcao == 'asc' else 'down' }}"></i>{% endif %}
+    </a>
+</th>
+{% endmacro %}
+<form method="GET" action="{{ url_for('estoque') }}" class="bg-white p-4 rounded-lg shadow mb-4 flex flex-wrap gap-2 items-center">
+    <input type="text" name="busca" value="{{ busca }}" placeholder="Buscar por nome ou ID" class="flex-1 min-w-0 border border-gray-300 rounded-md p-2 text-sm">
+    <input type="hidden" name="ordem" value="{{ ordem }}">
+    <input type="hidden" name="direcao" value="{{ direcao }}">
+    <button type="submit" class="bg-slate-700 text-white px-4 py-2 rounded-md text-sm hover:bg-slate-800"><i class="fas fa-search mr-1"></i> Buscar</button>
+    {% if busca %}<a href="{{ url_for('estoque', ordem=ordem, direcao=direcao) }}" class="px-4 py-2 rounded-md border border-gray-300 text-gray-700 text-sm hover:bg-gray-50">Limpar</a>{% endif %}
+    <span class="text-sm text-gray-500">{{ total_produtos }} produto(s)</span>
+</form>
+
 <div class="bg-white rounded-lg shadow overflow-x-auto">
     <table class="min-w-full divide-y divide-gray-200">
         <thead class="bg-gray-50">
             <tr>
-                <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">ID</th>
-                <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">Produto</th>
+                {{ coluna_ordenavel('id', 'ID') }}
+                {{ coluna_ordenavel('nome', 'Produto') }}
                 <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">Custo</th>
                 <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">Venda</th>
-                <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">Qtd</th>
-                <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">Fornecedor</th>
+                {{ coluna_ordenavel('margem', 'Margem') }}
+                {{ coluna_ordenavel('quantidade', 'Qtd') }}
+                {{ coluna_ordenavel('fornecedor', 'Fornecedor') }}
                 <th class="px-4 py-2 text-left text-xs font-medium text-gray-500 uppercase">Ações</th>
             </tr>
         </thead>
@@ -576,20 +3544,36 @@ ESTOQUE_HTML = """
                 <td class="px-4 py-2 text-sm font-medium text-gray-900">{{ produto.nome }}</td>
                 <td class="px-4 py-2 text-sm text-gray-900">R$ {{ "%.2f"|format(produto.custo|float) }}</td>
                 <td class="px-4 py-2 text-sm text-gray-900">R$ {{ "%.2f"|format(produto.preco_venda|float) }}</td>
-                <td class="px-4 py-2 text-sm text-gray-900">{{ produto.quantidade }}</td>
+                <td class="px-4 py-2 text-sm text-gray-900">{% if produto.margem is not none %}{{ "%.1f"|format(produto.margem * 100) }}%{% else %}-{% endif %}</td>
+                <td class="px-4 py-2 text-sm {% if produto.quantidade < produto.minimo %}font-bold text-red-600{% else %}text-gray-900{% endif %}" title="Estoque mínimo: {{ produto.minimo }}">{{ produto.quantidade }}</td>
                 <td class="px-4 py-2 text-sm text-gray-900">{{ produto.fornecedor }}</td>
                 <td class="px-4 py-2 text-sm">
-                    <button onclick="openEditModal('{{ produto.id }}', '{{ produto.nome }}', {{ produto.custo }}, {{ produto.preco_venda }}, {{ produto.quantidade }}, '{{ produto.fornecedor }}')" class="px-2 py-1 bg-blue-600 text-white rounded text-xs hover:bg-blue-700">Editar</button>
+                    <button onclick='openEditModal({{ produto.id|tojson }}, {{ produto.nome|tojson }}, {{ produto.custo|tojson }}, {{ produto.preco_venda|tojson }}, {{ produto.quantidade|tojson }}, {{ produto.fornecedor|tojson }}, {{ produto.estoque_minimo|tojson }})' class="px-2 py-1 bg-blue-600 text-white rounded text-xs hover:bg-blue-700">Editar</button>
                     <form method="POST" action="{{ url_for('excluir_produto') }}" class="inline-block ml-1">
                         <input type="hidden" name="id" value="{{ produto.id }}">
                         <button type="submit" class="px-2 py-1 bg-red-600 text-white rounded text-xs hover:bg-red-700" onclick="return confirm('Tem certeza que deseja excluir este produto?')">Excluir</button>
                     </form>
                 </td>
             </tr>
+            {% else %}
+            <tr>
+                <td colspan="8" class="px-4 py-4 text-center text-sm text-gray-500">Nenhum produto encontrado.</td>
+            </tr>
             {% endfor %}
         </tbody>
     </table>
 </div>
+{% if paginas > 1 %}
+<div class="flex justify-between items-center mt-4 text-sm">
+    {% if pagina > 1 %}
+    <a href="{{ url_for('estoque', busca=busca or None, ordem=ordem, direcao=direcao, pagina=pagina - 1) }}" class="px-3 py-1 rounded border border-gray-300 bg-white hover:bg-gray-50">&laquo; Anterior</a>
+    {% else %}<span></span>{% endif %}
+    <span class="text-gray-600">Página {{ pagina }} de {{ paginas }}</span>
+    {% if pagina < paginas %}
+    <a href="{{ url_for('estoque', busca=busca or None, ordem=ordem, direcao=direcao, pagina=pagina + 1) }}" class="px-3 py-1 rounded border border-gray-300 bg-white hover:bg-gray-50">Próxima &raquo;</a>
+    {% else %}<span></span>{% endif %}
+</div>
+{% endif %}
 
 <!-- Modal de edição de produto -->
 <div id="editModal" class="fixed inset-0 bg-black bg-opacity-40 flex items-center justify-center z-50 hidden">
@@ -618,6 +3602,10 @@ ESTOQUE_HTML = """
                     <label class="block text-sm font-medium text-gray-700">Fornecedor</label>
                     <input type="text" name="fornecedor" id="edit_fornecedor" class="mt-1 block w-full border border-gray-300 rounded-md p-2">
                 </div>
+                <div>
+                    <label class="block text-sm font-medium text-gray-700">Estoque Mínimo</label>
+                    <input type="number" min="0" name="estoque_minimo" id="edit_estoque_minimo" placeholder="{{ estoque_minimo_padrao }}" class="mt-1 block w-full border border-gray-300 rounded-md p-2">
+                </div>
             </div>
             <div class="flex justify-end gap-3 pt-4">
                 <button type="button" onclick="closeEditModal()" class="px-4 py-2 rounded-md border border-gray-300 text-gray-700 text-sm hover:bg-gray-50">Cancelar</button>
@@ -628,13 +3616,14 @@ ESTOQUE_HTML = """
 </div>
 
 <script>
-function openEditModal(id, nome, custo, precoVenda, quantidade, fornecedor) {
+function openEditModal(id, nome, custo, precoVenda, quantidade, fornecedor, estoqueMinimo) {
     document.getElementById('edit_id').value = id;
     document.getElementById('edit_nome').value = nome;
     document.getElementById('edit_custo').value = custo;
     document.getElementById('edit_preco_venda').value = precoVenda;
     document.getElementById('edit_quantidade').value = quantidade;
     document.getElementById('edit_fornecedor').value = fornecedor;
+    document.getElementById('edit_estoque_minimo').value = estoqueMinimo;
     document.getElementById('editModal').classList.remove('hidden');
 }
 function closeEditModal() {
@@ -649,7 +3638,7 @@ function closeEditModal() {
         <p class="text-sm text-gray-600 mb-4">Foram encontrados itens desta NFC-e que já estão cadastrados no estoque. Selecione quais deseja atualizar e ajuste as quantidades, se necessário.</p>
         <form method="POST" action="{{ url_for('adicionar_produto') }}" class="space-y-4">
             <input type="hidden" name="acao" value="confirmar_itens_existentes">
-            <input type="hidden" name="nfe_json" value='{{ nfe_json }}'>
+            <input type="hidden" name="nfe_token" value="{{ nfe_token }}">
             <div class="max-h-300 overflow-y-auto border rounded-md">
                 <table class="min-w-full text-sm">
                     <thead class="bg-gray-50">
@@ -697,7 +3686,7 @@ function closeEditModal() {
         <p class="text-sm text-gray-600 mb-4">Foram encontrados itens novos nesta NFC-e. Informe o preço de venda para cada um e confirme o cadastro em lote.</p>
         <form method="POST" action="{{ url_for('adicionar_produto') }}" class="space-y-4">
             <input type="hidden" name="acao" value="confirmar_itens_novos">
-            <input type="hidden" name="nfe_json_novos" value='{{ nfe_json_novos }}'>
+            <input type="hidden" name="nfe_token" value="{{ nfe_token }}">
             <div class="max-h-300 overflow-y-auto border rounded-md">
                 <table class="min-w-full text-sm">
                     <thead class="bg-gray-50">
@@ -714,6 +3703,9 @@ function closeEditModal() {
                         <tr>
                             <td class="px-3 py-2">
                                 <input type="text" name="nome_{{ loop.index0 }}" value="{{ item.nome }}" class="w-full border border-gray-300 rounded-md p-1 text-sm">
+                                {% if item.sugestoes %}
+                                <div class="text-xs text-amber-600 mt-1">Parecido com: {{ item.sugestoes|join(', ') }}</div>
+                                {% endif %}
                             </td>
                             <td class="px-3 py-2">
                                 <input type="number" step="0.01" name="custo_{{ loop.index0 }}" value="{{ item.custo }}" readonly class="w-20 border border-gray-300 rounded-md p-1 text-sm bg-gray-50">
@@ -747,29 +3739,43 @@ CAIXA_HTML = """
 {% extends "base" %}
 {% block content %}
 <div class="flex flex-col md:flex-row gap-6">
-    <!-- Formulário de Venda -->
+    <!-- Carrinho de Venda -->
     <div class="w-full md:w-1/2">
         <div class="bg-white p-6 rounded-lg shadow-lg border-t-4 border-green-500">
             <h3 class="text-2xl font-bold mb-6 text-gray-800">Registrar Venda</h3>
-            <form action="{{ url_for('registrar_venda') }}" method="POST">
-                <div class="mb-4">
-                    <label class="block text-sm font-bold text-gray-700 mb-2">Selecione o Produto</label>
-                    <select name="produto_id" id="produto_select" class="w-full border-2 border-gray-300 rounded-lg p-3 focus:border-green-500 focus:outline-none bg-white" onchange="atualizarPreco()">
-                        <option value="" data-preco="0">-- Escolha um produto --</option>
-                        {% for p in produtos %}
-                            {% if p.quantidade|int > 0 %}
-                            <option value="{{ p.id }}" data-preco="{{ p.preco_venda }}">
-                                {{ p.nome }} (Estoque: {{ p.quantidade }} | R$ {{ p.preco_venda }})
-                            </option>
-                            {% endif %}
-                        {% endfor %}
-                    </select>
+            <div class="mb-4">
+                <label class="block text-sm font-bold text-gray-700 mb-2">Produto (nome ou código)</label>
+                <div class="relative">
+                    <input type="text" id="produto_busca" autocomplete="off" autofocus placeholder="Digite o nome ou leia o código" class="w-full border-2 border-gray-300 rounded-lg p-3 focus:border-green-500 focus:outline-none bg-white">
+                    <ul id="produto_sugestoes" class="absolute z-10 w-full bg-white border border-gray-200 rounded-lg shadow-lg mt-1 max-h-72 overflow-y-auto hidden"></ul>
                 </div>
-                
-                <div class="mb-4">
+                <div id="produto_escolhido" class="mt-2 text-sm text-gray-600"></div>
+            </div>
+
+            <div class="mb-4 flex gap-2 items-end">
+                <div class="flex-1">
                     <label class="block text-sm font-bold text-gray-700 mb-2">Quantidade</label>
-                    <input type="number" name="quantidade" id="qtd_input" value="1" min="1" class="w-full border-2 border-gray-300 rounded-lg p-3 text-lg" oninput="calcularTotal()">
+                    <input type="number" id="qtd_input" value="1" min="1" class="w-full border-2 border-gray-300 rounded-lg p-3 text-lg">
                 </div>
+                <button type="button" onclick="adicionarAoCarrinho()" class="bg-blue-600 text-white px-4 py-3 rounded-lg hover:bg-blue-700 font-bold">
+                    <i class="fas fa-cart-plus mr-1"></i> Adicionar
+                </button>
+            </div>
+
+            <form action="{{ url_for('finalizar_carrinho') }}" method="POST" id="carrinho_form">
+                <table class="min-w-full text-sm mb-4">
+                    <thead>
+                        <tr class="text-left text-gray-500 border-b">
+                            <th class="pb-2">Produto</th>
+                            <th class="pb-2">Qtd</th>
+                            <th class="pb-2 text-right">Subtotal</th>
+                            <th class="pb-2"></th>
+                        </tr>
+                    </thead>
+                    <tbody id="carrinho_linhas">
+                        <tr id="carrinho_vazio"><td colspan="4" class="py-3 text-center text-gray-400">Carrinho vazio</td></tr>
+                    </tbody>
+                </table>
 
                 <div class="mb-6 p-4 bg-gray-50 rounded-lg text-center">
                     <span class="block text-gray-500 text-sm uppercase">Total da Venda</span>
@@ -792,6 +3798,7 @@ CAIXA_HTML = """
                     <thead>
                         <tr class="text-left text-gray-500 border-b">
                             <th class="pb-2">Hora</th>
+                            <th class="pb-2">Ticket</th>
                             <th class="pb-2">Produto</th>
                             <th class="pb-2">Qtd</th>
                             <th class="pb-2 text-right">Valor</th>
@@ -801,6 +3808,7 @@ CAIXA_HTML = """
                         {% for v in ultimas_vendas %}
                         <tr class="border-b border-gray-100">
                             <td class="py-3 text-gray-500">{{ v.data.split(' ')[1][:5] }}</td>
+                            <td class="py-3 text-gray-500">{% if v.ticket_id %}#{{ v.ticket_id }}{% endif %}</td>
                             <td class="py-3 font-medium">{{ v.nome_produto }}</td>
                             <td class="py-3">{{ v.quantidade }}</td>
                             <td class="py-3 text-right font-bold text-green-600">R$ {{ v.total_venda }}</td>
@@ -814,21 +3822,136 @@ CAIXA_HTML = """
 </div>
 
 <script>
-    function atualizarPreco() {
-        calcularTotal();
+    // Carrinho: produto_id -> {nome, preco, estoque, qtd}
+    const carrinho = {};
+    // Busca de produtos: espera a digitação parar antes de consultar o servidor
+    const URL_BUSCA = "{{ url_for('buscar_produtos') }}";
+    const campoBusca = document.getElementById('produto_busca');
+    const listaSugestoes = document.getElementById('produto_sugestoes');
+    let sugestoes = [];
+    let produtoEscolhido = null;
+    let esperaBusca = null;
+    let ultimaBusca = 0;
+
+    campoBusca.addEventListener('input', () => {
+        produtoEscolhido = null;
+        document.getElementById('produto_escolhido').textContent = '';
+        clearTimeout(esperaBusca);
+        esperaBusca = setTimeout(buscarProdutos, 150);
+    });
+    campoBusca.addEventListener('keydown', evento => {
+        if (evento.key !== 'Enter') {
+            return;
+        }
+        evento.preventDefault();
+        clearTimeout(esperaBusca);
+        // Leitor de código termina com Enter: busca na hora e adiciona o primeiro resultado
+        buscarProdutos().then(() => {
+            if (sugestoes.length) {
+                escolherProduto(sugestoes[0]);
+                adicionarAoCarrinho();
+            }
+        });
+    });
+
+    function buscarProdutos() {
+        const texto = campoBusca.value.trim();
+        const numero = ++ultimaBusca;
+        if (!texto) {
+            mostrarSugestoes([]);
+            return Promise.resolve();
+        }
+        const params = new URLSearchParams({q: texto, limite: 10, disponiveis: 1});
+        return fetch(URL_BUSCA + '?' + params)
+            .then(r => r.json())
+            .then(produtos => {
+                // Respostas fora de ordem de buscas antigas são ignoradas
+                if (numero === ultimaBusca) {
+                    mostrarSugestoes(produtos);
+                }
+            });
+    }
+
+    function mostrarSugestoes(produtos) {
+        sugestoes = produtos;
+        listaSugestoes.innerHTML = '';
+        for (const p of produtos) {
+            const li = document.createElement('li');
+            li.className = 'px-3 py-2 cursor-pointer hover:bg-green-50 flex justify-between';
+            li.innerHTML = '<span></span><span class="text-gray-500"></span>';
+            li.children[0].textContent = p.nome;
+            li.children[1].textContent = 'Estoque: ' + p.quantidade + ' | R$ ' + p.preco_venda.toFixed(2);
+            li.onclick = () => escolherProduto(p);
+            listaSugestoes.appendChild(li);
+        }
+        listaSugestoes.classList.toggle('hidden', !produtos.length);
+    }
+
+    function escolherProduto(p) {
+        produtoEscolhido = p;
+        campoBusca.value = p.nome;
+        mostrarSugestoes([]);
+        document.getElementById('produto_escolhido').textContent =
+            'Estoque: ' + p.quantidade + ' | R$ ' + p.preco_venda.toFixed(2);
+    }
+
+    function adicionarAoCarrinho() {
+        const p = produtoEscolhido;
+        const qtd = parseInt(document.getElementById('qtd_input').value);
+        if (!p || !qtd || qtd < 1) {
+            return;
+        }
+        const linha = carrinho[p.id] || {
+            nome: p.nome,
+            preco: p.preco_venda,
+            estoque: p.quantidade,
+            qtd: 0
+        };
+        if (linha.qtd + qtd > linha.estoque) {
+            alert('Estoque insuficiente! Disponível: ' + linha.estoque);
+            return;
+        }
+        linha.qtd += qtd;
+        carrinho[p.id] = linha;
+        document.getElementById('qtd_input').value = 1;
+        produtoEscolhido = null;
+        campoBusca.value = '';
+        document.getElementById('produto_escolhido').textContent = '';
+        campoBusca.focus();
+        renderizarCarrinho();
+    }
+
+    function removerDoCarrinho(id) {
+        delete carrinho[id];
+        renderizarCarrinho();
     }
 
-    function calcularTotal() {
-        const select = document.getElementById('produto_select');
-        const qtd = document.getElementById('qtd_input').value;
-        const preco = select.options[select.selectedIndex].getAttribute('data-preco');
-        
-        if (preco) {
-            const total = parseFloat(preco) * parseInt(qtd);
-            document.getElementById('total_display').innerText = 'R$ ' + total.toFixed(2);
-        } else {
-            document.getElementById('total_display').innerText = 'R$ 0.00';
+    function renderizarCarrinho() {
+        const corpo = document.getElementById('carrinho_linhas');
+        corpo.innerHTML = '';
+        let total = 0;
+        const ids = Object.keys(carrinho);
+        for (const id of ids) {
+            const linha = carrinho[id];
+            const subtotal = linha.preco * linha.qtd;
+            total += subtotal;
+            const tr = document.createElement('tr');
+            tr.className = 'border-b border-gray-100';
+            tr.innerHTML = '<td class="py-2"></td><td class="py-2"></td>' +
+                '<td class="py-2 text-right">R$ ' + subtotal.toFixed(2) + '</td>' +
+                '<td class="py-2 text-right"><button type="button" class="text-red-500 hover:text-red-700"><i class="fas fa-trash"></i></button>' +
+                '<input type="hidden" name="produto_id"><input type="hidden" name="quantidade"></td>';
+            tr.children[0].textContent = linha.nome;
+            tr.children[1].textContent = linha.qtd;
+            tr.querySelector('button').onclick = () => removerDoCarrinho(id);
+            tr.querySelector('input[name=produto_id]').value = id;
+            tr.querySelector('input[name=quantidade]').value = linha.qtd;
+            corpo.appendChild(tr);
         }
+        if (!ids.length) {
+            corpo.innerHTML = '<tr id="carrinho_vazio"><td colspan="4" class="py-3 text-center text-gray-400">Carrinho vazio</td></tr>';
+        }
+        document.getElementById('total_display').innerText = 'R$ ' + total.toFixed(2);
     }
 </script>
 {% endblock %}
@@ -862,6 +3985,26 @@ DESPESAS_HTML = """
     </form>
 </div>
 
+<form method="GET" action="{{ url_for('despesas') }}" class="bg-white p-4 rounded-lg shadow mb-4 flex flex-wrap gap-2 items-end">
+    <label class="text-sm text-gray-700">De
+        <input type="date" name="data_inicio" value="{{ filtros.data_inicio }}" class="mt-1 block border border-gray-300 rounded-md p-2 text-sm">
+    </label>
+    <label class="text-sm text-gray-700">Até
+        <input type="date" name="data_fim" value="{{ filtros.data_fim }}" class="mt-1 block border border-gray-300 rounded-md p-2 text-sm">
+    </label>
+    <label class="text-sm text-gray-700">Categoria
+        <select name="categoria" class="mt-1 block border border-gray-300 rounded-md p-2 text-sm bg-white">
+            <option value="">Todas</option>
+            {% for cat in categorias_opcoes %}
+            <option value="{{ cat }}" {% if filtros.categoria == cat %}selected{% endif %}>{{ cat }}</option>
+            {% endfor %}
+        </select>
+    </label>
+    <button type="submit" class="bg-slate-700 text-white px-4 py-2 rounded-md text-sm hover:bg-slate-800"><i class="fas fa-filter mr-1"></i> Filtrar</button>
+    <a href="{{ url_for('despesas') }}" class="px-4 py-2 rounded-md border border-gray-300 text-gray-700 text-sm hover:bg-gray-50">Limpar</a>
+    <span class="text-sm text-gray-500 ml-auto">{{ total_despesas }} despesa(s)</span>
+</form>
+
 <div class="bg-white rounded-lg shadow">
     <h3 class="p-4 text-lg font-bold border-b">Últimas Despesas</h3>
     <table class="min-w-full">
@@ -881,17 +4024,32 @@ DESPESAS_HTML = """
                 <td class="px-6 py-4"><span class="px-2 py-1 text-xs rounded bg-gray-200">{{ d.categoria }}</span></td>
                 <td class="px-6 py-4 text-red-600 font-bold">- R$ {{ d.valor }}</td>
             </tr>
+            {% else %}
+            <tr>
+                <td colspan="4" class="px-6 py-4 text-center text-gray-500">Nenhuma despesa no período.</td>
+            </tr>
             {% endfor %}
         </tbody>
     </table>
 </div>
+{% if paginas > 1 %}
+<div class="flex justify-between items-center mt-4 text-sm">
+    {% if pagina > 1 %}
+    <a href="{{ url_for('despesas', pagina=pagina - 1, **filtros) }}" class="px-3 py-1 rounded border border-gray-300 bg-white hover:bg-gray-50">&laquo; Mais recentes</a>
+    {% else %}<span></span>{% endif %}
+    <span class="text-gray-600">Página {{ pagina }} de {{ paginas }}</span>
+    {% if pagina < paginas %}
+    <a href="{{ url_for('despesas', pagina=pagina + 1, **filtros) }}" class="px-3 py-1 rounded border border-gray-300 bg-white hover:bg-gray-50">Mais antigas &raquo;</a>
+    {% else %}<span></span>{% endif %}
+</div>
+{% endif %}
 {% endblock %}
 """
 
 RELATORIOS_HTML = """
 {% extends "base" %}
 {% block content %}
-<div class="bg-white p-6 rounded-lg shadow text-center">
+<div class="bg-white p-6 rounded-lg shadow text-center mb-6">
     <h3 class="text-xl font-bold mb-4">Exportar Dados para Excel</h3>
     <p class="text-gray-600 mb-6">Baixe seus dados para analisar detalhadamente.</p>
     
@@ -907,6 +4065,217 @@ RELATORIOS_HTML = """
         </a>
     </div>
 </div>
+
+<datalist id="opcoesProdutos">
+    {% for nome in produtos_opcoes %}<option value="{{ nome }}">{% endfor %}
+</datalist>
+<datalist id="opcoesFornecedores">
+    {% for nome in fornecedores_opcoes %}<option value="{{ nome }}">{% endfor %}
+</datalist>
+<datalist id="opcoesCategorias">
+    {% for cat in categorias_opcoes %}<option value="{{ cat }}">{% endfor %}
+</datalist>
+
+<div class="grid grid-cols-1 md:grid-cols-3 gap-6">
+    {% for tipo, titulo in [('vendas', 'Vendas'), ('produtos', 'Estoque'), ('despesas', 'Despesas')] %}
+    <form action="{{ url_for('download_csv', tipo=tipo) }}" method="GET" class="bg-white p-6 rounded-lg shadow space-y-3">
+        <h3 class="text-lg font-bold">{{ titulo }} filtrado</h3>
+        {% if 'data_inicio' in filtros_exportacao[tipo] %}
+        <div class="grid grid-cols-2 gap-2">
+            <label class="text-sm text-gray-700">De
+                <input type="date" name="data_inicio" class="mt-1 w-full border border-gray-300 rounded-md p-2 text-sm">
+            </label>
+            <label class="text-sm text-gray-700">Até
+                <input type="date" name="data_fim" class="mt-1 w-full border border-gray-300 rounded-md p-2 text-sm">
+            </label>
+        </div>
+        {% endif %}
+        {% if 'produto' in filtros_exportacao[tipo] %}
+        <label class="block text-sm text-gray-700">Produto
+            <input type="text" name="produto" list="opcoesProdutos" class="mt-1 w-full border border-gray-300 rounded-md p-2 text-sm">
+        </label>
+        {% endif %}
+        {% if 'fornecedor' in filtros_exportacao[tipo] %}
+        <label class="block text-sm text-gray-700">Fornecedor
+            <input type="text" name="fornecedor" list="opcoesFornecedores" class="mt-1 w-full border border-gray-300 rounded-md p-2 text-sm">
+        </label>
+        {% endif %}
+        {% if 'categoria' in filtros_exportacao[tipo] %}
+        <label class="block text-sm text-gray-700">Categoria
+            <input type="text" name="categoria" list="opcoesCategorias" class="mt-1 w-full border border-gray-300 rounded-md p-2 text-sm">
+        </label>
+        {% endif %}
+        <fieldset class="text-sm text-gray-700">
+            <legend class="mb-1">Colunas</legend>
+            <div class="grid grid-cols-2 gap-1">
+                {% for coluna in colunas[tipo] %}
+                <label><input type="checkbox" name="colunas" value="{{ coluna }}" checked> {{ coluna }}</label>
+                {% endfor %}
+            </div>
+        </fieldset>
+        <label class="block text-sm text-gray-700"><input type="checkbox" name="gzip" value="1"> Compactar (.csv.gz)</label>
+        <button type="submit" class="w-full bg-slate-700 text-white px-4 py-2 rounded hover:bg-slate-800">
+            <i class="fas fa-filter mr-2"></i> Exportar
+        </button>
+    </form>
+    {% endfor %}
+</div>
+{% endblock %}
+"""
+
+IMPORTAR_NFE_HTML = """
+{% extends "base" %}
+{% block content %}
+<div class="bg-white p-6 rounded-lg shadow mb-6">
+    <h3 class="text-lg font-bold mb-2">Importar várias NFC-e</h3>
+    <p class="text-sm text-gray-600 mb-4">Cole as URLs das notas (uma por linha) ou envie um arquivo de texto com as URLs ou o conteúdo dos QR Codes. As notas são lidas em segundo plano; depois você revisa e lança tudo no estoque de uma vez.</p>
+    <form action="{{ url_for('importar_nfe') }}" method="POST" enctype="multipart/form-data" class="space-y-4">
+        <textarea name="urls" rows="8" placeholder="https://www.nfce.fazenda.sp.gov.br/qrcode?p=3524..." class="w-full border border-gray-300 rounded-md p-2 font-mono text-sm"></textarea>
+        <div class="flex flex-wrap items-center gap-4">
+            <input type="file" name="arquivo" accept=".txt,.csv,text/plain" class="text-sm">
+            <button type="submit" class="bg-green-600 text-white px-6 py-2 rounded-md hover:bg-green-700 font-bold"><i class="fas fa-file-import mr-2"></i>Importar</button>
+        </div>
+    </form>
+</div>
+
+<div class="bg-white rounded-lg shadow">
+    <h3 class="p-4 text-lg font-bold border-b">Importações Recentes</h3>
+    <table class="min-w-full">
+        <thead class="bg-gray-50">
+            <tr>
+                <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase">Criada em</th>
+                <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase">Notas</th>
+                <th class="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase">Situação</th>
+                <th class="px-6 py-3"></th>
+            </tr>
+        </thead>
+        <tbody class="divide-y divide-gray-200">
+            {% for job in importacoes %}
+            <tr>
+                <td class="px-6 py-4">{{ job.criado }}</td>
+                <td class="px-6 py-4">{{ job.notas }}</td>
+                <td class="px-6 py-4">{{ {'processando': 'Lendo notas', 'falhou': 'Interrompida', 'concluido': 'Aguardando revisão', 'aplicado': 'Lançada no estoque'}[job.estado] }}</td>
+                <td class="px-6 py-4 text-right"><a href="{{ url_for('ver_importacao', job_id=job.id) }}" class="text-blue-600 hover:underline">Abrir</a></td>
+            </tr>
+            {% else %}
+            <tr><td colspan="4" class="px-6 py-4 text-gray-500">Nenhuma importação ainda.</td></tr>
+            {% endfor %}
+        </tbody>
+    </table>
+</div>
+{% endblock %}
+"""
+
+IMPORTACAO_NFE_HTML = """
+{% extends "base" %}
+{% block content %}
+{% set rotulos = {'pendente': 'Na fila', 'interrompida': 'Interrompida', 'ok': 'Lida', 'erro_busca': 'Falha ao baixar', 'erro_leitura': 'Página sem itens', 'repetida': 'Repetida nesta lista', 'ja_aplicada': 'Já lançada antes', 'aplicada': 'Lançada'} %}
+<div class="bg-white p-6 rounded-lg shadow mb-6">
+    <div class="flex justify-between items-center mb-2">
+        <h3 class="text-lg font-bold">Importação de {{ job.criado }}</h3>
+        <a href="{{ url_for('importar_nfe') }}" class="text-sm text-blue-600 hover:underline">Nova importação</a>
+    </div>
+    <div class="w-full bg-gray-200 rounded h-3 mb-2">
+        <div id="barra" class="bg-green-600 h-3 rounded" style="width: {{ (100 * job.processadas / job.a_processar) if job.a_processar else 100 }}%"></div>
+    </div>
+    <p id="andamento" class="text-sm text-gray-600">{{ job.processadas }} de {{ job.a_processar }} notas lidas</p>
+</div>
+
+{% if job.estado == 'processando' %}
+<div class="bg-white rounded-lg shadow">
+    <table class="min-w-full text-sm">
+        <thead class="bg-gray-50">
+            <tr>
+                <th class="px-4 py-2 text-left font-medium text-gray-600">Nota</th>
+                <th class="px-4 py-2 text-left font-medium text-gray-600">Situação</th>
+            </tr>
+        </thead>
+        <tbody class="divide-y divide-gray-200">
+            {% for nota in job.notas %}
+            <tr>
+                <td class="px-4 py-2 font-mono text-xs break-all">{{ nota.chave or nota.url }}</td>
+                <td class="px-4 py-2" id="nota_{{ loop.index0 }}">{{ rotulos[nota.estado] }}</td>
+            </tr>
+            {% endfor %}
+        </tbody>
+    </table>
+</div>
+<script>
+const rotulos = {{ rotulos|tojson }};
+function acompanhar() {
+    fetch("{{ url_for('status_importacao', job_id=job.id) }}").then(r => r.json()).then(s => {
+        const pct = s.a_processar ? 100 * s.processadas / s.a_processar : 100;
+        document.getElementById('barra').style.width = pct + '%';
+        document.getElementById('andamento').textContent = s.processadas + ' de ' + s.a_processar + ' notas lidas';
+        s.notas.forEach((n, i) => {
+            document.getElementById('nota_' + i).textContent = rotulos[n.estado] + (n.erro ? ' (' + n.erro + ')' : '');
+        });
+        if (s.estado === 'processando') setTimeout(acompanhar, 1500);
+        else window.location.reload();
+    }).catch(() => setTimeout(acompanhar, 5000));
+}
+setTimeout(acompanhar, 1000);
+</script>
+{% else %}
+{% if job.estado == 'falhou' %}
+<div class="bg-yellow-50 border border-yellow-300 p-4 rounded-lg mb-6 flex justify-between items-center">
+    <p class="text-sm text-yellow-800">O servidor reiniciou no meio desta importação e algumas notas não foram lidas.</p>
+    <form action="{{ url_for('retomar_importacao_nfe', job_id=job.id) }}" method="POST">
+        <button type="submit" class="px-4 py-2 rounded-md bg-yellow-600 text-white font-semibold hover:bg-yellow-700">Tentar de novo</button>
+    </form>
+</div>
+{% endif %}
+<form action="{{ url_for('aplicar_importacao', job_id=job.id) }}" method="POST" class="space-y-6">
+    {% for nota in job.notas %}
+    {% set n = loop.index0 %}
+    <div class="bg-white rounded-lg shadow">
+        <div class="p-4 border-b flex justify-between items-center">
+            <div>
+                <div class="font-bold text-gray-800">{{ nota['itens'][0].fornecedor if nota['itens'] else 'Nota ' ~ (n + 1) }}</div>
+                <div class="font-mono text-xs text-gray-500 break-all">{{ nota.chave or nota.url }}</div>
+            </div>
+            <span class="px-2 py-1 text-xs rounded {% if nota.estado in ('ok', 'aplicada') %}bg-green-100 text-green-700{% else %}bg-gray-200 text-gray-700{% endif %}">{{ rotulos[nota.estado] }}</span>
+        </div>
+        {% if nota.erro %}<p class="px-4 py-2 text-sm text-red-600">{{ nota.erro }}</p>{% endif %}
+        {% if nota.estado == 'ok' %}
+        <table class="min-w-full text-sm">
+            <thead class="bg-gray-50">
+                <tr>
+                    <th class="px-3 py-2 text-left font-medium text-gray-600">Incluir</th>
+                    <th class="px-3 py-2 text-left font-medium text-gray-600">Item da nota</th>
+                    <th class="px-3 py-2 text-left font-medium text-gray-600">Produto no estoque</th>
+                    <th class="px-3 py-2 text-left font-medium text-gray-600">Qtd. na nota</th>
+                    <th class="px-3 py-2 text-left font-medium text-gray-600">Qtd. a adicionar</th>
+                </tr>
+            </thead>
+            <tbody class="divide-y divide-gray-200">
+                {% for item in nota['itens'] %}
+                <tr>
+                    {% if item.produto_id %}
+                    <td class="px-3 py-2"><input type="checkbox" name="sel_{{ n }}_{{ loop.index0 }}" checked class="h-4 w-4 text-green-600 border-gray-300 rounded"></td>
+                    <td class="px-3 py-2">{{ item.nome }}</td>
+                    <td class="px-3 py-2 font-medium text-gray-800">{{ nomes_produtos.get(item.produto_id, '(excluído)') }}</td>
+                    <td class="px-3 py-2">{{ item.quantidade }}</td>
+                    <td class="px-3 py-2"><input type="number" name="qtd_{{ n }}_{{ loop.index0 }}" value="{{ item.quantidade }}" min="0" class="w-24 border border-gray-300 rounded-md p-1 text-sm"></td>
+                    {% else %}
+                    <td class="px-3 py-2"></td>
+                    <td class="px-3 py-2">{{ item.nome }}</td>
+                    <td class="px-3 py-2 text-gray-500" colspan="3">Não cadastrado: cadastre pela tela de Estoque</td>
+                    {% endif %}
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        {% endif %}
+    </div>
+    {% endfor %}
+    {% if job.estado == 'concluido' %}
+    <div class="flex justify-end">
+        <button type="submit" class="px-6 py-2 rounded-md bg-green-600 text-white font-semibold hover:bg-green-700">Lançar itens selecionados no estoque</button>
+    </div>
+    {% endif %}
+</form>
+{% endif %}
 {% endblock %}
 """
 
@@ -917,195 +4286,183 @@ TEMPLATES = {
     'estoque': ESTOQUE_HTML,
     'caixa': CAIXA_HTML,
     'despesas': DESPESAS_HTML,
-    'relatorios': RELATORIOS_HTML
+    'relatorios': RELATORIOS_HTML,
+    'importar_nfe': IMPORTAR_NFE_HTML,
+    'importacao_nfe': IMPORTACAO_NFE_HTML
 }
 app.jinja_loader = DictLoader(TEMPLATES)
 
 # --- Rotas do Flask ---
 
-@app.route('/')
-def index():
-    init_db()
-    vendas = ler_csv('vendas')
-    despesas = ler_csv('despesas')
-    produtos = ler_csv('produtos')
-    
-    hoje = datetime.now().strftime('%Y-%m-%d')
-    mes_atual = datetime.now().strftime('%Y-%m')
-    
-    # --- Filtros para análise ---
-    # Padrão: primeiro e último dia do mês atual
+def filtros_painel(args):
+    """Filtros do dashboard a partir da query string; padrão é o mês atual."""
     primeiro_dia = datetime.now().replace(day=1).strftime('%Y-%m-%d')
     ultimo_dia = (datetime.now().replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
     ultimo_dia = ultimo_dia.strftime('%Y-%m-%d')
-    f_data_inicio = request.args.get('data_inicio') or primeiro_dia
-    f_data_fim = request.args.get('data_fim') or ultimo_dia
-    f_produto = request.args.get('produto') or ''
-    f_categoria = request.args.get('categoria') or ''
-
-    # Cálculos principais (sem filtro - visão geral)
-    vendas_hoje = sum(float(v['total_venda']) for v in vendas if v['data'].startswith(hoje))
-    lucro_mes = sum(float(v['lucro_estimado']) for v in vendas if v['data'].startswith(mes_atual))
-    despesas_mes = sum(float(d['valor']) for d in despesas if d['data'].startswith(mes_atual))
-
-    # --- Cálculos com filtro para os cards ---
-    produtos_dict = {p['id']: p for p in produtos}
-    produtos_dict_nome = {p['nome']: p for p in produtos}
-    # Vendas filtradas
-    vendas_filtradas = [
-        v for v in vendas
-        if v['data'] >= f_data_inicio and v['data'] <= f_data_fim
-        and (not f_produto or v.get('nome_produto') == f_produto)
-        and (not f_categoria or produtos_dict.get(v.get('id_produto'), {}).get('categoria', '') == f_categoria)
-    ]
-    # Vendas (total filtrado)
-    vendas_filtrado = sum(float(v['total_venda']) for v in vendas_filtradas)
-    # Lucro Estimado filtrado
-    lucro_filtrado = sum(float(v['lucro_estimado']) for v in vendas_filtradas)
-    # Despesas filtradas
-    despesas_filtradas = [
-        d for d in despesas
-        if d['data'] >= f_data_inicio and d['data'] <= f_data_fim
-        and (not f_categoria or d['categoria'] == f_categoria)
-    ]
-    despesas_filtrado = sum(float(d['valor']) for d in despesas_filtradas)
-
-    def dentro_periodo(data_str: str) -> bool:
-        if not (f_data_inicio or f_data_fim):
-            return True
-        data_dia = data_str[:10]
-        if f_data_inicio and data_dia < f_data_inicio:
-            return False
-        if f_data_fim and data_dia > f_data_fim:
-            return False
-        return True
+    filtros = {
+        'data_inicio': args.get('data_inicio') or primeiro_dia,
+        'data_fim': args.get('data_fim') or ultimo_dia,
+        'produto': args.get('produto') or '',
+        'categoria': args.get('categoria') or '',
+    }
+    try:
+        date.fromisoformat(filtros['data_inicio'])
+        date.fromisoformat(filtros['data_fim'])
+    except ValueError:
+        filtros['data_inicio'], filtros['data_fim'] = primeiro_dia, ultimo_dia
+    return filtros
 
-    # Aplicar filtros sobre vendas e despesas usados nos gráficos
-    vendas_filtradas = []
-    for v in vendas:
-        if f_produto and v['nome_produto'] != f_produto:
-            continue
-        if not dentro_periodo(v['data']):
-            continue
-        vendas_filtradas.append(v)
+def calcular_painel(filtros):
+    """Todos os números do dashboard, reaproveitados do cache quando possível.
 
-    despesas_filtradas = []
-    for d in despesas:
-        categoria = d.get('categoria', 'Outros') or 'Outros'
-        if f_categoria and categoria != f_categoria:
-            continue
-        if not dentro_periodo(d['data']):
-            continue
-        despesas_filtradas.append(d)
-
-    # --- Agregações para gráficos (dados filtrados) ---
-    # Vendas e lucro por dia
-    # Vendas e lucro por produto
-    vendas_por_produto = defaultdict(float)
-    lucro_por_produto = defaultdict(float)
-    for v in vendas_filtradas:
-        nome = v['nome_produto']
-        vendas_por_produto[nome] += float(v['total_venda'])
-        lucro_por_produto[nome] += float(v['lucro_estimado'])
-
-    produtos_labels = list(vendas_por_produto.keys())
-    produtos_vendas_valores = [round(vendas_por_produto[n], 2) for n in produtos_labels]
-    produtos_lucro_valores = [round(lucro_por_produto[n], 2) for n in produtos_labels]
-
-    # Despesas por categoria e por dia
-    despesas_por_categoria = defaultdict(float)
-    for d in despesas_filtradas:
-        data_dia = d['data'][:10]
-        valor = float(d['valor'])
-        categoria = d.get('categoria', 'Outros') or 'Outros'
-        despesas_por_categoria[categoria] += valor
-
-    despesas_cat_labels = list(despesas_por_categoria.keys())
-    despesas_cat_valores = [round(despesas_por_categoria[c], 2) for c in despesas_cat_labels]
+    O dicionário devolvido é compartilhado com o cache: não altere.
+    """
+    return cache_painel.obter(filtros, _calcular_painel)
+
+def _calcular_painel(filtros):
+    """Todos os números do dashboard, numa única passada pelos resumos.
+
+    Meses fechados entram pelo resumo mensal; só os abertos passam pelos
+    resumos diários.
+    """
+    agregador = AgregadorPainel(filtros['data_inicio'], filtros['data_fim'],
+                                filtros['produto'], filtros['categoria'])
+    inicio, fim = agregador.intervalo_necessario()
+    fechados = {}
+    for tipo in TABELAS_PARTICIONADAS:
+        fechados[tipo] = armazenamento.resumos_fechados(tipo, inicio, fim)
+        for resumo in fechados[tipo].values():
+            agregador.alimentar_mes_fechado(tipo, resumo)
+    agregador.alimentar_resumos(resumos_do_intervalo(inicio, fim), fechados)
+    return agregador.resultado()
+
+def estoque_painel():
+    """Gráfico de estoque e alerta de estoque baixo (abaixo do mínimo de cada produto)."""
+    produtos = ler_colunas('produtos')
+    estoque = estoque_atual()
+    nomes = produtos.textos['nome']
+    estoque_labels = [nomes[i] for i in produtos.colunas['nome']]
+    estoque_valores = [estoque.get(str(i), q) for i, q in zip(produtos.colunas['id'], produtos.colunas['quantidade'])]
+    return {'estoque_labels': estoque_labels, 'estoque_valores': estoque_valores,
+            'baixo_estoque': estoque_baixo()}
+
+# --- API do Dashboard ---
+# Cada bloco do dashboard tem seu endpoint JSON, com os mesmos filtros da
+# página, e a página os carrega depois de aparecer. O ETag sai da assinatura
+# das tabelas de que o bloco depende (mtime/tamanho do CSV ou versão no
+# SQLite), que vale para todos os workers: sem mudança, a resposta é um 304
+# sem recalcular nada. bloco -> (tabelas, campos de calcular_painel)
+WIDGETS_PAINEL = {
+    'cards': (('vendas', 'despesas'), ['vendas_hoje', 'lucro_mes', 'despesas_mes',
+                                       'vendas_filtrado', 'lucro_filtrado', 'despesas_filtrado']),
+    'evolucao': (('vendas',), ['evolucao_labels', 'evolucao_valores']),
+    'comparativo': (('vendas', 'despesas'), ['comparativo_labels', 'comparativo_vendas', 'comparativo_despesas']),
+    'vendas_produto': (('vendas',), ['produtos_labels', 'produtos_vendas_valores', 'produtos_lucro_valores']),
+    'despesas_categoria': (('despesas',), ['despesas_cat_labels', 'despesas_cat_valores']),
+    'estoque': (('produtos', 'movimentos'), None),
+}
+
+def etag_widget(widget, filtros):
+    tabelas = WIDGETS_PAINEL[widget][0]
+    assinaturas = [assinatura_tabela(tipo) for tipo in tabelas]
+    if 'movimentos' in tabelas:
+        assinaturas.append(_assinatura_arquivo(ESTOQUE_SNAPSHOT_FILE))
+    # O dia entra na conta: "hoje" e "mês atual" mudam sem mudar os dados
+    chave = (widget, sorted(filtros.items()), assinaturas, date.today().isoformat())
+    return hashlib.sha1(repr(chave).encode('utf-8')).hexdigest()[:24]
+
+@app.route('/api/estoque/baixo')
+def api_estoque_baixo():
+    """Produtos abaixo do estoque mínimo. Com ?limite=N, só os N primeiros
+    (por nome); ?limite=0 devolve só o total, que é o que o menu lateral usa."""
+    limite = request.args.get('limite', type=int)
+    if 'limite' in request.args and (limite is None or limite < 0):
+        return jsonify({'erro': 'limite deve ser um número inteiro maior ou igual a zero'}), 400
+    if limite == 0:
+        dados = {'total': total_estoque_baixo(), 'produtos': []}
+    else:
+        produtos = estoque_baixo()
+        dados = {'total': len(produtos), 'produtos': produtos[:limite] if limite else produtos}
+    etag = hashlib.sha1(repr(dados).encode('utf-8')).hexdigest()[:24]
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304)
+    else:
+        resposta = jsonify(dados)
+    resposta.set_etag(etag)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+@app.route('/api/painel/cache')
+def estatisticas_cache_painel():
+    """Acertos e falhas do cache do dashboard neste worker, para ajustar o limite."""
+    return jsonify(cache_painel.estatisticas())
+
+@app.route('/api/painel/<widget>')
+def widget_painel(widget):
+    if widget not in WIDGETS_PAINEL:
+        return jsonify({'erro': 'bloco desconhecido'}), 404
+    filtros = filtros_painel(request.args)
+    etag = etag_widget(widget, filtros)
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304)
+    elif widget == 'estoque':
+        resposta = jsonify(estoque_painel())
+    else:
+        painel = calcular_painel(filtros)
+        resposta = jsonify({campo: painel[campo] for campo in WIDGETS_PAINEL[widget][1]})
+    resposta.set_etag(etag)
+    # O navegador guarda a resposta, mas sempre confere o ETag antes de usar
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+@app.route('/')
+def index():
+    produtos = ler_colunas('produtos')
+    filtros = filtros_painel(request.args)
 
     # --- Opções para filtros (todos os produtos e categorias cadastrados) ---
-    produtos_opcoes = sorted(set(p['nome'] for p in produtos))
-    categorias_opcoes = sorted(set(d.get('categoria', 'Outros') for d in despesas))
-    # Evolução de Vendas no Tempo (agrupar por dia/semana/mês conforme filtro)
-    evolucao_dict = defaultdict(float)
-    for v in vendas_filtradas:
-        # Define o nível de agrupamento conforme o intervalo de datas
-        delta = datetime.strptime(f_data_fim, '%Y-%m-%d') - datetime.strptime(f_data_inicio, '%Y-%m-%d')
-        if delta.days <= 31:
-            chave = v['data'][:10]  # dia
-        elif delta.days <= 90:
-            # semana (YYYY-WW)
-            data_obj = datetime.strptime(v['data'][:10], '%Y-%m-%d')
-            chave = f"{data_obj.year}-{data_obj.isocalendar()[1]:02d}"
-        else:
-            chave = v['data'][:7]  # mês
-        evolucao_dict[chave] += float(v['total_venda'])
-    evolucao_labels = sorted(evolucao_dict.keys())
-    evolucao_valores = [round(evolucao_dict[d], 2) for d in evolucao_labels]
-
-    # Comparativo Mensal: Vendas vs Despesas (últimos 12 meses)
-    from datetime import date
-    hoje = date.today()
-    comparativo_labels = []
-    comparativo_vendas = []
-    comparativo_despesas = []
-    for i in range(11, -1, -1):
-        mes = (hoje.month - i - 1) % 12 + 1
-        ano = hoje.year - (1 if hoje.month - i - 1 < 0 else 0)
-        mes_str = f"{ano}-{mes:02d}"
-        comparativo_labels.append(datetime(ano, mes, 1).strftime('%b/%Y'))
-        total_vendas_mes = sum(float(v['total_venda']) for v in vendas if v['data'].startswith(mes_str))
-        total_despesas_mes = sum(float(d['valor']) for d in despesas if d['data'].startswith(mes_str))
-        comparativo_vendas.append(round(total_vendas_mes, 2))
-        comparativo_despesas.append(round(total_despesas_mes, 2))
-
-    # Estoque por produto
-    estoque_labels = [p['nome'] for p in produtos]
-    estoque_valores = [int(p['quantidade']) for p in produtos]
-    
-    # Alerta de estoque (menos de 5 unidades)
-    baixo_estoque = [p for p in produtos if int(p['quantidade']) < 5]
-    
+    produtos_opcoes = sorted(produtos.textos['nome'])
+    categorias_opcoes = categorias_despesas()
+
     # Formatação da data para o header
     data_formatada = datetime.now().strftime('%d/%m/%Y')
-    
-    # Renderizar via Loader (CORREÇÃO)
-    return render_template('dashboard', 
-                                titulo="Painel Geral", 
+
+    # Só a moldura: cards e gráficos vêm de /api/painel/<bloco>, carregados pela página
+    return render_template('dashboard',
+                                titulo="Painel Geral",
                                 data_hoje=data_formatada,
-                                vendas_hoje=vendas_hoje,
-                                vendas_filtrado=vendas_filtrado,
-                                lucro_mes=lucro_mes,
-                                despesas_mes=despesas_mes,
-                                lucro_filtrado=lucro_filtrado,
-                                despesas_filtrado=despesas_filtrado,
-                                data_inicio_padrao=primeiro_dia,
-                                data_fim_padrao=ultimo_dia,
-                                baixo_estoque=baixo_estoque,
+                                data_inicio_padrao=filtros_painel({})['data_inicio'],
+                                data_fim_padrao=filtros_painel({})['data_fim'],
+                                filtros=filtros,
                                 active_page='dashboard',
-                                produtos_labels=produtos_labels,
-                                produtos_vendas_valores=produtos_vendas_valores,
-                                produtos_lucro_valores=produtos_lucro_valores,
-                                despesas_cat_labels=despesas_cat_labels,
-                                despesas_cat_valores=despesas_cat_valores,
-                                estoque_labels=estoque_labels,
-                                estoque_valores=estoque_valores,
-                                evolucao_labels=evolucao_labels,
-                                evolucao_valores=evolucao_valores,
-                                comparativo_labels=comparativo_labels,
-                                comparativo_vendas=comparativo_vendas,
-                                comparativo_despesas=comparativo_despesas,
                                 produtos_opcoes=produtos_opcoes,
                                 categorias_opcoes=categorias_opcoes)
 
+ORDENS_ESTOQUE = ('id', 'nome', 'quantidade', 'fornecedor', 'margem')
+POR_PAGINA_ESTOQUE = 50
+
+def pagina_estoque(args):
+    """Variáveis da tabela de estoque (página, busca e ordem) a partir da query string."""
+    busca = (args.get('busca') or '').strip()
+    ordem = args.get('ordem') if args.get('ordem') in ORDENS_ESTOQUE else 'id'
+    direcao = 'desc' if args.get('direcao') == 'desc' else 'asc'
+    pagina = max(1, _inteiro(args.get('pagina') or 1))
+    produtos, total = pagina_catalogo(busca, ordem, direcao == 'desc', pagina, POR_PAGINA_ESTOQUE)
+    paginas = max(1, -(-total // POR_PAGINA_ESTOQUE))
+    if pagina > paginas:
+        pagina = paginas
+        produtos, total = pagina_catalogo(busca, ordem, direcao == 'desc', pagina, POR_PAGINA_ESTOQUE)
+    return {'produtos': produtos, 'total_produtos': total, 'pagina': pagina, 'paginas': paginas,
+            'busca': busca, 'ordem': ordem, 'direcao': direcao,
+            'estoque_minimo_padrao': ESTOQUE_MINIMO_PADRAO}
+
 @app.route('/estoque')
 def estoque():
-    produtos = ler_csv('produtos')
     data_formatada = datetime.now().strftime('%d/%m/%Y')
     return render_template('estoque', 
                                 titulo="Gerenciar Estoque",
                                 data_hoje=data_formatada,
-                                produtos=produtos,
+                                **pagina_estoque(request.args),
                                 active_page='estoque',
                                 form_data=None,
                                 nfe_itens_existentes=None)
@@ -1123,11 +4480,25 @@ def adicionar_produto():
         qtd_str = request.form.get('quantidade', '')
         fornecedor = request.form.get('fornecedor', '')
         url_nfe = request.form.get('url_nfe', '').strip()
-        from json import dumps
-        itens = extrair_itens_nfe(url_nfe) if url_nfe else []
+        # A mesma nota não pode entrar duas vezes no estoque
+        nfe_chave = chave_nfe(url_nfe)
+        aplicadas = etapas_aplicadas(nfe_chave)
+        if aplicadas:
+            flash(f'Esta NFC-e já foi lançada no estoque em {min(aplicadas.values())}. '
+                  'Para corrigir quantidades, use o ajuste de estoque.', 'error')
+            return redirect(url_for('estoque'))
+        itens = []
+        erro_nfe = 'Não foi possível ler os dados da NFC-e. Confira a URL ou preencha manualmente.'
+        try:
+            itens = cliente_nfe.extrair(url_nfe) if url_nfe else []
+        except ErroBuscaNFe as e:
+            app.logger.warning('Falha ao baixar NFC-e: %s', e)
+            erro_nfe = 'Não foi possível acessar a página da NFC-e (SEFAZ fora do ar ou sem conexão). Tente de novo ou preencha manualmente.'
+        except ErroLeituraNFe as e:
+            app.logger.warning('NFC-e sem itens legíveis: %s', e)
+            erro_nfe = 'A página aberta não trouxe a lista de itens da NFC-e. Confira a URL ou preencha manualmente.'
         if not itens:
-            flash('Não foi possível ler os dados da NFC-e. Confira a URL ou preencha manualmente.', 'error')
-            produtos = ler_csv('produtos')
+            flash(erro_nfe, 'error')
             data_formatada = datetime.now().strftime('%d/%m/%Y')
             form_data = {
                 'nome': nome,
@@ -1135,41 +4506,38 @@ def adicionar_produto():
                 'preco_venda': venda_str,
                 'quantidade': qtd_str,
                 'fornecedor': fornecedor,
+                'estoque_minimo': request.form.get('estoque_minimo', ''),
                 'url_nfe': url_nfe
             }
             return render_template('estoque',
                                    titulo="Gerenciar Estoque",
                                    data_hoje=data_formatada,
-                                   produtos=produtos,
+                                   **pagina_estoque({}),
                                    active_page='estoque',
                                    form_data=form_data,
                                    nfe_itens_existentes=None)
 
-        produtos = ler_csv('produtos')
+        indice = indice_catalogo()
+        busca_aproximada = bool(request.form.get('busca_aproximada'))
         itens_existentes = []
-        for item in itens:
-            nome_item = item['nome'].strip().lower()
-            produto = next((p for p in produtos if p['nome'].strip().lower() == nome_item), None)
-            if produto:
-                try:
-                    estoque_atual = int(produto.get('quantidade', 0))
-                except ValueError:
-                    estoque_atual = 0
-                itens_existentes.append({
-                    'nome': item['nome'],
-                    'quantidade_nota': item['quantidade'],
-                    'custo': item['custo'],
-                    'fornecedor': item['fornecedor'],
-                    'estoque_atual': estoque_atual
-                })
-
-        # Determina quais itens são novos
         itens_novos = []
+        # Uma consulta ao índice por item separa existentes de novos
         for item in itens:
-            nome_item = item['nome'].strip().lower()
-            produto = next((p for p in produtos if p['nome'].strip().lower() == nome_item), None)
-            if not produto:
+            ids = indice.buscar(item['nome'])
+            if not ids:
+                if busca_aproximada:
+                    item['sugestoes'] = [nome for _, nome, _ in indice.sugerir(item['nome'])]
                 itens_novos.append(item)
+                continue
+            produto = buscar_produto(ids[0])
+            itens_existentes.append({
+                'nome': item['nome'],
+                'produto_id': produto['id'],
+                'quantidade_nota': item['quantidade'],
+                'custo': item['custo'],
+                'fornecedor': item['fornecedor'],
+                'estoque_atual': produto['quantidade']
+            })
 
         data_formatada = datetime.now().strftime('%d/%m/%Y')
 
@@ -1184,126 +4552,110 @@ def adicionar_produto():
                     'preco_venda': venda_str,
                     'quantidade': primeiro['quantidade'] or qtd_str,
                     'fornecedor': primeiro['fornecedor'] or fornecedor,
+                    'estoque_minimo': request.form.get('estoque_minimo', ''),
                     'url_nfe': url_nfe
                 }
                 flash('Dados preenchidos a partir da NFC-e. Confira e informe o preço de venda.', 'success')
                 return render_template('estoque',
                                        titulo="Gerenciar Estoque",
                                        data_hoje=data_formatada,
-                                       produtos=produtos,
+                                       **pagina_estoque({}),
                                        active_page='estoque',
                                        form_data=form_data,
                                        nfe_itens_existentes=None)
             else:
                 # Múltiplos itens novos: abrir modal de cadastro em lote
-                data_formatada = datetime.now().strftime('%d/%m/%Y')
-                produtos = ler_csv('produtos')
-                nfe_json_novos = dumps(itens)
+                nfe_token = criar_sessao_nfce(url_nfe, nfe_chave, [], itens)
                 return render_template('estoque',
                                        titulo="Gerenciar Estoque",
                                        data_hoje=data_formatada,
-                                       produtos=produtos,
+                                       **pagina_estoque({}),
                                        active_page='estoque',
                                        form_data=None,
                                        nfe_itens_existentes=None,
                                        nfe_itens_novos=itens,
-                                       nfe_json_novos=nfe_json_novos)
+                                       nfe_token=nfe_token)
 
         # Há itens já cadastrados: abrir modal de confirmação múltipla
         flash('Foram encontrados itens já cadastrados. Confirme a quantidade a adicionar ao estoque.', 'info')
-        # Monta payload com existentes e novos para ser lido após a confirmação
-        payload = {
-            'itens_existentes': itens_existentes,
-            'itens_novos': itens_novos
-        }
-        nfe_json = dumps(payload)
+        # Existentes e novos ficam na sessão para os passos de confirmação
+        nfe_token = criar_sessao_nfce(url_nfe, nfe_chave, itens_existentes, itens_novos)
         return render_template('estoque',
                                titulo="Gerenciar Estoque",
                                data_hoje=data_formatada,
-                               produtos=produtos,
+                               **pagina_estoque({}),
                                active_page='estoque',
                                form_data=None,
                                nfe_itens_existentes=itens_existentes,
-                               nfe_json=nfe_json)
+                               nfe_token=nfe_token)
 
     # Confirmação em lote de itens existentes vindos de NFC-e
     if acao == 'confirmar_itens_existentes':
-        produtos = ler_csv('produtos')
-        from json import loads, dumps
-        try:
-            payload = loads(request.form.get('nfe_json', '{}'))
-            itens_existentes = payload.get('itens_existentes', [])
-            itens_novos = payload.get('itens_novos', [])
-        except Exception as e:
-            print(f'Erro ao decodificar nfe_json: {e}')
-            itens_existentes = []
-            itens_novos = []
-
-        print(f'itens_existentes recebidos: {itens_existentes}')
-        print(f'Form fields: {list(request.form.keys())}')
+        nfe_token = request.form.get('nfe_token', '')
+        sessao = carregar_sessao_nfce(nfe_token)
+        if sessao is None:
+            flash('A importação desta NFC-e expirou. Leia a nota de novo.', 'error')
+            return redirect(url_for('estoque'))
+        itens_existentes = sessao['itens_existentes']
+        itens_novos = sessao['itens_novos']
 
         if not itens_existentes:
             flash('Nenhum item para atualizar.', 'error')
             return redirect(url_for('estoque'))
 
-        # Para cada item existente, verificar se foi selecionado e qual quantidade adicionar
-        for idx, item in enumerate(itens_existentes):
-            sel_key = f'sel_{idx}'
-            qtd_key = f'qtd_{idx}'
-            print(f'Verificando item {idx}: sel_key={sel_key} in form? {sel_key in request.form}')
-            if sel_key not in request.form:
-                continue
-            nome_item = item['nome']
-            qtd_add_str = request.form.get(qtd_key, str(item.get('quantidade_nota', 0)))
-            try:
-                qtd_add = int(qtd_add_str)
-            except ValueError:
-                qtd_add = int(item.get('quantidade_nota', 0) or 0)
-
-            print(f'Item {nome_item}: vai adicionar {qtd_add} ao estoque')
-
-            for p in produtos:
-                if p['nome'].strip().lower() == nome_item.strip().lower():
-                    try:
-                        estoque_atual = int(p.get('quantidade', 0))
-                    except ValueError:
-                        estoque_atual = 0
-                    p['quantidade'] = estoque_atual + qtd_add
-                    print(f'Estoque de {nome_item}: {estoque_atual} -> {p["quantidade"]}')
-
-        print('Salvando produtos...')
-        escrever_csv('produtos', produtos, mode='w')
-        flash('Estoque atualizado para os itens selecionados da NFC-e.', 'success')
+        nfe_chave = sessao['chave']
+        with trava_dados():
+            # Conferido sob a trava: um duplo clique ou outro operador não lança a nota duas vezes
+            if 'existentes' in etapas_aplicadas(nfe_chave):
+                flash('Esta NFC-e já foi lançada no estoque.', 'error')
+                return redirect(url_for('estoque'))
+            # Cada item selecionado vira um movimento de entrada; produtos.csv não é reescrito
+            movimentos = []
+            for idx, item in enumerate(itens_existentes):
+                if f'sel_{idx}' not in request.form:
+                    continue
+                try:
+                    qtd_add = int(request.form.get(f'qtd_{idx}', item.get('quantidade_nota', 0)))
+                except ValueError:
+                    qtd_add = int(item.get('quantidade_nota', 0) or 0)
+                # Só o produto conciliado na leitura da nota, e se ainda existir
+                if buscar_produto(item['produto_id']) is not None:
+                    movimentos.append((item['produto_id'], qtd_add, 'nfce', nfe_chave))
+            app.logger.info('NFC-e %s: %d entradas de estoque', nfe_chave or sessao['url'], len(movimentos))
+            registro = [registro_nfce_aplicada(nfe_chave, 'existentes', len(movimentos))] if nfe_chave else []
+            if nfe_chave and not itens_novos:
+                registro.append(registro_nfce_aplicada(nfe_chave, ETAPA_FINAL_NFCE, 0))
+            movimentar_estoque(movimentos, registro)
+            flash('Estoque atualizado para os itens selecionados da NFC-e.', 'success')
         # Se houver itens novos, abrir modal de cadastro
         if itens_novos:
             data_formatada = datetime.now().strftime('%d/%m/%Y')
-            produtos = ler_csv('produtos')
-            nfe_json_novos = dumps(itens_novos)
             return render_template('estoque',
                                    titulo="Gerenciar Estoque",
                                    data_hoje=data_formatada,
-                                   produtos=produtos,
+                                   **pagina_estoque({}),
                                    active_page='estoque',
                                    form_data=None,
                                    nfe_itens_existentes=None,
                                    nfe_itens_novos=itens_novos,
-                                   nfe_json_novos=nfe_json_novos)
+                                   nfe_token=nfe_token)
+        encerrar_sessao_nfce(nfe_token)
         return redirect(url_for('estoque'))
 
     # Cadastro em lote de itens novos vindos de NFC-e
     if acao == 'confirmar_itens_novos':
-        from json import loads
-        try:
-            itens_novos = loads(request.form.get('nfe_json_novos', '[]'))
-        except Exception as e:
-            print(f'Erro ao decodificar nfe_json_novos: {e}')
-            itens_novos = []
+        nfe_token = request.form.get('nfe_token', '')
+        sessao = carregar_sessao_nfce(nfe_token)
+        if sessao is None:
+            flash('A importação desta NFC-e expirou. Leia a nota de novo.', 'error')
+            return redirect(url_for('estoque'))
+        itens_novos = sessao['itens_novos']
 
         if not itens_novos:
             flash('Nenhum item novo para cadastrar.', 'error')
             return redirect(url_for('estoque'))
 
-        produtos = ler_csv('produtos')
+        novos_produtos = []
         for idx, item in enumerate(itens_novos):
             nome = request.form.get(f'nome_{idx}', '').strip()
             custo_str = request.form.get(f'custo_{idx}', '')
@@ -1327,17 +4679,29 @@ def adicionar_produto():
                 flash(f'Item {nome}: preço de venda deve ser maior que o custo.', 'error')
                 return redirect(url_for('estoque'))
 
-            novo_prod = {
-                'id': gerar_id('produtos'),
+            novos_produtos.append({
                 'nome': nome,
                 'custo': custo,
                 'preco_venda': venda,
                 'quantidade': qtd,
                 'fornecedor': fornecedor
-            }
-            produtos.append(novo_prod)
+            })
 
-        escrever_csv('produtos', produtos, mode='w')
+        nfe_chave = sessao['chave']
+        with trava_dados():
+            if 'novos' in etapas_aplicadas(nfe_chave):
+                flash('Os itens novos desta NFC-e já foram cadastrados.', 'error')
+                return redirect(url_for('estoque'))
+            # Um bloco de ids para o lote inteiro
+            produtos = ler_csv('produtos')
+            for novo_id, novo_prod in zip(reservar_ids('produtos', len(novos_produtos)), novos_produtos):
+                produtos.append({'id': novo_id, **novo_prod})
+
+            operacoes = [('produtos', 'w', produtos)]
+            if nfe_chave:
+                operacoes.append(registro_nfce_aplicada(nfe_chave, 'novos', len(novos_produtos)))
+            gravar_em_lote(operacoes)
+        encerrar_sessao_nfce(nfe_token)
         flash('Novos produtos cadastrados a partir da NFC-e.', 'success')
         return redirect(url_for('estoque'))
 
@@ -1349,6 +4713,7 @@ def adicionar_produto():
         venda_str = request.form.get('preco_venda', '')
         qtd_str = request.form.get('quantidade', '')
         fornecedor = request.form.get('fornecedor', '')
+        minimo = ler_estoque_minimo(request.form.get('estoque_minimo', ''))
         url_nfe = request.form.get('url_nfe', '').strip()
         try:
             custo = float(custo_str) if custo_str else 0.0
@@ -1367,17 +4732,24 @@ def adicionar_produto():
             flash('Erro: O preço de venda deve ser maior que o custo!', 'error')
             return redirect(url_for('estoque'))
 
-        novo_prod = {
-            'id': gerar_id('produtos'),
-            'nome': nome,
-            'custo': custo,
-            'preco_venda': venda,
-            'quantidade': qtd,
-            'fornecedor': fornecedor
-        }
-        produtos = ler_csv('produtos')
-        produtos.append(novo_prod)
-        escrever_csv('produtos', produtos, mode='w')
+        with trava_dados():
+            novo_prod = {
+                'id': gerar_id('produtos'),
+                'nome': nome,
+                'custo': custo,
+                'preco_venda': venda,
+                'quantidade': qtd,
+                'fornecedor': fornecedor,
+                'estoque_minimo': minimo
+            }
+            produtos = ler_csv('produtos')
+            produtos.append(novo_prod)
+            operacoes = [('produtos', 'w', produtos)]
+            # Cadastro preenchido por uma NFC-e de item único: a nota fica marcada como lançada
+            nfe_chave = chave_nfe(url_nfe)
+            if nfe_chave and not etapas_aplicadas(nfe_chave):
+                operacoes.append(registro_nfce_aplicada(nfe_chave, 'novos', 1))
+            gravar_em_lote(operacoes)
         flash('Produto cadastrado com sucesso!', 'success')
         return redirect(url_for('estoque'))
 
@@ -1392,6 +4764,7 @@ def editar_produto():
     venda_str = request.form.get('preco_venda')
     qtd_str = request.form.get('quantidade')
     fornecedor = request.form.get('fornecedor', '').strip()
+    minimo = ler_estoque_minimo(request.form.get('estoque_minimo', ''))
     try:
         custo = float(custo_str) if custo_str else 0.0
     except ValueError:
@@ -1409,25 +4782,31 @@ def editar_produto():
         flash('Erro: O preço de venda deve ser maior que o custo!', 'error')
         return redirect(url_for('estoque'))
 
-    produtos = ler_csv('produtos')
-    for p in produtos:
-        if p['id'] == prod_id:
-            p['nome'] = nome
-            p['custo'] = custo
-            p['preco_venda'] = venda
-            p['quantidade'] = qtd
-            p['fornecedor'] = fornecedor
-            break
-    escrever_csv('produtos', produtos, mode='w')
+    with trava_dados():
+        produtos = ler_csv('produtos')
+        for p in produtos:
+            if p['id'] == prod_id:
+                p['nome'] = nome
+                p['custo'] = custo
+                p['preco_venda'] = venda
+                p['fornecedor'] = fornecedor
+                p['estoque_minimo'] = minimo
+                break
+        # A quantidade do catálogo fica como está: a diferença vira um ajuste no ledger
+        estoque = estoque_atual()
+        delta = qtd - estoque.get(prod_id, qtd)
+        movimentos = [(prod_id, delta, 'ajuste', 'edicao')] if delta else []
+        movimentar_estoque(movimentos, [('produtos', 'w', produtos)])
     flash('Produto atualizado com sucesso!', 'success')
     return redirect(url_for('estoque'))
 
 @app.route('/excluir_produto', methods=['POST'])
 def excluir_produto():
     prod_id = request.form.get('id')
-    produtos = ler_csv('produtos')
-    produtos = [p for p in produtos if p['id'] != prod_id]
-    escrever_csv('produtos', produtos, mode='w')
+    with trava_dados():
+        produtos = ler_csv('produtos')
+        produtos = [p for p in produtos if p['id'] != prod_id]
+        escrever_csv('produtos', produtos, mode='w')
     flash('Produto excluído com sucesso!', 'success')
     return redirect(url_for('estoque'))
 
@@ -1436,31 +4815,40 @@ def atualizar_estoque():
     prod_id = request.form['id']
     qtd_add = int(request.form['qtd_add'])
     
-    produtos = ler_csv('produtos')
-    for p in produtos:
-        if p['id'] == prod_id:
-            p['quantidade'] = int(p['quantidade']) + qtd_add
-            break
-            
-    escrever_csv('produtos', produtos, mode='w') # Reescreve tudo com a nova qtd
+    if prod_id in estoque_atual():
+        movimentar_estoque([(prod_id, qtd_add, 'ajuste', 'manual')])
     flash('Estoque atualizado!', 'success')
     return redirect(url_for('estoque'))
 
 @app.route('/caixa')
 def caixa():
-    produtos = ler_csv('produtos')
-    vendas = ler_csv('vendas')
-    # Pegar as ultimas 10 vendas invertidas
-    ultimas_vendas = sorted(vendas, key=lambda x: x['id'], reverse=True)[:10]
-    
+    # As 10 últimas vendas, lidas do fim do arquivo sem carregar o histórico
+    ultimas_vendas = armazenamento.ultimas('vendas', 10)
+
     data_formatada = datetime.now().strftime('%d/%m/%Y')
     return render_template('caixa', 
                                 titulo="Ponto de Venda",
                                 data_hoje=data_formatada,
-                                produtos=produtos,
                                 ultimas_vendas=ultimas_vendas,
                                 active_page='caixa')
 
+LIMITE_BUSCA_PRODUTOS = 50
+
+@app.route('/api/produtos/busca')
+def buscar_produtos():
+    """Autocompletar do caixa: até 'limite' produtos por nome ou id, com preço e estoque."""
+    texto = request.args.get('q', '')
+    limite = min(max(_inteiro(request.args.get('limite') or 10), 1), LIMITE_BUSCA_PRODUTOS)
+    with _cache_lock:
+        aceitar = None
+        if request.args.get('disponiveis') == '1':
+            estoque = estoque_atual()
+            aceitar = lambda prod_id: estoque.get(prod_id, 0) > 0
+        ids = indice_catalogo().autocompletar(texto, limite, aceitar)
+        produtos = [buscar_produto(prod_id) for prod_id in ids]
+    return jsonify([{'id': p['id'], 'nome': p['nome'], 'preco_venda': _centavos(p['preco_venda']) / 100,
+                     'quantidade': p['quantidade']} for p in produtos if p])
+
 @app.route('/registrar_venda', methods=['POST'])
 def registrar_venda():
     prod_id = request.form.get('produto_id')
@@ -1470,53 +4858,227 @@ def registrar_venda():
         flash('Selecione um produto!', 'error')
         return redirect(url_for('caixa'))
 
-    produtos = ler_csv('produtos')
-    produto_selecionado = None
-    
-    # Validar e atualizar estoque
-    for p in produtos:
-        if p['id'] == prod_id:
-            if int(p['quantidade']) < qtd_venda:
-                flash(f'Erro: Estoque insuficiente! Disponível: {p["quantidade"]}', 'error')
-                return redirect(url_for('caixa'))
+    with trava_dados():
+        produto_selecionado = buscar_produto(prod_id)
+
+        # Validar estoque
+        if produto_selecionado and produto_selecionado['quantidade'] < qtd_venda:
+            flash(f'Erro: Estoque insuficiente! Disponível: {produto_selecionado["quantidade"]}', 'error')
+            return redirect(url_for('caixa'))
+
+        if produto_selecionado:
+            # Calcular valores
+            total_venda = float(produto_selecionado['preco_venda']) * qtd_venda
+            lucro = (float(produto_selecionado['preco_venda']) - float(produto_selecionado['custo'])) * qtd_venda
             
-            p['quantidade'] = int(p['quantidade']) - qtd_venda
-            produto_selecionado = p
-            break
-    
-    if produto_selecionado:
-        # Gravar atualização de estoque
-        escrever_csv('produtos', produtos, mode='w')
-        
-        # Calcular valores
-        total_venda = float(produto_selecionado['preco_venda']) * qtd_venda
-        lucro = (float(produto_selecionado['preco_venda']) - float(produto_selecionado['custo'])) * qtd_venda
-        
-        # Registrar Venda
-        nova_venda = {
-            'id': gerar_id('vendas'),
-            'data': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'produto_id': prod_id,
-            'nome_produto': produto_selecionado['nome'],
-            'quantidade': qtd_venda,
-            'total_venda': f"{total_venda:.2f}",
-            'lucro_estimado': f"{lucro:.2f}"
-        }
-        escrever_csv('vendas', nova_venda, mode='a')
-        flash(f'Venda de R$ {total_venda:.2f} registrada!', 'success')
+            # Registrar Venda
+            nova_venda = {
+                'id': gerar_id('vendas'),
+                'data': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'produto_id': prod_id,
+                'nome_produto': produto_selecionado['nome'],
+                'quantidade': qtd_venda,
+                'total_venda': f"{total_venda:.2f}",
+                'lucro_estimado': f"{lucro:.2f}",
+                'ticket_id': gerar_id('tickets')
+            }
+            # Baixa de estoque (um movimento) e venda gravadas num único commit
+            movimentar_estoque([(prod_id, -qtd_venda, 'venda', str(nova_venda['id']))],
+                               [('vendas', 'a', nova_venda)])
+            flash(f'Venda de R$ {total_venda:.2f} registrada!', 'success')
     
     return redirect(url_for('caixa'))
 
+@app.route('/finalizar_carrinho', methods=['POST'])
+def finalizar_carrinho():
+    """Fecha o carrinho do caixa: todas as linhas num único commit e num mesmo ticket."""
+    ids = request.form.getlist('produto_id')
+    qtds = request.form.getlist('quantidade')
+    carrinho = defaultdict(int)
+    try:
+        for prod_id, qtd_str in zip(ids, qtds):
+            qtd = int(qtd_str)
+            if prod_id and qtd > 0:
+                carrinho[prod_id] += qtd
+    except ValueError:
+        flash('Quantidade inválida no carrinho.', 'error')
+        return redirect(url_for('caixa'))
+    if not carrinho:
+        flash('O carrinho está vazio!', 'error')
+        return redirect(url_for('caixa'))
+
+    with trava_dados():
+        produtos_por_id = {prod_id: buscar_produto(prod_id) for prod_id in carrinho}
+
+        # Valida todas as linhas antes de gravar qualquer coisa
+        desconhecidos = [prod_id for prod_id, p in produtos_por_id.items() if p is None]
+        if desconhecidos:
+            # Excluído depois de entrar no carrinho, ou id que nunca existiu
+            flash('Erro: produto não encontrado (código ' + ', '.join(desconhecidos) + '). '
+                  'Ele pode ter sido excluído; remova-o do carrinho.', 'error')
+            return redirect(url_for('caixa'))
+        erros = [f'{p["nome"]} (disponível: {p["quantidade"]})'
+                 for prod_id, p in produtos_por_id.items() if p['quantidade'] < carrinho[prod_id]]
+        if erros:
+            flash('Erro: Estoque insuficiente! ' + '; '.join(erros), 'error')
+            return redirect(url_for('caixa'))
+
+        ticket_id = gerar_id('tickets')
+        agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        novas_vendas = []
+        movimentos = []
+        total_ticket = 0.0
+        for venda_id, (prod_id, qtd) in zip(reservar_ids('vendas', len(carrinho)), carrinho.items()):
+            p = produtos_por_id[prod_id]
+            movimentos.append((prod_id, -qtd, 'venda', str(venda_id)))
+            total_venda = float(p['preco_venda']) * qtd
+            lucro = (float(p['preco_venda']) - float(p['custo'])) * qtd
+            total_ticket += total_venda
+            novas_vendas.append({
+                'id': venda_id,
+                'data': agora,
+                'produto_id': prod_id,
+                'nome_produto': p['nome'],
+                'quantidade': qtd,
+                'total_venda': f"{total_venda:.2f}",
+                'lucro_estimado': f"{lucro:.2f}",
+                'ticket_id': ticket_id
+            })
+
+        # Movimentos de estoque e vendas anexados no mesmo commit
+        movimentar_estoque(movimentos, [('vendas', 'a', v) for v in novas_vendas])
+    flash(f'Venda #{ticket_id} de R$ {total_ticket:.2f} registrada ({len(novas_vendas)} itens)!', 'success')
+    return redirect(url_for('caixa'))
+
+@app.route('/importar_nfe', methods=['GET', 'POST'])
+def importar_nfe():
+    if request.method == 'POST':
+        texto = request.form.get('urls', '')
+        arquivo = request.files.get('arquivo')
+        if arquivo and arquivo.filename:
+            texto += '\n' + arquivo.read().decode('utf-8', errors='replace')
+        urls = urls_de_texto(texto)
+        if not urls:
+            flash('Nenhuma URL de NFC-e encontrada no texto ou arquivo.', 'error')
+            return redirect(url_for('importar_nfe'))
+        if len(urls) > MAX_NOTAS_IMPORTACAO:
+            flash(f'Importe no máximo {MAX_NOTAS_IMPORTACAO} notas por vez.', 'error')
+            return redirect(url_for('importar_nfe'))
+        job_id = criar_importacao(urls)
+        return redirect(url_for('ver_importacao', job_id=job_id))
+
+    data_formatada = datetime.now().strftime('%d/%m/%Y')
+    return render_template('importar_nfe',
+                           titulo="Importar NFC-e",
+                           data_hoje=data_formatada,
+                           importacoes=listar_importacoes(),
+                           active_page='importar_nfe')
+
+@app.route('/importar_nfe/<job_id>')
+def ver_importacao(job_id):
+    job = carregar_importacao(job_id)
+    if job is None:
+        flash('Importação não encontrada (ela expira depois de 7 dias).', 'error')
+        return redirect(url_for('importar_nfe'))
+    nomes_produtos = {p['id']: p['nome'] for p in ler_csv('produtos')}
+    data_formatada = datetime.now().strftime('%d/%m/%Y')
+    return render_template('importacao_nfe',
+                           titulo="Importar NFC-e",
+                           data_hoje=data_formatada,
+                           job=job,
+                           nomes_produtos=nomes_produtos,
+                           active_page='importar_nfe')
+
+@app.route('/importar_nfe/<job_id>/status')
+def status_importacao(job_id):
+    job = carregar_importacao(job_id)
+    if job is None:
+        return jsonify({'erro': 'importação não encontrada'}), 404
+    return jsonify(resumo_importacao(job))
+
+@app.route('/importar_nfe/<job_id>/retomar', methods=['POST'])
+def retomar_importacao_nfe(job_id):
+    if not retomar_importacao(job_id):
+        flash('Só uma importação interrompida pode ser retomada.', 'error')
+    return redirect(url_for('ver_importacao', job_id=job_id))
+
+@app.route('/importar_nfe/<job_id>/aplicar', methods=['POST'])
+def aplicar_importacao(job_id):
+    """Lança no estoque as entradas confirmadas de todas as notas num único commit."""
+    with trava_dados():
+        job = carregar_importacao(job_id)
+        if job is None:
+            flash('Importação não encontrada (ela expira depois de 7 dias).', 'error')
+            return redirect(url_for('importar_nfe'))
+        if job['estado'] != 'concluido':
+            flash('Esta importação ainda está lendo as notas, foi interrompida ou já foi lançada.', 'error')
+            return redirect(url_for('ver_importacao', job_id=job_id))
+
+        # Uma nota pela metade pode ser revisada de novo, mas a entrada dos
+        # itens existentes dela já foi feita e não se repete
+        aplicadas = _chaves_aplicadas() | _chaves_com_entrada()
+        estoque = estoque_atual()
+        movimentos = []
+        registros = []
+        for n, nota in enumerate(job['notas']):
+            if nota['estado'] != 'ok':
+                continue
+            if nota['chave'] in aplicadas:
+                nota['estado'] = 'ja_aplicada'
+                continue
+            entradas = []
+            for i, item in enumerate(nota['itens']):
+                if item.get('produto_id') not in estoque or f'sel_{n}_{i}' not in request.form:
+                    continue
+                try:
+                    qtd = int(request.form.get(f'qtd_{n}_{i}', item['quantidade']))
+                except ValueError:
+                    qtd = int(item['quantidade'])
+                if qtd:
+                    entradas.append((item['produto_id'], qtd, 'nfce', nota['chave']))
+            if not entradas:
+                continue
+            movimentos.extend(entradas)
+            if nota['chave']:
+                # Os itens não cadastrados ficam para a tela de Estoque: a nota termina aqui
+                registros.append(registro_nfce_aplicada(nota['chave'], 'existentes', len(entradas)))
+                registros.append(registro_nfce_aplicada(nota['chave'], ETAPA_FINAL_NFCE, 0))
+                aplicadas.add(nota['chave'])
+            nota['estado'] = 'aplicada'
+
+        movimentar_estoque(movimentos, registros)
+        job['estado'] = 'aplicado'
+        _salvar_importacao(job)
+    notas = sum(1 for nota in job['notas'] if nota['estado'] == 'aplicada')
+    flash(f'Estoque atualizado: {len(movimentos)} entradas de {notas} notas.', 'success')
+    return redirect(url_for('ver_importacao', job_id=job_id))
+
+POR_PAGINA_DESPESAS = 50
+
 @app.route('/despesas')
 def despesas():
-    despesas = ler_csv('despesas')
-    # Ordenar por data decrescente
-    despesas_sorted = sorted(despesas, key=lambda x: x['data'], reverse=True)
+    filtros = {campo: (request.args.get(campo) or '').strip() for campo in ('data_inicio', 'data_fim', 'categoria')}
+    for campo in ('data_inicio', 'data_fim'):
+        try:
+            if filtros[campo]:
+                date.fromisoformat(filtros[campo])
+        except ValueError:
+            flash('Data inválida no filtro; mostrando todas as datas.', 'error')
+            filtros[campo] = ''
+    pagina = max(1, _inteiro(request.args.get('pagina') or 1))
+    despesas, total = pagina_por_data('despesas', filtros['data_inicio'], filtros['data_fim'],
+                                      filtros['categoria'], pagina, POR_PAGINA_DESPESAS)
+    paginas = max(1, -(-total // POR_PAGINA_DESPESAS))
     data_formatada = datetime.now().strftime('%d/%m/%Y')
     return render_template('despesas', 
                                 titulo="Controle de Despesas",
                                 data_hoje=data_formatada,
-                                despesas=despesas_sorted,
+                                despesas=despesas,
+                                total_despesas=total,
+                                pagina=pagina,
+                                paginas=paginas,
+                                filtros=filtros,
+                                categorias_opcoes=categorias_despesas(),
                                 active_page='despesas')
 
 @app.route('/registrar_despesa', methods=['POST'])
@@ -1535,21 +5097,161 @@ def registrar_despesa():
 @app.route('/relatorios')
 def relatorios():
     data_formatada = datetime.now().strftime('%d/%m/%Y')
+    produtos = ler_colunas('produtos')
     return render_template('relatorios', 
                                 titulo="Exportação",
                                 data_hoje=data_formatada,
-                                active_page='relatorios')
+                                active_page='relatorios',
+                                filtros_exportacao=FILTROS_EXPORTACAO,
+                                colunas=HEADERS,
+                                produtos_opcoes=sorted(produtos.textos['nome']),
+                                fornecedores_opcoes=sorted(f for f in produtos.textos['fornecedor'] if f),
+                                categorias_opcoes=categorias_despesas())
+
+# --- Exportação ---
+# A exportação passa as linhas filtradas por um gerador: a tabela é lida do
+# disco (ou do cursor do SQLite) aos poucos e o CSV sai em blocos de 64 KB,
+# opcionalmente em gzip, sem nunca montar o arquivo inteiro na memória.
+# Filtros que cada tabela aceita, além das colunas escolhidas
+FILTROS_EXPORTACAO = {
+    'vendas': ('data_inicio', 'data_fim', 'produto', 'fornecedor'),
+    'produtos': ('produto', 'fornecedor'),
+    'despesas': ('data_inicio', 'data_fim', 'categoria'),
+    'movimentos': ('data_inicio', 'data_fim'),
+    'nfce_aplicadas': ('data_inicio', 'data_fim'),
+}
+TAMANHO_BLOCO_EXPORTACAO = 64 * 1024
+
+def _igual(a, b):
+    return a.strip().casefold() == b.strip().casefold()
+
+def filtros_exportacao(tipo, args):
+    """Filtros da query string que valem para a tabela; ValueError se inválidos."""
+    filtros = {f: args.get(f, '').strip() for f in FILTROS_EXPORTACAO[tipo] if args.get(f, '').strip()}
+    for campo in ('data_inicio', 'data_fim'):
+        if campo in filtros:
+            date.fromisoformat(filtros[campo])
+    colunas = args.getlist('colunas')
+    desconhecidas = [c for c in colunas if c not in HEADERS[tipo]]
+    if desconhecidas:
+        raise ValueError(f"colunas desconhecidas: {', '.join(desconhecidas)}")
+    # Mantém a ordem do arquivo, qualquer que seja a ordem pedida
+    filtros['colunas'] = [c for c in HEADERS[tipo] if c in colunas] or list(HEADERS[tipo])
+    return filtros
+
+def linhas_exportacao(tipo, filtros):
+    """Gera as linhas da tabela que passam pelos filtros."""
+    if tipo == 'produtos':
+        # O catálogo é pequeno e sai com a quantidade atual do ledger
+        linhas = ler_produtos()
+    else:
+        linhas = armazenamento.iterar(tipo, filtros.get('data_inicio'), filtros.get('data_fim'))
+    produto = filtros.get('produto')
+    categoria = filtros.get('categoria')
+    fornecedor = filtros.get('fornecedor')
+    ids_fornecedor = None
+    if fornecedor and tipo == 'vendas':
+        ids_fornecedor = {p['id'] for p in ler_csv('produtos') if _igual(p['fornecedor'], fornecedor)}
+    for linha in linhas:
+        if produto and not _igual(linha['nome_produto' if tipo == 'vendas' else 'nome'], produto):
+            continue
+        if categoria and not _igual(linha['categoria'] or 'Outros', categoria):
+            continue
+        if fornecedor:
+            if ids_fornecedor is None:
+                if not _igual(linha['fornecedor'], fornecedor):
+                    continue
+            elif linha['produto_id'] not in ids_fornecedor:
+                continue
+        yield linha
+
+def gerar_exportacao(tipo, filtros, compactar=False):
+    """Blocos (bytes) do CSV filtrado, em gzip se 'compactar'."""
+    colunas = filtros['colunas']
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compactar else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def esvaziar():
+        bloco = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(bloco) if compressor else bloco
+
+    writer.writerow(colunas)
+    for linha in linhas_exportacao(tipo, filtros):
+        writer.writerow([linha.get(c, '') for c in colunas])
+        if buffer.tell() > TAMANHO_BLOCO_EXPORTACAO:
+            bloco = esvaziar()
+            if bloco:
+                yield bloco
+    bloco = esvaziar()
+    if compressor:
+        bloco += compressor.flush()
+    if bloco:
+        yield bloco
 
 @app.route('/download/<tipo>')
 def download_csv(tipo):
-    filepath = FILES.get(tipo)
-    if filepath and os.path.exists(filepath):
-        return send_file(filepath, as_attachment=True)
-    flash('Arquivo não encontrado.', 'error')
-    return redirect(url_for('relatorios'))
+    if tipo not in FILES:
+        flash('Arquivo não encontrado.', 'error')
+        return redirect(url_for('relatorios'))
+    try:
+        filtros = filtros_exportacao(tipo, request.args)
+    except ValueError as e:
+        flash(f'Filtros de exportação inválidos: {e}', 'error')
+        return redirect(url_for('relatorios'))
+    compactar = request.args.get('gzip') in ('1', 'on')
+    completo = len(filtros) == 1 and filtros['colunas'] == HEADERS[tipo]
+    if (completo and not compactar and not armazenamento.agrega_em_sql and tipo != 'produtos'
+            and not armazenamento.particionada(tipo)):
+        # O arquivo inteiro sai direto do disco, com ETag e suporte a Range
+        # (downloads grandes interrompidos podem continuar de onde pararam)
+        return send_file(os.path.abspath(FILES[tipo]), as_attachment=True,
+                         download_name=f'{tipo}.csv', conditional=True)
+    if completo and not compactar and armazenamento.particionada(tipo):
+        # Particionada: os meses são servidos em sequência como um arquivo
+        # só, com o mesmo ETag e Range de um CSV inteiro
+        arquivo = armazenamento.abrir_concatenado(tipo)
+        if arquivo is not None:
+            resposta = Response(wrap_file(request.environ, arquivo), mimetype='text/csv',
+                                direct_passthrough=True,
+                                headers={'Content-Disposition': f'attachment; filename={tipo}.csv'})
+            resposta.content_length = arquivo.tamanho
+            resposta.set_etag(arquivo.etag)
+            return resposta.make_conditional(request, accept_ranges=True,
+                                             complete_length=arquivo.tamanho)
+
+    partes = [tipo] + [filtros[f] for f in ('data_inicio', 'data_fim') if f in filtros]
+    nome = '_'.join(partes) + ('.csv.gz' if compactar else '.csv')
+    # Filtrado, o CSV é gerado na hora e não tem tamanho conhecido: sem Range
+    return Response(gerar_exportacao(tipo, filtros, compactar),
+                    mimetype='application/gzip' if compactar else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={nome}',
+                             'Accept-Ranges': 'none'})
+
+@app.cli.command('migrar-sqlite')
+@click.option('--substituir', is_flag=True, help='Apaga o que já existir no banco antes de importar.')
+def migrar_sqlite_cmd(substituir):
+    """Copia os CSVs de dados_mercearia para o banco SQLite (fiscalflow.db)."""
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    origem = ArmazenamentoCSV()
+    destino = ArmazenamentoSQLite(SQLITE_FILE)
+    destino.inicializar()
+    for tipo in HEADERS:
+        if not substituir and destino.ler(tipo)[1]:
+            raise click.ClickException(f'A tabela {tipo} já tem dados no SQLite. Use --substituir.')
+    for tipo in HEADERS:
+        if not origem.existe(tipo):
+            continue
+        campos, linhas = origem.ler(tipo)
+        destino.escrever(tipo, [dict(zip(campos, linha)) for linha in linhas])
+        print(f'{tipo}: {len(linhas)} linhas migradas.')
+    print('Pronto. Inicie o sistema com FISCALFLOW_BACKEND=sqlite para usar o banco.')
 
 if __name__ == '__main__':
-    init_db()
+    preparar_dados()
     # Roda o servidor acessível na rede local se quiser acessar pelo celular (mude o host para 0.0.0.0)
     print("Sistema rodando! Acesse http://127.0.0.1:5000 no seu navegador.")
     app.run(debug=True, port=5000)
@@ -0,0 +1,48 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(RAIZ, 'tests', 'fixtures')
+sys.path.insert(0, RAIZ)
+
+
+def fixture(*partes):
+    """Conteúdo de um arquivo de tests/fixtures."""
+    with open(os.path.join(FIXTURES, *partes), mode='r', encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture(params=['csv'])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch, backend):
+    """O módulo main recarregado numa pasta vazia: dados e caches só do teste."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('FISCALFLOW_BACKEND', backend)
+    import main as modulo
+    modulo = importlib.reload(modulo)
+    modulo.preparar_dados()
+    modulo.app.config['TESTING'] = True
+    return modulo
+
+
+@pytest.fixture
+def cliente(main):
+    return main.app.test_client()
+
+
+@pytest.fixture
+def produto(main):
+    """Cadastra um produto pelo formulário e devolve a linha gravada."""
+    def cadastrar(nome, quantidade=10, custo='5', preco_venda='8', fornecedor=''):
+        main.app.test_client().post('/adicionar_produto', data={
+            'acao': 'salvar', 'nome': nome, 'custo': custo, 'preco_venda': preco_venda,
+            'quantidade': str(quantidade), 'fornecedor': fornecedor})
+        return [p for p in main.ler_csv('produtos') if p['nome'] == nome][-1]
+    return cadastrar
@@ -0,0 +1,164 @@
+"""O dashboard pelos resumos (diários e de meses fechados) tem de bater com a soma das linhas brutas."""
+from collections import defaultdict
+from datetime import date, timedelta
+
+import pytest
+
+from bench.nfe import pagina_nfe_sintetica
+
+
+def mes_anterior(mes, n=1):
+    ano, numero = int(mes[:4]), int(mes[5:])
+    numero -= n
+    while numero < 1:
+        ano, numero = ano - 1, numero + 12
+    return f'{ano}-{numero:02d}'
+
+
+HOJE = date.today()
+MES_ATUAL = HOJE.strftime('%Y-%m')
+MESES = [mes_anterior(MES_ATUAL, n) for n in (3, 2, 1)]
+PRODUTOS = ['Arroz 5KG', 'Feijão 1KG', 'Café 500G']
+CATEGORIAS = ['Fixa', 'Variável', '']
+
+
+def centavos(valor):
+    return int(round(float(valor) * 100))
+
+
+def registrar(main, mes, n, desloc=0):
+    """n vendas e n // 2 despesas espalhadas pelo mês, com centavos quebrados."""
+    operacoes = []
+    ids_vendas = main.reservar_ids('vendas', n)
+    for i, venda_id in enumerate(ids_vendas):
+        dia = f'{mes}-{(i * 7 + desloc) % 28 + 1:02d}'
+        total = 3.17 * (i % 5 + 1) + desloc / 100
+        operacoes.append(('vendas', 'a', {
+            'id': venda_id, 'data': f'{dia} 1{i % 10}:00:00', 'produto_id': str(i % 3 + 1),
+            'nome_produto': PRODUTOS[i % 3], 'quantidade': 1, 'total_venda': f'{total:.2f}',
+            'lucro_estimado': f'{total * 0.27:.2f}', 'ticket_id': venda_id}))
+    for i, despesa_id in enumerate(main.reservar_ids('despesas', n // 2)):
+        dia = f'{mes}-{(i * 11 + desloc) % 28 + 1:02d}'
+        operacoes.append(('despesas', 'a', {
+            'id': despesa_id, 'data': f'{dia} 09:00:00', 'descricao': f'Conta {i}',
+            'valor': f'{12.34 * (i % 4 + 1) + desloc:.2f}', 'categoria': CATEGORIAS[i % 3]}))
+    main.gravar_em_lote(operacoes)
+
+
+def ingenuo(vendas, despesas, filtros):
+    """Totais do dashboard somados linha a linha, sem resumo nenhum."""
+    dentro = lambda dia: filtros['data_inicio'] <= dia <= filtros['data_fim']
+    resultado = {'vendas_hoje': 0, 'lucro_mes': 0, 'despesas_mes': 0, 'produtos': defaultdict(int),
+                 'lucros': defaultdict(int), 'categorias': defaultdict(int),
+                 'vendas_mes': defaultdict(int), 'despesas_mes_a_mes': defaultdict(int)}
+    for v in vendas:
+        dia, total, lucro = v['data'][:10], centavos(v['total_venda']), centavos(v['lucro_estimado'])
+        resultado['vendas_mes'][dia[:7]] += total
+        resultado['vendas_hoje'] += total if dia == HOJE.isoformat() else 0
+        resultado['lucro_mes'] += lucro if dia[:7] == MES_ATUAL else 0
+        if dentro(dia) and filtros['produto'] in ('', v['nome_produto']):
+            resultado['produtos'][v['nome_produto']] += total
+            resultado['lucros'][v['nome_produto']] += lucro
+    for d in despesas:
+        dia, valor, categoria = d['data'][:10], centavos(d['valor']), d['categoria'] or 'Outros'
+        resultado['despesas_mes_a_mes'][dia[:7]] += valor
+        resultado['despesas_mes'] += valor if dia[:7] == MES_ATUAL else 0
+        if dentro(dia) and filtros['categoria'] in ('', categoria):
+            resultado['categorias'][categoria] += valor
+    return resultado
+
+
+def conferir(main, filtros):
+    main.cache_painel._entradas.clear()
+    painel = main.calcular_painel(filtros)
+    vendas, despesas = main.ler_csv('vendas'), main.ler_csv('despesas')
+    esperado = ingenuo(vendas, despesas, filtros)
+
+    reais = lambda centavos_: pytest.approx(centavos_ / 100, abs=0.005)
+    assert painel['vendas_hoje'] == reais(esperado['vendas_hoje'])
+    assert painel['lucro_mes'] == reais(esperado['lucro_mes'])
+    assert painel['despesas_mes'] == reais(esperado['despesas_mes'])
+    assert painel['vendas_filtrado'] == reais(sum(esperado['produtos'].values()))
+    assert painel['lucro_filtrado'] == reais(sum(esperado['lucros'].values()))
+    assert painel['despesas_filtrado'] == reais(sum(esperado['categorias'].values()))
+    assert dict(zip(painel['produtos_labels'], painel['produtos_vendas_valores'])) == {
+        nome: reais(total) for nome, total in esperado['produtos'].items()}
+    assert dict(zip(painel['produtos_labels'], painel['produtos_lucro_valores'])) == {
+        nome: reais(lucro) for nome, lucro in esperado['lucros'].items()}
+    assert dict(zip(painel['despesas_cat_labels'], painel['despesas_cat_valores'])) == {
+        categoria: reais(valor) for categoria, valor in esperado['categorias'].items()}
+    meses = main.AgregadorPainel(filtros['data_inicio'], filtros['data_fim']).meses_comparativo
+    assert painel['comparativo_vendas'] == [reais(esperado['vendas_mes'][m]) for m in meses]
+    assert painel['comparativo_despesas'] == [reais(esperado['despesas_mes_a_mes'][m]) for m in meses]
+
+    # A evolução (dia, semana ou mês) tem de ser a mesma do agregador sobre as linhas brutas
+    bruto = main.AgregadorPainel(filtros['data_inicio'], filtros['data_fim'], filtros['produto'], filtros['categoria'])
+    bruto.alimentar_linhas(vendas, despesas)
+    bruto = bruto.resultado()
+    assert painel['evolucao_labels'] == bruto['evolucao_labels']
+    assert painel['evolucao_valores'] == pytest.approx(bruto['evolucao_valores'], abs=0.005)
+
+
+def filtros(inicio, fim, produto='', categoria=''):
+    return {'data_inicio': inicio, 'data_fim': fim, 'produto': produto, 'categoria': categoria}
+
+
+def ultimo_dia(mes):
+    return ((date.fromisoformat(mes + '-01') + timedelta(days=32)).replace(day=1) - timedelta(days=1)).isoformat()
+
+
+CASOS = {
+    'tudo': lambda: filtros(MESES[0] + '-01', ultimo_dia(MES_ATUAL)),
+    'um_mes_fechado': lambda: filtros(MESES[1] + '-01', ultimo_dia(MESES[1])),
+    'parte_de_dois_meses': lambda: filtros(MESES[0] + '-15', MESES[1] + '-10'),
+    'produto': lambda: filtros(MESES[0] + '-01', ultimo_dia(MES_ATUAL), produto='Feijão 1KG'),
+    'categoria': lambda: filtros(MESES[1] + '-05', ultimo_dia(MES_ATUAL), categoria='Outros'),
+}
+
+
+@pytest.fixture
+def historico(main):
+    for n, mes in enumerate(MESES):
+        registrar(main, mes, 20 + n)
+    registrar(main, MES_ATUAL, 6, desloc=HOJE.day - 1)
+    return main
+
+
+@pytest.mark.parametrize('caso', sorted(CASOS))
+def test_resumos_batem_com_as_linhas(historico, caso):
+    main = historico
+    conferir(main, CASOS[caso]())
+
+    # Fechar meses troca os resumos diários pelo resumo mensal
+    for mes in MESES[:2]:
+        main.fechar_mes(mes)
+    assert main.armazenamento.fechados('vendas') == MESES[:2]
+    conferir(main, CASOS[caso]())
+
+    # Anexar num mês fechado o reabre; o resto continua fechado
+    registrar(main, MESES[1], 5, desloc=3)
+    assert main.armazenamento.fechados('vendas') == MESES[:1]
+    conferir(main, CASOS[caso]())
+
+    # E fechado de novo, com as linhas novas no resumo
+    main.fechar_mes(MESES[1])
+    assert main.armazenamento.fechados('vendas') == MESES[:2]
+    conferir(main, CASOS[caso]())
+
+
+def test_linhas_colunares_e_dicts_dao_o_mesmo(historico):
+    main = historico
+    inicio, fim = MESES[0] + '-01', ultimo_dia(MES_ATUAL)
+    por_dicts = main.AgregadorPainel(inicio, fim)
+    por_dicts.alimentar_linhas(main.ler_csv('vendas'), main.ler_csv('despesas'))
+    por_colunas = main.AgregadorPainel(inicio, fim)
+    por_colunas.alimentar_colunas(main.ler_colunas('vendas'), main.ler_colunas('despesas'))
+    assert por_dicts.resultado() == por_colunas.resultado()
+
+
+@pytest.mark.parametrize('n_itens', [1, 50, 300])
+def test_pagina_sintetica_do_bench_le_igual_nos_dois_caminhos(main, n_itens):
+    html = pagina_nfe_sintetica(n_itens)
+    itens = main.ler_itens_nfe(html, restrito=True)
+    assert len(itens) == n_itens
+    assert itens == main.ler_itens_nfe(html, restrito=False)
@@ -0,0 +1,21 @@
+"""Endpoint de estoque baixo usado pelo menu lateral e pelo dashboard."""
+import pytest
+
+
+@pytest.fixture
+def em_falta(main, produto):
+    return [produto(nome, quantidade=q)['id'] for nome, q in (('Arroz', 1), ('Feijão', 2), ('Café', 30))]
+
+
+def test_limite(cliente, em_falta):
+    assert cliente.get('/api/estoque/baixo').get_json()['total'] == 2
+    assert cliente.get('/api/estoque/baixo?limite=0').get_json() == {'total': 2, 'produtos': []}
+    dados = cliente.get('/api/estoque/baixo?limite=1').get_json()
+    assert dados['total'] == 2 and [p['nome'] for p in dados['produtos']] == ['Arroz']
+
+
+@pytest.mark.parametrize('limite', ['-1', '-5', 'abc', '1.5', ''])
+def test_limite_invalido_e_recusado(cliente, em_falta, limite):
+    resposta = cliente.get(f'/api/estoque/baixo?limite={limite}')
+    assert resposta.status_code == 400
+    assert 'erro' in resposta.get_json()
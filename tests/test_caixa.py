@@ -0,0 +1,31 @@
+"""Fechamento do carrinho do caixa."""
+
+
+def finalizar(cliente, carrinho):
+    cliente.post('/finalizar_carrinho', data={'produto_id': [p for p, _ in carrinho],
+                                              'quantidade': [str(q) for _, q in carrinho]})
+    with cliente.session_transaction() as sessao:
+        return [mensagem for _, mensagem in sessao.pop('_flashes', [])]
+
+
+def test_venda_do_carrinho(main, cliente, produto):
+    arroz, feijao = produto('Arroz', quantidade=5), produto('Feijão', quantidade=5)
+    [mensagem] = finalizar(cliente, [(arroz['id'], 2), (feijao['id'], 1)])
+    assert 'registrada (2 itens)' in mensagem
+    assert main.estoque_atual()[arroz['id']] == 3
+
+
+def test_produto_inexistente_nao_e_estoque_insuficiente(main, cliente, produto):
+    arroz = produto('Arroz', quantidade=5)
+    [mensagem] = finalizar(cliente, [(arroz['id'], 1), ('999', 1)])
+    assert 'não encontrado' in mensagem and '999' in mensagem
+    assert 'Estoque insuficiente' not in mensagem
+    assert main.ler_csv('vendas') == []
+    assert main.estoque_atual()[arroz['id']] == 5
+
+
+def test_estoque_insuficiente(main, cliente, produto):
+    arroz = produto('Arroz', quantidade=1)
+    [mensagem] = finalizar(cliente, [(arroz['id'], 3)])
+    assert mensagem == 'Erro: Estoque insuficiente! Arroz (disponível: 1)'
+    assert main.ler_csv('vendas') == []
@@ -0,0 +1,69 @@
+"""Busca do catálogo pelo índice de fragmentos e ordem por quantidade em cache."""
+import pytest
+
+NOMES = ['Arroz Tio João 5kg', 'Arroz Parboilizado 1 kg', 'Feijão Carioca 1kg', 'Café Pilão 500g',
+         'Leite Integral 1L', 'Açúcar Cristal 2kg', 'Óleo de Soja 900ml', 'Sal Refinado 1kg', 'Pão de Forma']
+
+
+def contendo_ingenuo(main, indice, texto):
+    palavras = main.normalizar_nome(texto).split()
+    ids = {texto.strip()} & indice._nomes.keys()
+    if palavras:
+        ids.update(prod_id for prod_id, chave in indice._normalizados.items()
+                   if all(p in chave for p in palavras))
+    return ids
+
+
+@pytest.fixture
+def indice(main):
+    indice = main.IndiceCatalogo()
+    for i, nome in enumerate(NOMES, 1):
+        indice.adicionar(str(i), nome)
+    return indice
+
+
+@pytest.mark.parametrize('texto', ['arroz', 'ARR', 'a', 'de', 'kg', '1kg', 'arroz 5', 'cafe pil',
+                                   'oz', 'zzz', '', '3', 'soja de', 'ao', 'o de'])
+def test_contendo_igual_a_varredura(main, indice, texto):
+    assert indice.contendo(texto) == contendo_ingenuo(main, indice, texto)
+
+
+def test_contendo_acompanha_adicionar_e_remover(main, indice):
+    assert indice.contendo('arroz') == {'1', '2'}
+    indice.adicionar('2', 'Macarrão Espaguete')  # renomeado
+    indice.adicionar('10', 'Arroz Integral 1kg')
+    indice.remover('1')
+    assert indice.contendo('arroz') == {'10'}
+    assert indice.contendo('esp') == {'2'}
+    assert indice.contendo('ao') == contendo_ingenuo(main, indice, 'ao')
+
+
+def test_contendo_nao_varre_o_catalogo(main, indice, monkeypatch):
+    indice.contendo('x')  # monta o índice de fragmentos
+
+    class SemVarredura(dict):
+        def items(self):
+            raise AssertionError('contendo() varreu todos os nomes')
+
+    monkeypatch.setattr(indice, '_normalizados', SemVarredura(indice._normalizados))
+    assert indice.contendo('arroz 5') == {'1'}
+
+
+def test_autocompletar_pelo_meio_do_nome(indice):
+    assert indice.autocompletar('soja') == ['7']
+    assert indice.autocompletar('de') == ['7', '9']
+
+
+def test_ordem_por_quantidade_so_remonta_quando_o_estoque_muda(main, produto):
+    ids = [produto(nome, quantidade=q)['id'] for nome, q in (('Arroz', 7), ('Feijão', 3), ('Café', 5))]
+    pagina = lambda: [p['id'] for p in main.pagina_catalogo(ordem='quantidade')[0]]
+    assert pagina() == [ids[1], ids[2], ids[0]]
+
+    ordem = lambda: main._ordem_catalogo(main._carregar_tabela('produtos'), 'quantidade')
+    assert ordem() is ordem()
+    antes = ordem()
+    main.movimentar_estoque([(ids[0], -6, 'venda', 'teste')])
+    assert ordem() is not antes
+    assert pagina() == [ids[0], ids[1], ids[2]]
+    main.movimentar_estoque([(ids[2], -5, 'venda', 'teste')])
+    assert pagina() == [ids[2], ids[0], ids[1]]
@@ -0,0 +1,169 @@
+"""ClienteNFe contra um servidor local que faz o papel da SEFAZ."""
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import fixture
+
+CHAVE = '35261012345678000190650010000012341000012345'
+ATRASO_LENTA = 1.0
+
+
+class SefazLocal:
+    """Serve as páginas salvas em tests/fixtures/nfce e anota cada pedido.
+
+    /nota          a nota com 3 itens
+    /instavel      503 nas duas primeiras vezes, depois a nota
+    /fora-do-ar    sempre 503
+    /lenta         a nota, mas só depois de ATRASO_LENTA segundos
+    /indisponivel  200 com a página de erro da SEFAZ, sem a tabela de itens
+    /inexistente   404
+    """
+
+    def __init__(self):
+        self.pedidos = defaultdict(list)  # caminho -> [instante de cada pedido]
+        self.paginas = {'nota': fixture('nfce', 'nota_sp.html').encode('utf-8'),
+                        'indisponivel': fixture('nfce', 'consulta_indisponivel.html').encode('utf-8')}
+        self._trava = threading.Lock()
+        sefaz = self
+
+        class Pagina(BaseHTTPRequestHandler):
+            def do_GET(self):
+                sefaz.responder(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', 0), Pagina)
+        self.servidor.daemon_threads = True
+        self.base = f'http://127.0.0.1:{self.servidor.server_port}'
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+
+    def responder(self, pedido):
+        caminho = pedido.path.split('?')[0]
+        with self._trava:
+            self.pedidos[caminho].append(time.monotonic())
+            vez = len(self.pedidos[caminho])
+        if caminho == '/lenta':
+            time.sleep(ATRASO_LENTA)
+        if caminho == '/inexistente':
+            status, corpo = 404, b''
+        elif caminho == '/fora-do-ar' or (caminho == '/instavel' and vez <= 2):
+            status, corpo = 503, b''
+        elif caminho == '/indisponivel':
+            status, corpo = 200, self.paginas['indisponivel']
+        else:
+            status, corpo = 200, self.paginas['nota']
+        try:
+            pedido.send_response(status)
+            pedido.send_header('Content-Type', 'text/html; charset=utf-8')
+            pedido.send_header('Content-Length', str(len(corpo)))
+            pedido.end_headers()
+            pedido.wfile.write(corpo)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # o cliente já desistiu pelo timeout
+
+    def url(self, caminho):
+        return f'{self.base}{caminho}?p={CHAVE}|2|1|1|ABCDEF'
+
+    def fechar(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+
+@pytest.fixture
+def sefaz():
+    servidor = SefazLocal()
+    yield servidor
+    servidor.fechar()
+
+
+@pytest.fixture
+def novo_cliente(main):
+    def criar(**opcoes):
+        padrao = {'tentativas': 3, 'backoff': 0.1, 'timeout': (1, 0.3), 'prazo': 5}
+        return main.ClienteNFe(**{**padrao, **opcoes})
+    return criar
+
+
+def test_le_os_itens_da_nota(main, sefaz, novo_cliente):
+    itens = novo_cliente().extrair(sefaz.url('/nota'))
+    assert [item['nome'] for item in itens] == [
+        'ARROZ TIO JOAO TIPO 1 5KG', 'FEIJAO CARIOCA CAMIL 1KG', 'LEITE INTEGRAL ITALAC 1L']
+    assert [item['quantidade'] for item in itens] == [2, 3, 12]
+    assert [item['custo'] for item in itens] == [27.95, 8.49, 4.6]
+    assert {item['fornecedor'] for item in itens} == {'SUPERMERCADO BOA COMPRA LTDA'}
+    assert len(sefaz.pedidos['/nota']) == 1
+
+
+def test_repete_com_backoff_exponencial_depois_de_503(main, sefaz, novo_cliente):
+    itens = novo_cliente(backoff=0.1).extrair(sefaz.url('/instavel'))
+    assert len(itens) == 3
+    instantes = sefaz.pedidos['/instavel']
+    assert len(instantes) == 3
+    esperas = [depois - antes for antes, depois in zip(instantes, instantes[1:])]
+    assert esperas[0] >= 0.1 and esperas[1] >= 0.2
+
+
+def test_desiste_depois_das_tentativas(main, sefaz, novo_cliente):
+    with pytest.raises(main.ErroBuscaNFe, match='503'):
+        novo_cliente(tentativas=3, backoff=0.01).extrair(sefaz.url('/fora-do-ar'))
+    assert len(sefaz.pedidos['/fora-do-ar']) == 3
+
+
+def test_erro_do_cliente_nao_e_repetido(main, sefaz, novo_cliente):
+    with pytest.raises(main.ErroBuscaNFe, match='404'):
+        novo_cliente().extrair(sefaz.url('/inexistente'))
+    assert len(sefaz.pedidos['/inexistente']) == 1
+
+
+def test_timeout_de_leitura_em_cada_tentativa(main, sefaz, novo_cliente):
+    inicio = time.monotonic()
+    with pytest.raises(main.ErroBuscaNFe):
+        novo_cliente(tentativas=2, backoff=0.01, timeout=(1, 0.2)).extrair(sefaz.url('/lenta'))
+    assert len(sefaz.pedidos['/lenta']) == 2
+    # Cada tentativa para no timeout de leitura, bem antes do servidor responder
+    assert time.monotonic() - inicio < 2 * ATRASO_LENTA
+
+
+def test_prazo_total_da_nota(main, sefaz, novo_cliente):
+    inicio = time.monotonic()
+    with pytest.raises(main.ErroBuscaNFe):
+        novo_cliente(tentativas=10, backoff=0.05, timeout=(1, 0.3), prazo=0.5).extrair(sefaz.url('/lenta'))
+    assert time.monotonic() - inicio < 0.5 + 0.25
+    assert len(sefaz.pedidos['/lenta']) <= 2
+
+
+def test_pagina_sem_tabela_de_itens(main, sefaz, novo_cliente):
+    with pytest.raises(main.ErroLeituraNFe, match='tabResult'):
+        novo_cliente().extrair(sefaz.url('/indisponivel'))
+    assert len(sefaz.pedidos['/indisponivel']) == 1
+
+
+def test_nota_em_cache_nao_vai_a_rede(main, sefaz, novo_cliente, tmp_path):
+    cliente = novo_cliente(cache=main.CacheNFe(str(tmp_path / 'cache_nfce')))
+    primeira = cliente.extrair(sefaz.url('/nota'))
+    assert len(sefaz.pedidos['/nota']) == 1
+    # Mesma chave de acesso: vem do cache, mesmo com a SEFAZ fora do ar
+    assert cliente.extrair(sefaz.url('/fora-do-ar')) == primeira
+    assert cliente.extrair(sefaz.url('/nota')) == primeira
+    assert len(sefaz.pedidos['/nota']) == 1
+    assert not sefaz.pedidos['/fora-do-ar']
+
+
+def test_erro_da_pagina_nao_vai_para_o_cache(main, sefaz, novo_cliente, tmp_path):
+    cliente = novo_cliente(cache=main.CacheNFe(str(tmp_path / 'cache_nfce')))
+    with pytest.raises(main.ErroLeituraNFe):
+        cliente.extrair(sefaz.url('/indisponivel'))
+    assert cliente.extrair(sefaz.url('/nota'))
+    assert len(sefaz.pedidos['/nota']) == 1
+
+
+def test_extrair_itens_nfe_repassa_os_erros(main, sefaz):
+    with pytest.raises(main.ErroLeituraNFe):
+        main.extrair_itens_nfe(sefaz.url('/indisponivel'))
+    with pytest.raises(main.ErroBuscaNFe):
+        main.extrair_itens_nfe(sefaz.url('/inexistente'))
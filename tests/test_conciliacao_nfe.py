@@ -0,0 +1,60 @@
+"""Confirmação dos itens de uma NFC-e já cadastrados no estoque."""
+import pytest
+
+CHAVE = '35261012345678000190650010000012341000012345'
+
+
+def item(produto_id, quantidade, nome='ARROZ 5 KG'):
+    return {'nome': nome, 'produto_id': produto_id, 'quantidade_nota': quantidade, 'custo': 9.0,
+            'fornecedor': 'ATACADO', 'estoque_atual': 0}
+
+
+def confirmar(cliente, token, selecionados):
+    dados = {'acao': 'confirmar_itens_existentes', 'nfe_token': token}
+    for i, qtd in selecionados.items():
+        dados.update({f'sel_{i}': 'on', f'qtd_{i}': str(qtd)})
+    return cliente.post('/adicionar_produto', data=dados)
+
+
+@pytest.fixture
+def duplicados(main, produto):
+    """Dois produtos com o mesmo nome normalizado e um terceiro qualquer."""
+    ids = [produto('Arroz 5KG', quantidade=10)['id'], produto('Arroz 5 kg', quantidade=7)['id'],
+           produto('Feijão 1KG', quantidade=4)['id']]
+    assert sorted(main.indice_catalogo().buscar('ARROZ 5 KG')) == sorted(ids[:2])
+    return ids
+
+
+def test_so_o_produto_conciliado_recebe_a_entrada(main, cliente, duplicados):
+    primeiro, conciliado, outro = duplicados
+    antes = dict(main.estoque_atual())
+    token = main.criar_sessao_nfce(f'http://sefaz.local/nota?p={CHAVE}', CHAVE, [item(conciliado, 3)], [])
+    assert confirmar(cliente, token, {0: 3}).status_code == 302
+    depois = main.estoque_atual()
+    assert depois[conciliado] == antes[conciliado] + 3
+    assert depois[primeiro] == antes[primeiro]
+    assert depois[outro] == antes[outro]
+    movimentos = main.ler_csv('movimentos')
+    assert [(m['produto_id'], m['delta'], m['tipo'], m['referencia']) for m in movimentos] == [
+        (conciliado, '3', 'nfce', CHAVE)]
+
+
+def test_item_de_produto_excluido_nao_movimenta(main, cliente, duplicados):
+    conciliado = duplicados[1]
+    antes = dict(main.estoque_atual())
+    token = main.criar_sessao_nfce('http://sefaz.local/nota', '', [item(conciliado, 2), item('999', 5, 'SUMIU')], [])
+    confirmar(cliente, token, {0: 2, 1: 5})
+    depois = main.estoque_atual()
+    assert depois[conciliado] == antes[conciliado] + 2
+    assert '999' not in depois
+    assert {p: q for p, q in depois.items() if p != conciliado} == {p: q for p, q in antes.items() if p != conciliado}
+
+
+def test_item_desmarcado_nao_movimenta(main, cliente, duplicados):
+    primeiro, conciliado, _ = duplicados
+    antes = dict(main.estoque_atual())
+    token = main.criar_sessao_nfce('http://sefaz.local/nota', '', [item(primeiro, 1), item(conciliado, 2)], [])
+    confirmar(cliente, token, {1: 2})
+    depois = main.estoque_atual()
+    assert depois[primeiro] == antes[primeiro]
+    assert depois[conciliado] == antes[conciliado] + 2
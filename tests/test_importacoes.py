@@ -0,0 +1,82 @@
+"""Importações em lote deixadas pela metade por um processo que morreu."""
+import os
+import time
+
+import pytest
+
+CHAVES = [f'3526101234567800019065001000001234{i:010d}' for i in range(1, 4)]
+ITENS = [{'nome': 'ARROZ 5KG', 'quantidade': 2, 'custo': 20.0, 'fornecedor': 'ATACADO'}]
+
+
+@pytest.fixture
+def job_orfao(main):
+    """Job 'processando' de um processo que já não existe: uma nota lida, uma na fila, uma com falha."""
+    os.makedirs(main.IMPORTACOES_DIR, exist_ok=True)
+    notas = [{'url': f'http://sefaz.local/nota?p={chave}', 'chave': chave, 'estado': 'pendente',
+              'erro': '', 'itens': []} for chave in CHAVES]
+    notas[0].update(estado='ok', itens=[dict(ITENS[0], produto_id='')])
+    notas[2].update(estado='erro_busca', erro='a SEFAZ respondeu 503')
+    job = {'id': 'abcdef123456', 'criado': '2026-10-17 10:00:00', 'estado': 'processando',
+           'processadas': 2, 'a_processar': 3, 'notas': notas, 'processo': '000000000000'}
+    main._salvar_importacao(job)
+    return job['id']
+
+
+def reiniciar(main):
+    main._preparacao['feita'] = False
+    main.preparar_dados()
+
+
+def esperar(main, job_id, estado, prazo=5):
+    limite = time.monotonic() + prazo
+    while time.monotonic() < limite:
+        job = main.carregar_importacao(job_id)
+        if job['estado'] == estado:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'o job não chegou a {estado!r}: {job["estado"]!r}')
+
+
+def test_job_de_processo_morto_vira_falhou(main, job_orfao):
+    reiniciar(main)
+    job = main.carregar_importacao(job_orfao)
+    assert job['estado'] == 'falhou'
+    assert [nota['estado'] for nota in job['notas']] == ['ok', 'interrompida', 'erro_busca']
+    assert job['notas'][0]['itens']
+
+
+def test_job_de_processo_vivo_continua(main, job_orfao):
+    job = main.carregar_importacao(job_orfao)
+    job['processo'] = 'outroprocess'
+    main._salvar_importacao(job)
+    with open(main._caminho_processo('outroprocess'), 'a+b') as trava:
+        main._travar_arquivo(trava)
+        reiniciar(main)
+        assert main.carregar_importacao(job_orfao)['estado'] == 'processando'
+        main._destravar_arquivo(trava)
+    # Sem a trava, o dono morreu
+    reiniciar(main)
+    assert main.carregar_importacao(job_orfao)['estado'] == 'falhou'
+
+
+def test_tentar_de_novo_pela_tela(main, cliente, job_orfao, monkeypatch):
+    reiniciar(main)
+    assert 'Tentar de novo' in cliente.get(f'/importar_nfe/{job_orfao}').get_data(as_text=True)
+    urls = []
+    monkeypatch.setattr(main.cliente_nfe, 'extrair', lambda url: (urls.append(url), [dict(i) for i in ITENS])[1])
+
+    resposta = cliente.post(f'/importar_nfe/{job_orfao}/retomar')
+    assert resposta.status_code == 302
+    job = esperar(main, job_orfao, 'concluido')
+    assert sorted(urls) == [f'http://sefaz.local/nota?p={chave}' for chave in CHAVES[1:]]
+    assert [nota['estado'] for nota in job['notas']] == ['ok', 'ok', 'ok']
+    assert job['processadas'] == job['a_processar'] == 3
+    # Um job que não falhou não é retomado
+    assert not main.retomar_importacao(job_orfao)
+
+
+def test_job_criado_depois_do_reinicio_pertence_ao_processo_novo(main, monkeypatch):
+    monkeypatch.setattr(main.cliente_nfe, 'extrair', lambda url: [dict(i) for i in ITENS])
+    job_id = main.criar_importacao([f'http://sefaz.local/nota?p={CHAVES[0]}'])
+    esperar(main, job_id, 'concluido')
+    assert main._processo_vivo(main.carregar_importacao(job_id)['processo'])
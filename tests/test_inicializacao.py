@@ -0,0 +1,21 @@
+"""Preparação da pasta de dados: uma vez por processo, fora do caminho das requisições."""
+
+
+def test_primeira_requisicao_prepara_os_dados_uma_vez(main, cliente, monkeypatch):
+    chamadas = []
+    init_db = main.init_db
+    monkeypatch.setattr(main, 'init_db', lambda: (chamadas.append(1), init_db())[1])
+    monkeypatch.setitem(main._preparacao, 'feita', False)
+    for _ in range(3):
+        assert cliente.get('/').status_code == 200
+    assert cliente.get('/estoque').status_code == 200
+    assert len(chamadas) == 1
+
+
+def test_dashboard_nao_passa_pelo_armazenamento_a_cada_visita(main, cliente, monkeypatch):
+    chamadas = []
+    monkeypatch.setattr(main.armazenamento, 'recuperar', lambda: chamadas.append('recuperar'))
+    monkeypatch.setattr(main.armazenamento, 'inicializar', lambda: chamadas.append('inicializar'))
+    for _ in range(3):
+        assert cliente.get('/').status_code == 200
+    assert chamadas == []
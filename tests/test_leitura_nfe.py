@@ -0,0 +1,32 @@
+"""A leitura recortada da NFC-e tem de dar o mesmo que a página inteira no BeautifulSoup."""
+import os
+
+import pytest
+
+from conftest import FIXTURES, fixture
+
+PAGINAS = sorted(nome for nome in os.listdir(os.path.join(FIXTURES, 'nfce'))
+                 if 'tabResult' in fixture('nfce', nome))
+
+
+@pytest.mark.parametrize('nome', PAGINAS)
+def test_recorte_igual_a_pagina_inteira(main, nome):
+    html = fixture('nfce', nome)
+    assert main.ler_itens_nfe(html, restrito=True) == main.ler_itens_nfe(html, restrito=False)
+
+
+def test_maior_que_dentro_de_atributo(main):
+    html = ('<div class="txtTopo">Loja</div><table id="tabResult"><tr><td>'
+            '<span class="txtTit" title="a>b">Arroz</span><span class="Rqtd">Qtde.:2</span>'
+            '</td></tr></table>')
+    esperado = [{'nome': 'Arroz', 'quantidade': 2, 'custo': 0.0, 'fornecedor': 'Loja'}]
+    assert main.ler_itens_nfe(html, restrito=False) == esperado
+    assert main.ler_itens_nfe(html, restrito=True) == esperado
+
+
+def test_atributos_fora_do_padrao_sem_lixo_no_nome(main):
+    itens = main.ler_itens_nfe(fixture('nfce', 'nota_atributos.html'), restrito=True)
+    assert [item['nome'] for item in itens] == ['ARROZ PARBOILIZADO 5KG', 'CAFE & CIA 500G']
+    assert [item['quantidade'] for item in itens] == [2, 1]
+    assert [item['custo'] for item in itens] == [21.9, 15.49]
+    assert {item['fornecedor'] for item in itens} == {'MERCADINHO SÃO JOSÉ'}
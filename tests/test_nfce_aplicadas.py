@@ -0,0 +1,64 @@
+"""Quais NFC-e contam como já lançadas numa nova importação em lote."""
+import time
+
+import pytest
+
+CHAVES = {nome: f'3526101234567800019065001000001234{i:010d}'
+          for i, nome in enumerate(('concluida', 'pela_metade', 'sem_itens', 'nova'), 1)}
+
+
+def url(nome):
+    return f'http://sefaz.local/nota?p={CHAVES[nome]}'
+
+
+@pytest.fixture
+def arroz(main, produto):
+    return produto('Arroz 5KG', quantidade=10)
+
+
+@pytest.fixture
+def historico(main):
+    """Uma nota concluída, uma com o cadastro dos itens novos pendente e uma cuja entrada não lançou nada."""
+    main.gravar_em_lote([
+        main.registro_nfce_aplicada(CHAVES['concluida'], 'existentes', 2),
+        main.registro_nfce_aplicada(CHAVES['concluida'], 'novos', 1),
+        main.registro_nfce_aplicada(CHAVES['pela_metade'], 'existentes', 1),
+        main.registro_nfce_aplicada(CHAVES['sem_itens'], 'existentes', 0),
+    ])
+
+
+def importar(main, monkeypatch, nomes):
+    itens = [{'nome': 'Arroz 5KG', 'quantidade': 4, 'custo': 20.0, 'fornecedor': 'ATACADO'}]
+    monkeypatch.setattr(main.cliente_nfe, 'extrair', lambda u: [dict(i) for i in itens])
+    job_id = main.criar_importacao([url(nome) for nome in nomes])
+    limite = time.monotonic() + 5
+    while main.carregar_importacao(job_id)['estado'] != 'concluido':
+        assert time.monotonic() < limite
+        time.sleep(0.02)
+    return job_id
+
+
+def test_so_a_nota_concluida_e_recusada(main, historico, arroz, monkeypatch):
+    job = main.carregar_importacao(importar(main, monkeypatch, ['concluida', 'pela_metade', 'sem_itens', 'nova']))
+    assert [nota['estado'] for nota in job['notas']] == ['ja_aplicada', 'ok', 'ok', 'ok']
+
+
+def test_entrada_ja_feita_nao_se_repete(main, cliente, historico, arroz, monkeypatch):
+    job_id = importar(main, monkeypatch, ['pela_metade', 'sem_itens', 'nova'])
+    cliente.post(f'/importar_nfe/{job_id}/aplicar', data={f'sel_{n}_0': 'on' for n in range(3)})
+    job = main.carregar_importacao(job_id)
+    assert [nota['estado'] for nota in job['notas']] == ['ja_aplicada', 'aplicada', 'aplicada']
+    assert main.estoque_atual()[arroz['id']] == 10 + 4 + 4
+    # Depois do lote, as notas lançadas estão concluídas
+    assert {CHAVES['sem_itens'], CHAVES['nova']} <= main._chaves_aplicadas()
+    assert CHAVES['pela_metade'] not in main._chaves_aplicadas()
+
+
+def test_confirmar_nota_sem_itens_novos_conclui(main, cliente, arroz):
+    token = main.criar_sessao_nfce(url('nova'), CHAVES['nova'], [
+        {'nome': 'ARROZ 5KG', 'produto_id': arroz['id'], 'quantidade_nota': 3, 'custo': 20.0,
+         'fornecedor': 'ATACADO', 'estoque_atual': 10}], [])
+    cliente.post('/adicionar_produto', data={'acao': 'confirmar_itens_existentes', 'nfe_token': token,
+                                             'sel_0': 'on', 'qtd_0': '3'})
+    assert set(main.etapas_aplicadas(CHAVES['nova'])) == {'existentes', 'novos'}
+    assert CHAVES['nova'] in main._chaves_aplicadas()
@@ -0,0 +1,55 @@
+"""Journal e reparos do backend CSV: na inicialização, uma vez por processo."""
+import os
+
+import pytest
+
+
+def venda(id_venda, data, total='10.00'):
+    return {'id': str(id_venda), 'data': data, 'produto_id': '1', 'nome_produto': 'Arroz',
+            'quantidade': '1', 'total_venda': total, 'lucro_estimado': '2.00', 'ticket_id': ''}
+
+
+@pytest.fixture
+def commit_interrompido(main, monkeypatch):
+    """Deixa um journal no disco: o commit passa do ponto de confirmação e cai no meio."""
+    armazenamento = main.armazenamento
+    aplicar_passos = armazenamento._aplicar_passos
+
+    def cair(passos, recuperando):
+        aplicar_passos(passos[:1], recuperando)
+        raise OSError('disco cheio')
+
+    monkeypatch.setattr(armazenamento, '_aplicar_passos', cair)
+    linhas = [venda(1, '2026-01-10 09:00:00'), venda(2, '2026-02-10 09:00:00')]
+    with pytest.raises(OSError):
+        main.gravar_em_lote([('vendas', 'w', linhas), ('despesas', 'a', {
+            'id': '1', 'data': '2026-02-10 10:00:00', 'descricao': 'Luz', 'valor': '50', 'categoria': 'Fixa'})])
+    monkeypatch.setattr(armazenamento, '_aplicar_passos', aplicar_passos)
+    assert os.path.exists(armazenamento.JOURNAL_FILE)
+    main._cache_tabelas.clear()
+    return linhas
+
+
+def test_recuperar_roda_uma_vez_por_processo(main, monkeypatch):
+    reparados = []
+    monkeypatch.setattr(main.armazenamento, '_reparar_final', reparados.append)
+    main.init_db()
+    main.init_db()
+    assert reparados == []  # a fixture já inicializou este processo
+
+
+def test_novo_processo_conclui_o_journal(main, commit_interrompido):
+    novo = main.ArmazenamentoCSV()
+    with main.trava_dados():
+        novo.recuperar()
+    assert not os.path.exists(novo.JOURNAL_FILE)
+    assert [v['id'] for v in main.ler_csv('vendas')] == ['1', '2']
+    assert [d['id'] for d in main.ler_csv('despesas')] == ['1']
+
+
+def test_proxima_escrita_conclui_o_journal(main, commit_interrompido):
+    main.escrever_csv('despesas', {'id': '2', 'data': '2026-02-11 10:00:00', 'descricao': 'Água',
+                                   'valor': '30', 'categoria': 'Fixa'}, mode='a')
+    assert not os.path.exists(main.armazenamento.JOURNAL_FILE)
+    assert [v['id'] for v in main.ler_csv('vendas')] == ['1', '2']
+    assert [d['id'] for d in main.ler_csv('despesas')] == ['1', '2']
@@ -0,0 +1,62 @@
+"""Sequências de ids: semeadas uma vez, sem ler os dados a cada processo."""
+import os
+
+import pytest
+
+
+def venda(main, data):
+    return ('vendas', 'a', {'id': main.gerar_id('vendas'), 'data': data, 'produto_id': '1',
+                            'nome_produto': 'Arroz', 'quantidade': 1, 'total_venda': '8.00',
+                            'lucro_estimado': '3.00', 'ticket_id': main.gerar_id('tickets')})
+
+
+@pytest.fixture
+def vendas(main):
+    """Três vendas num mês fechado e uma no mês atual."""
+    main.gravar_em_lote([venda(main, f'2026-08-1{i} 10:00:00') for i in range(1, 4)])
+    main.fechar_mes('2026-08')
+    main.gravar_em_lote([venda(main, main.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))])
+    return main
+
+
+def reiniciar(main):
+    main._sequencias = None
+
+
+def test_primeira_alocacao_do_processo_nao_le_os_dados(vendas, monkeypatch):
+    main = vendas
+    reiniciar(main)
+
+    def proibido(*args, **kwargs):
+        raise AssertionError('a alocação leu os dados')
+
+    monkeypatch.setattr(main, 'ler_colunas', proibido)
+    monkeypatch.setattr(main.armazenamento, 'ler', proibido)
+    monkeypatch.setattr(main.armazenamento, 'maiores', proibido)
+    assert main.gerar_id('vendas') == 5
+    assert main.gerar_id('produtos') == 1
+    assert main.reservar_ids('tickets', 1)[0] == 5
+
+
+def test_semente_usa_o_resumo_dos_meses_fechados(vendas, monkeypatch):
+    main = vendas
+    assert main.armazenamento.fechados('vendas') == ['2026-08']
+    os.remove(main.SEQUENCIAS_FILE)
+    reiniciar(main)
+    ler_arquivo = main.armazenamento._ler_arquivo
+    lidos = []
+    monkeypatch.setattr(main.armazenamento, '_ler_arquivo',
+                        lambda caminho: (lidos.append(caminho), ler_arquivo(caminho))[1])
+    main.preparar_sequencias()
+    assert not [caminho for caminho in lidos if caminho.endswith('.gz')]
+    assert main._ler_arquivo_sequencias()['vendas'] == 4
+    assert main._ler_arquivo_sequencias()['tickets'] == 4
+    assert main.gerar_id('vendas') == 5
+
+
+def test_arquivo_apagado_com_o_processo_rodando(vendas):
+    main = vendas
+    os.remove(main.SEQUENCIAS_FILE)
+    reiniciar(main)
+    assert main.gerar_id('vendas') == 5
+    assert main.reservar_ids('tickets', 2) == range(5, 7)